@@ -0,0 +1,80 @@
+import math
+
+
+def circle_through(p1, p2, p3):
+    # Returns the center and radius of the circle through three points, or None if they are (nearly) collinear
+    ax, ay = p1
+    bx, by = p2
+    cx, cy = p3
+    d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if abs(d) < 1e-12:
+        return None
+    a2 = ax * ax + ay * ay
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    ux = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+    uy = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+    return (ux, uy), math.hypot(ax - ux, ay - uy)
+
+
+def cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def fits_arc(points, start, end, tolerance, min_radius, max_radius):
+    # Check whether points[start..end] lie on one arc that turns consistently in one direction
+    circle = circle_through(points[start], points[(start + end) // 2], points[end])
+    if circle is None:
+        return None
+    center, radius = circle
+    if radius < min_radius or radius > max_radius:
+        return None
+
+    clockwise = cross(points[start], points[start + 1], points[start + 2]) < 0
+    swept = 0.0
+    for i in range(start, end + 1):
+        if abs(math.hypot(points[i][0] - center[0], points[i][1] - center[1]) - radius) > tolerance:
+            return None
+        if i < end:
+            # Every step must turn the same way around the center and the chord must stay close to the arc
+            turn = cross(center, points[i], points[i + 1])
+            if (turn > 0) == clockwise or turn == 0:
+                return None
+            chord = math.hypot(points[i + 1][0] - points[i][0], points[i + 1][1] - points[i][1])
+            if chord > 2.0 * radius:
+                return None
+            step = 2.0 * math.asin(chord / (2.0 * radius))
+            if radius * (1.0 - math.cos(step / 2.0)) > tolerance:
+                return None
+            swept += step
+    # Keep arcs below a full turn so that the end point is unambiguous
+    if swept >= 2.0 * math.pi - 1e-3:
+        return None
+    return center, clockwise
+
+
+def fit_arcs(points, tolerance, min_points=4, max_points=200, min_radius=0.5, max_radius=1000.0):
+    """ Splits a polyline into runs that can be replaced by an arc. Returns a list of (end_index, arc) tuples where
+    arc is None for a plain line to points[end_index] or (center, clockwise) for an arc from the previous end."""
+    moves = []
+    i = 0
+    n = len(points)
+    while i < n - 1:
+        best_end = None
+        best_arc = None
+        end = i + min_points - 1
+        while end < n and end - i < max_points:
+            arc = fits_arc(points, i, end, tolerance, min_radius, max_radius)
+            if arc is None:
+                break
+            best_end = end
+            best_arc = arc
+            end += 1
+
+        if best_end is None:
+            moves.append((i + 1, None))
+            i += 1
+        else:
+            moves.append((best_end, best_arc))
+            i = best_end
+    return moves
@@ -0,0 +1,255 @@
+import struct
+import zlib
+
+try:
+    import heatshrink2
+except ImportError:
+    heatshrink2 = None
+
+# Prusa binary G-code (.bgcode) constants
+FILE_MAGIC = b"GCDE"
+FILE_VERSION = 1
+CHECKSUM_CRC32 = 1
+
+BLOCK_FILE_METADATA = 0
+BLOCK_GCODE = 1
+BLOCK_SLICER_METADATA = 2
+BLOCK_PRINTER_METADATA = 3
+BLOCK_PRINT_METADATA = 4
+
+COMPRESSION_NONE = 0
+COMPRESSION_DEFLATE = 1
+COMPRESSION_HEATSHRINK_11_4 = 2
+COMPRESSION_HEATSHRINK_12_4 = 3
+
+COMPRESSION_TYPES = {
+    "none": COMPRESSION_NONE,
+    "deflate": COMPRESSION_DEFLATE,
+    "heatshrink_11_4": COMPRESSION_HEATSHRINK_11_4,
+    "heatshrink_12_4": COMPRESSION_HEATSHRINK_12_4
+}
+
+METADATA_ENCODING_INI = 0
+GCODE_ENCODING_NONE = 0
+GCODE_ENCODING_MEATPACK = 1
+
+# The printer firmware only decodes G-code blocks that are uncompressed or heatshrink compressed, deflate is only
+# accepted for the metadata blocks
+GCODE_COMPRESSION_TYPES = ["none", "heatshrink_11_4", "heatshrink_12_4"]
+
+# Maximum amount of G-code text held before it is encoded into a block
+GCODE_BLOCK_SIZE = 65535
+
+# MeatPack packs the most common G-code characters into 4 bit nibbles
+MEATPACK_TABLE = {"0": 0, "1": 1, "2": 2, "3": 3, "4": 4, "5": 5, "6": 6, "7": 7, "8": 8, "9": 9,
+                  ".": 10, " ": 11, "\n": 12, "G": 13, "X": 14}
+MEATPACK_SIGNAL_BYTE = 0xFF
+MEATPACK_ENABLE_PACKING = 251
+MEATPACK_RESET_ALL = 249
+MEATPACK_FIRST_NOT_PACKED = 0b00001111
+MEATPACK_SECOND_NOT_PACKED = 0b11110000
+
+
+def meatpack_encode(lines):
+    """ Encodes G-code lines with MeatPack, dropping comments and empty lines."""
+    out = bytearray([MEATPACK_SIGNAL_BYTE, MEATPACK_SIGNAL_BYTE, MEATPACK_ENABLE_PACKING])
+    table = MEATPACK_TABLE
+    for line in lines:
+        line = line.split(";", 1)[0].rstrip()
+        if len(line) == 0:
+            continue
+        line += "\n"
+        for i in range(0, len(line), 2):
+            first = line[i]
+            # Odd length lines are padded with an extra newline
+            second = line[i + 1] if i + 1 < len(line) else "\n"
+            first_code = table.get(first)
+            second_code = table.get(second)
+            if first_code is not None and second_code is not None:
+                out.append((second_code << 4) | first_code)
+            elif first_code is not None:
+                out.append(MEATPACK_SECOND_NOT_PACKED | first_code)
+                out.append(ord(second))
+            elif second_code is not None:
+                out.append((second_code << 4) | MEATPACK_FIRST_NOT_PACKED)
+                out.append(ord(first))
+            else:
+                out.append(MEATPACK_FIRST_NOT_PACKED | MEATPACK_SECOND_NOT_PACKED)
+                out.append(ord(first))
+                out.append(ord(second))
+    out.extend([MEATPACK_SIGNAL_BYTE, MEATPACK_SIGNAL_BYTE, MEATPACK_RESET_ALL])
+    return bytes(out)
+
+
+def heatshrink_compress(data, window_bits=12, lookahead_bits=4, max_chain=16):
+    """ LZSS compression in the heatshrink bit format: a 1 bit followed by a literal byte, or a 0 bit followed by a
+    window_bits back-reference offset and a lookahead_bits length (both stored minus one), MSB first. Uses the
+    heatshrink2 package when it is installed. The pure Python fallback compresses well under 1 MB/s, which is minutes
+    for a large print."""
+    if heatshrink2 is not None:
+        return heatshrink2.compress(data, window_sz2=window_bits, lookahead_sz2=lookahead_bits)
+    window = 1 << window_bits
+    max_length = 1 << lookahead_bits
+    backref_bits = 1 + window_bits + lookahead_bits
+    n = len(data)
+    out = bytearray()
+    accumulator = 0
+    num_bits = 0
+    chains = {}
+
+    i = 0
+    while i < n:
+        best_length = 0
+        best_offset = 0
+        if i + 1 < n:
+            candidates = chains.get(data[i] | (data[i + 1] << 8))
+            if candidates is not None:
+                limit = min(max_length, n - i)
+                for p in reversed(candidates[-max_chain:]):
+                    if i - p > window:
+                        break
+                    length = 2
+                    while length < limit and data[p + length] == data[i + length]:
+                        length += 1
+                    if length > best_length:
+                        best_length = length
+                        best_offset = i - p
+                        if length == limit:
+                            break
+
+        # A back-reference of two bytes is already shorter than two literals
+        if best_length >= 2:
+            accumulator = (accumulator << backref_bits) | ((best_offset - 1) << lookahead_bits) | (best_length - 1)
+            num_bits += backref_bits
+            step = best_length
+        else:
+            accumulator = (accumulator << 9) | 0x100 | data[i]
+            num_bits += 9
+            step = 1
+
+        while num_bits >= 8:
+            num_bits -= 8
+            out.append((accumulator >> num_bits) & 0xFF)
+        accumulator &= (1 << num_bits) - 1
+
+        for k in range(i, min(i + step, n - 1)):
+            key = data[k] | (data[k + 1] << 8)
+            chain = chains.get(key)
+            if chain is None:
+                chains[key] = [k]
+            else:
+                chain.append(k)
+                if len(chain) > 4 * max_chain:
+                    del chain[:-max_chain]
+        i += step
+
+    if num_bits > 0:
+        out.append((accumulator << (8 - num_bits)) & 0xFF)
+    return bytes(out)
+
+
+def compress(data, compression):
+    if compression == COMPRESSION_DEFLATE:
+        return zlib.compress(data)
+    elif compression == COMPRESSION_HEATSHRINK_11_4:
+        return heatshrink_compress(data, 11, 4)
+    elif compression == COMPRESSION_HEATSHRINK_12_4:
+        return heatshrink_compress(data, 12, 4)
+    return data
+
+
+def encode_block(block_type, compression, parameters, data):
+    # Block header, parameters, (compressed) data and a CRC32 over all of them
+    payload = compress(data, compression)
+    if compression == COMPRESSION_NONE:
+        header = struct.pack("<HHI", block_type, compression, len(data))
+    else:
+        header = struct.pack("<HHII", block_type, compression, len(data), len(payload))
+    block = header + parameters + payload
+    return block + struct.pack("<I", zlib.crc32(block) & 0xFFFFFFFF)
+
+
+def encode_metadata(metadata):
+    # Metadata blocks hold INI style "key=value" lines
+    text = "".join("{}={}\n".format(key, value) for key, value in metadata.items())
+    return struct.pack("<H", METADATA_ENCODING_INI), text.encode("utf-8")
+
+
+class BGCodeFile:
+    """ File-like object that writes G-code text as a Prusa binary G-code file. Text is collected into blocks of at
+    most GCODE_BLOCK_SIZE bytes, which are encoded, compressed and written as soon as they are full."""
+
+    def __init__(self, filename, printer_metadata, print_metadata, slicer_metadata, compression="heatshrink_12_4",
+                 use_meatpack=True, metadata_compression="deflate"):
+        if compression not in GCODE_COMPRESSION_TYPES:
+            raise ValueError("Unknown or unsupported bgcode compression '{}' for G-code blocks. Please use one of: "
+                             "{}".format(compression, ", ".join(GCODE_COMPRESSION_TYPES)))
+        if metadata_compression not in COMPRESSION_TYPES:
+            raise ValueError("Unknown bgcode metadata compression '{}'. Please use one of: {}".format(
+                metadata_compression, ", ".join(COMPRESSION_TYPES.keys())))
+        if compression.startswith("heatshrink") and heatshrink2 is None:
+            print("\t-> heatshrink2 is not installed, G-code blocks are compressed by the slow pure Python encoder. "
+                  "Install it with 'pip install heatshrink2'")
+        self.compression = COMPRESSION_TYPES[compression]
+        self.metadata_compression = COMPRESSION_TYPES[metadata_compression]
+        self.use_meatpack = use_meatpack
+
+        self.file = open(filename, "wb")
+        self.raw_size = 0
+        self.written_size = 0
+
+        self.pending_lines = []
+        self.pending_size = 0
+        self.partial_line = ""
+
+        self.write_bytes(FILE_MAGIC + struct.pack("<IH", FILE_VERSION, CHECKSUM_CRC32))
+        self.write_metadata_block(BLOCK_FILE_METADATA, {"Producer": "VCAD-Slicer"})
+        # The firmware reads the printer metadata before the rest of the file, so it is never compressed
+        self.write_metadata_block(BLOCK_PRINTER_METADATA, printer_metadata, COMPRESSION_NONE)
+        self.write_metadata_block(BLOCK_PRINT_METADATA, print_metadata)
+        self.write_metadata_block(BLOCK_SLICER_METADATA, slicer_metadata)
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.written_size += len(data)
+
+    def write_metadata_block(self, block_type, metadata, compression=None):
+        parameters, data = encode_metadata(metadata)
+        if compression is None:
+            compression = self.metadata_compression
+        self.write_bytes(encode_block(block_type, compression, parameters, data))
+
+    def write_gcode_block(self):
+        if len(self.pending_lines) == 0:
+            return
+        if self.use_meatpack:
+            data = meatpack_encode(self.pending_lines)
+            encoding = GCODE_ENCODING_MEATPACK
+        else:
+            data = ("\n".join(self.pending_lines) + "\n").encode("utf-8")
+            encoding = GCODE_ENCODING_NONE
+        self.write_bytes(encode_block(BLOCK_GCODE, self.compression, struct.pack("<H", encoding), data))
+        self.pending_lines = []
+        self.pending_size = 0
+
+    def write(self, text):
+        self.raw_size += len(text)
+        if self.partial_line:
+            text = self.partial_line + text
+        lines = text.split("\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            if self.pending_size + len(line) + 1 > GCODE_BLOCK_SIZE:
+                self.write_gcode_block()
+            self.pending_lines.append(line)
+            self.pending_size += len(line) + 1
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.partial_line:
+            self.pending_lines.append(self.partial_line)
+            self.partial_line = ""
+        self.write_gcode_block()
+        self.file.close()
+        self.file = None
@@ -0,0 +1,83 @@
+import concurrent.futures
+import pyvcad as pv
+import pyvcad_compilers as pvc
+import tiled_sampling
+
+
+class BuildPlate:
+    """ Several OpenVCAD objects placed side by side on one bed, sliced as a single part. placements holds
+    (vcad_object, [x, y]) pairs, where [x, y] is where the center of the object's bounding box goes, relative to the
+    center of the bed. Every object rests on the bed, so the plate starts at z = 0. A build plate can be sliced
+    wherever an object can: it has a bounding box, and the slicers sample it through a PlateCrossSectioner. Every
+    object is wrapped in a translation to its place on the plate, so its cross-sections keep their holes."""
+
+    def __init__(self, placements):
+        if len(placements) == 0:
+            raise ValueError("A build plate needs at least one object")
+
+        self.objects = []  # (translated vcad_object, min and max in plate coordinates)
+        for vcad_object, position in placements:
+            [object_min, object_max] = vcad_object.bounding_box()
+            dx = position[0] - (object_min.x + object_max.x) / 2
+            dy = position[1] - (object_min.y + object_max.y) / 2
+            translated = pv.Translate(dx, dy, -object_min.z, vcad_object)
+            self.objects.append((translated, pv.Vec3(object_min.x + dx, object_min.y + dy, 0.0),
+                                 pv.Vec3(object_max.x + dx, object_max.y + dy, object_max.z - object_min.z)))
+
+        # Objects whose footprints overlap would be merged into one outline
+        for i in range(len(self.objects)):
+            for j in range(i + 1, len(self.objects)):
+                a_min, a_max = self.footprint(i)
+                b_min, b_max = self.footprint(j)
+                if a_min[0] < b_max[0] and b_min[0] < a_max[0] and a_min[1] < b_max[1] and b_min[1] < a_max[1]:
+                    raise ValueError("Objects {} and {} overlap on the build plate. Please move them apart".format(i, j))
+
+        self.min = pv.Vec3(min(o[1].x for o in self.objects), min(o[1].y for o in self.objects), 0.0)
+        self.max = pv.Vec3(max(o[2].x for o in self.objects), max(o[2].y for o in self.objects),
+                           max(o[2].z for o in self.objects))
+
+    def footprint(self, i):
+        vcad_object, object_min, object_max = self.objects[i]
+        return [object_min.x, object_min.y], [object_max.x, object_max.y]
+
+    def bounding_box(self):
+        return [self.min, self.max]
+
+
+class PlateCrossSectioner:
+    """ Drop-in replacement for pvc.CrossSectionSlicer that samples a build plate. Every object is sampled through
+    its own cross-sectioner (tiled if tiled sampling is used) on a thread pool. The objects are already translated to
+    their place on the plate, so their outlines or range polygons are merged into one cross-section as they are."""
+
+    def __init__(self, plate, voxel_size, settings):
+        self.workers = settings["slicer_settings"].get("build_plate", {}).get("workers", 4)
+        tiled = settings["slicer_settings"].get("tiled_sampling", {}).get("use", False)
+        self.objects = []  # (cross-sectioner, object top z)
+        for vcad_object, object_min, object_max in plate.objects:
+            if tiled:
+                sectioner = tiled_sampling.TiledCrossSectioner(vcad_object, object_min, object_max, voxel_size,
+                                                               settings)
+            else:
+                sectioner = pvc.CrossSectionSlicer(vcad_object, object_min, object_max, voxel_size)
+            self.objects.append((sectioner, object_max.z))
+
+    def sample(self, z, sample_object):
+        # Only the objects that reach the height are sampled
+        active = [sectioner for sectioner, top_z in self.objects if z <= top_z + 1e-9]
+        if self.workers > 1 and len(active) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(sample_object, active))
+        return [sample_object(sectioner) for sectioner in active]
+
+    def slice_geometry(self, z):
+        outlines = []
+        for result in self.sample(z, lambda sectioner: sectioner.slice_geometry(z)):
+            outlines.extend(result)
+        return outlines
+
+    def slice_material(self, z, material, ranges):
+        pieces = {}
+        for result in self.sample(z, lambda sectioner: sectioner.slice_material(z, material, ranges)):
+            for lower, higher, polygons in result:
+                pieces.setdefault((lower, higher), []).extend(polygons)
+        return [(lower, higher, pieces.get((lower, higher), [])) for lower, higher in ranges]
@@ -0,0 +1,251 @@
+import copy
+import glob
+import hashlib
+import json
+import os
+import struct
+import zlib
+import pyvcad as pv
+
+CHUNK_MAGIC = b"VCKP"
+CHUNK_VERSION = 4
+
+RECORD_CUT = 0
+RECORD_CONNECTED = 1
+
+# Settings that do not change the per-layer results, so they may differ between a job and its resumption
+RESUMABLE_SETTINGS = ["checkpointing", "partial_slicing", "preview", "multi_target"]
+
+
+class RecordWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def pack(self, fmt, *values):
+        self.data += struct.pack("<" + fmt, *values)
+
+    def range(self, r):
+        if r is None:
+            self.pack("B", 0)
+        else:
+            self.pack("Bdd", 1, r[0], r[1])
+
+    def points(self, polyline):
+        points = polyline.points()
+        self.pack("I", len(points))
+        coordinates = []
+        for p in points:
+            coordinates.append(p.x())
+            coordinates.append(p.y())
+        self.pack("{}d".format(len(coordinates)), *coordinates)
+
+    def ranged_paths(self, ranged_paths):
+        self.pack("I", len(ranged_paths))
+        for lower, higher, paths in ranged_paths:
+            self.pack("ddI", lower, higher, len(paths))
+            for polyline in paths:
+                self.points(polyline)
+
+
+class RecordReader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        fmt = "<" + fmt
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def range(self):
+        if self.unpack("B")[0] == 0:
+            return None
+        return self.unpack("dd")
+
+    def points(self):
+        count = self.unpack("I")[0]
+        coordinates = self.unpack("{}d".format(2 * count))
+        return pv.Polyline2([pv.Point2(coordinates[2 * i], coordinates[2 * i + 1]) for i in range(count)])
+
+    def ranged_paths(self):
+        ranged_paths = []
+        for i in range(self.unpack("I")[0]):
+            lower, higher, count = self.unpack("ddI")
+            ranged_paths.append((lower, higher, [self.points() for j in range(count)]))
+        return ranged_paths
+
+
+class Checkpointer:
+    """ Saves the per-layer results of a slicing job to a job directory, so that a job that dies can be resumed
+    without cutting or connecting the layers it had finished again. Records hold the cut walls and infill and the
+    connected paths of a layer as packed coordinates. They are collected in memory and written every few layers as a
+    zlib compressed chunk, under a temporary name that is only renamed once the chunk is complete, so a crash never
+    leaves a partial chunk behind. A manifest holds a hash of the settings, the ranges and the object, and checkpoints
+    of a different job are never resumed from. The object is fingerprinted by its bounding box and a few sampled
+    material cross-sections, since the settings do not describe it."""
+
+    def __init__(self, settings):
+        checkpoint_settings = settings["slicer_settings"].get("checkpointing", {})
+        self.directory = checkpoint_settings.get("directory",
+                                                 os.path.join("output", "checkpoints",
+                                                              settings["object_settings"]["name"]))
+        self.flush_every = checkpoint_settings.get("flush_every", 10)
+        self.resume = checkpoint_settings.get("resume", True)
+        self.fingerprint_layers = checkpoint_settings.get("fingerprint_layers", 4)
+        if self.flush_every < 1:
+            raise ValueError("Checkpoints must be flushed at least every layer")
+
+        job_settings = copy.deepcopy(settings)
+        for name in RESUMABLE_SETTINGS:
+            job_settings["slicer_settings"].pop(name, None)
+        self.settings_json = json.dumps(job_settings, sort_keys=True)
+
+        self.cuts = {}
+        self.connected = {}
+        self.pending = []
+        self.next_chunk = 0
+
+        self.restored_cuts = 0
+        self.restored_connections = 0
+        self.stored_records = 0
+
+    def object_fingerprint(self, cross_sectioner, object_min, object_max, ranges):
+        data = [round(v, 6) for v in [object_min.x, object_min.y, object_min.z, object_max.x, object_max.y,
+                                      object_max.z]]
+        for k in range(self.fingerprint_layers):
+            z = object_min.z + (k + 0.5) * (object_max.z - object_min.z) / self.fingerprint_layers
+            for lower, higher, polygons in cross_sectioner.slice_material(z, 1, ranges):
+                for polygon in polygons:
+                    for ring in [polygon] + list(polygon.holes()):
+                        data.append((lower, higher, tuple((round(p.x(), 4), round(p.y(), 4)) for p in ring)))
+        return hashlib.sha1(repr(data).encode()).hexdigest()
+
+    def job_hash(self, ranges, object_fingerprint):
+        return hashlib.sha1((self.settings_json + repr([tuple(r) for r in ranges]) + object_fingerprint).encode()
+                            ).hexdigest()
+
+    def open(self, ranges, cross_sectioner, object_min, object_max):
+        """ Loads the checkpoints of an earlier run of the same job, or starts a new job in the directory."""
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_path = os.path.join(self.directory, "job.json")
+        job_hash = self.job_hash(ranges, self.object_fingerprint(cross_sectioner, object_min, object_max, ranges))
+        chunk_paths = sorted(glob.glob(os.path.join(self.directory, "chunk_*.bin")))
+
+        if self.resume and os.path.exists(manifest_path):
+            with open(manifest_path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest["job_hash"] != job_hash:
+                raise ValueError("The checkpoints in {} belong to a job with different settings, ranges or object. "
+                                 "Please remove them or choose another checkpoint directory".format(self.directory))
+            for path in chunk_paths:
+                self.load_chunk(path)
+            self.next_chunk = len(chunk_paths)
+            print("\t-> Resuming from {} cut and {} connected layers in {}".format(
+                len(self.cuts), len(self.connected), self.directory))
+            return
+
+        for path in chunk_paths:
+            os.remove(path)
+        with open(manifest_path, "w") as manifest_file:
+            json.dump({"job_hash": job_hash}, manifest_file)
+
+    def load_chunk(self, path):
+        with open(path, "rb") as chunk_file:
+            data = chunk_file.read()
+        magic, version = struct.unpack_from("<4sI", data, 0)
+        if magic != CHUNK_MAGIC or version != CHUNK_VERSION:
+            raise ValueError("{} is not a checkpoint chunk of this version".format(path))
+        reader = RecordReader(zlib.decompress(data[8:]))
+        while reader.offset < len(reader.data):
+            kind, layer_num, z, length = reader.unpack("BIdI")
+            record = reader.data[reader.offset:reader.offset + length]
+            reader.offset += length
+            if kind == RECORD_CUT:
+                self.cuts[layer_num] = (z, record)
+            else:
+                self.connected[layer_num] = (z, record)
+
+    def add_record(self, kind, layer_num, z, writer):
+        header = struct.pack("<BIdI", kind, layer_num, z, len(writer.data))
+        self.pending.append(header + bytes(writer.data))
+        self.stored_records += 1
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        path = os.path.join(self.directory, "chunk_{:06d}.bin".format(self.next_chunk))
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as chunk_file:
+            chunk_file.write(struct.pack("<4sI", CHUNK_MAGIC, CHUNK_VERSION))
+            chunk_file.write(zlib.compress(b"".join(self.pending)))
+            chunk_file.flush()
+            os.fsync(chunk_file.fileno())
+        os.replace(temporary_path, path)
+        self.next_chunk += 1
+        self.pending = []
+
+    @staticmethod
+    def find(records, layer_num, z):
+        # Records are keyed by layer number, the height guards against a changed object
+        if layer_num not in records:
+            return None
+        record_z, record = records[layer_num]
+        if abs(record_z - z) > 1e-6:
+            return None
+        return RecordReader(record)
+
+    def has_cut(self, layer_num, z):
+        return self.find(self.cuts, layer_num, z) is not None
+
+    def store_cut(self, layer_num, z, ranged_walls, ranged_infill, ranged_combined_infill, infill_thickness):
+        writer = RecordWriter()
+        writer.pack("I", infill_thickness)
+        writer.ranged_paths(ranged_walls)
+        writer.ranged_paths(ranged_infill)
+        writer.ranged_paths(ranged_combined_infill)
+        self.add_record(RECORD_CUT, layer_num, z, writer)
+
+    def restore_cut(self, layer_num, z):
+        """ Returns the ranged walls, infill and combined infill and the infill thickness of a cut layer, or None."""
+        reader = self.find(self.cuts, layer_num, z)
+        if reader is None:
+            return None
+        infill_thickness = reader.unpack("I")[0]
+        ranged_walls = reader.ranged_paths()
+        ranged_infill = reader.ranged_paths()
+        ranged_combined_infill = reader.ranged_paths()
+        self.restored_cuts += 1
+        return ranged_walls, ranged_infill, ranged_combined_infill, infill_thickness
+
+    def store_connected(self, layer_num, z, connected_paths, skipped_ranges, purge_range):
+        # The range purged last is kept so that purging continues correctly after a restored layer
+        writer = RecordWriter()
+        writer.pack("I", skipped_ranges)
+        writer.range(purge_range)
+        writer.pack("I", len(connected_paths))
+        for lower, higher, is_extrusion, polyline, layers in connected_paths:
+            writer.pack("ddBI", lower, higher, is_extrusion, layers)
+            writer.points(polyline)
+        self.add_record(RECORD_CONNECTED, layer_num, z, writer)
+
+    def restore_connected(self, layer_num, z):
+        """ Returns the connected paths, skipped range count and last purged range of a layer, or None."""
+        reader = self.find(self.connected, layer_num, z)
+        if reader is None:
+            return None
+        skipped_ranges = reader.unpack("I")[0]
+        purge_range = reader.range()
+        connected_paths = []
+        for i in range(reader.unpack("I")[0]):
+            lower, higher, is_extrusion, layers = reader.unpack("ddBI")
+            connected_paths.append((lower, higher, is_extrusion == 1, reader.points(), layers))
+        self.restored_connections += 1
+        return connected_paths, skipped_ranges, purge_range
+
+    def report(self):
+        self.flush()
+        print("\t-> Checkpoints restored {} cut and {} connected layers and stored {} records in {}".format(
+            self.restored_cuts, self.restored_connections, self.stored_records, self.directory))
@@ -0,0 +1,307 @@
+import math
+import pyvcad as pv
+import simplification
+
+# Travels that stay inside the part are labelled with this value as their lower and higher bounds, which tells the
+# writer that they do not need a retraction or Z-lift
+COMBED_TRAVEL = -1
+
+
+def distance(p1, p2):
+    return ((p1.x() - p2.x()) ** 2 + (p1.y() - p2.y()) ** 2) ** 0.5
+
+
+def polygon_rings(polygons):
+    # The outer boundaries and holes of a list of polygons as open rings of (x, y) tuples
+    rings = []
+    for polygon in polygons:
+        for ring in [polygon] + list(polygon.holes()):
+            points = [(p.x(), p.y()) for p in ring]
+            if len(points) > 1 and points[0] == points[-1]:
+                points.pop()
+            if len(points) >= 3:
+                rings.append(points)
+    return rings
+
+
+class EdgeGrid:
+    """ Uniform grid over the edges of a set of rings, for fast segment crossing and point-in-polygon queries."""
+
+    def __init__(self, rings):
+        self.rings = rings
+        self.edges = []
+        for ring_index in range(len(rings)):
+            ring = rings[ring_index]
+            for i in range(len(ring)):
+                a = ring[i]
+                b = ring[(i + 1) % len(ring)]
+                self.edges.append((a[0], a[1], b[0], b[1], ring_index, i))
+
+        if len(self.edges) == 0:
+            self.cell_size = 1.0
+            self.cells = {}
+            self.max_ix = 0
+            self.min_cell = (0, 0)
+            self.max_cell = (0, 0)
+            return
+        min_x = min(min(e[0], e[2]) for e in self.edges)
+        max_x = max(max(e[0], e[2]) for e in self.edges)
+        min_y = min(min(e[1], e[3]) for e in self.edges)
+        max_y = max(max(e[1], e[3]) for e in self.edges)
+        self.cell_size = max(max(max_x - min_x, max_y - min_y) / 64.0, 0.5)
+        self.max_ix = int(math.floor(max_x / self.cell_size))
+
+        # Every edge goes into each cell its (slightly padded) bounding box touches
+        self.cells = {}
+        padding = 1e-6
+        for edge_id in range(len(self.edges)):
+            x1, y1, x2, y2 = self.edges[edge_id][:4]
+            for ix in range(int(math.floor((min(x1, x2) - padding) / self.cell_size)),
+                            int(math.floor((max(x1, x2) + padding) / self.cell_size)) + 1):
+                for iy in range(int(math.floor((min(y1, y2) - padding) / self.cell_size)),
+                                int(math.floor((max(y1, y2) + padding) / self.cell_size)) + 1):
+                    self.cells.setdefault((ix, iy), []).append(edge_id)
+        self.min_cell = (min(ix for ix, iy in self.cells), min(iy for ix, iy in self.cells))
+        self.max_cell = (max(ix for ix, iy in self.cells), max(iy for ix, iy in self.cells))
+
+    def segment_edges(self, a, b):
+        # Ids of the edges in the cells that the segment from a to b passes through
+        if a[0] > b[0]:
+            a, b = b, a
+        size = self.cell_size
+        padding = 1e-6
+        found = set()
+        for ix in range(int(math.floor(a[0] / size)), int(math.floor(b[0] / size)) + 1):
+            # Part of the segment that lies within this column of cells
+            x0 = max(a[0], ix * size)
+            x1 = min(b[0], (ix + 1) * size)
+            if b[0] == a[0]:
+                y0, y1 = a[1], b[1]
+            else:
+                y0 = a[1] + (x0 - a[0]) * (b[1] - a[1]) / (b[0] - a[0])
+                y1 = a[1] + (x1 - a[0]) * (b[1] - a[1]) / (b[0] - a[0])
+            for iy in range(int(math.floor((min(y0, y1) - padding) / size)),
+                            int(math.floor((max(y0, y1) + padding) / size)) + 1):
+                found.update(self.cells.get((ix, iy), ()))
+        return found
+
+    def crossings(self, a, b):
+        # Sorted (t, ring, edge, point) of every place where the segment from a to b crosses an edge
+        result = []
+        rx = b[0] - a[0]
+        ry = b[1] - a[1]
+        for edge_id in self.segment_edges(a, b):
+            cx, cy, dx, dy, ring_index, index = self.edges[edge_id]
+            sx = dx - cx
+            sy = dy - cy
+            denominator = rx * sy - ry * sx
+            if denominator == 0:
+                continue
+            t = ((cx - a[0]) * sy - (cy - a[1]) * sx) / denominator
+            u = ((cx - a[0]) * ry - (cy - a[1]) * rx) / denominator
+            # Edges are half open so that a crossing through a shared vertex is only counted once
+            if 0 <= t <= 1 and 0 <= u < 1:
+                result.append((t, ring_index, index, (a[0] + t * rx, a[1] + t * ry)))
+        result.sort()
+        return result
+
+    def point_inside(self, p):
+        # Even-odd rule with a ray towards +x, only looking at the cells on its row
+        size = self.cell_size
+        iy = int(math.floor(p[1] / size))
+        seen = set()
+        inside = False
+        for ix in range(int(math.floor(p[0] / size)), self.max_ix + 1):
+            for edge_id in self.cells.get((ix, iy), ()):
+                if edge_id in seen:
+                    continue
+                seen.add(edge_id)
+                x1, y1, x2, y2 = self.edges[edge_id][:4]
+                if (y1 > p[1]) != (y2 > p[1]):
+                    if x1 + (p[1] - y1) * (x2 - x1) / (y2 - y1) > p[0]:
+                        inside = not inside
+        return inside
+
+    def nearest_point(self, p):
+        # (ring, edge, point) of the closest point on any edge, searching outwards one ring of cells at a time
+        if len(self.edges) == 0:
+            return None
+        size = self.cell_size
+        cx = int(math.floor(p[0] / size))
+        cy = int(math.floor(p[1] / size))
+        best = None
+        best_distance = float('inf')
+        seen = set()
+        radius = 0
+        max_radius = max(abs(cx - self.min_cell[0]), abs(cx - self.max_cell[0]),
+                         abs(cy - self.min_cell[1]), abs(cy - self.max_cell[1]))
+        while radius <= max_radius and best_distance > (radius - 1) * size:
+            for ix in range(cx - radius, cx + radius + 1):
+                for iy in range(cy - radius, cy + radius + 1):
+                    if max(abs(ix - cx), abs(iy - cy)) != radius:
+                        continue
+                    for edge_id in self.cells.get((ix, iy), ()):
+                        if edge_id in seen:
+                            continue
+                        seen.add(edge_id)
+                        x1, y1, x2, y2, ring_index, index = self.edges[edge_id]
+                        dx = x2 - x1
+                        dy = y2 - y1
+                        length_squared = dx * dx + dy * dy
+                        t = 0.0
+                        if length_squared > 0:
+                            t = max(0.0, min(1.0, ((p[0] - x1) * dx + (p[1] - y1) * dy) / length_squared))
+                        point = (x1 + t * dx, y1 + t * dy)
+                        distance_to_edge = math.hypot(point[0] - p[0], point[1] - p[1])
+                        if distance_to_edge < best_distance:
+                            best_distance = distance_to_edge
+                            best = (ring_index, index, point)
+            radius += 1
+        return best
+
+    def segment_inside(self, a, b, tolerance=0):
+        # The segment may touch the boundary at its ends but must not cross it, and its middle must be inside (or
+        # within the tolerance of the boundary, for segments that run along it)
+        for t, ring_index, index, point in self.crossings(a, b):
+            if 1e-9 < t < 1 - 1e-9:
+                return False
+        middle = ((a[0] + b[0]) / 2, (a[1] + b[1]) / 2)
+        if self.point_inside(middle):
+            return True
+        if tolerance > 0:
+            nearest = self.nearest_point(middle)
+            return nearest is not None and math.hypot(nearest[2][0] - middle[0], nearest[2][1] - middle[1]) <= tolerance
+        return False
+
+
+class CombingPlanner:
+    """ Routes long travels inside the part instead of straight across open space, so that they do not need a
+    retraction or Z-lift. A travel that leaves the part is replaced by a walk along the outline inset by the combing
+    distance, which is then shortened by skipping every corner that can be cut without leaving the part. Travels
+    that cannot be routed, or whose detour is too long, are left as they are."""
+
+    def __init__(self, settings):
+        combing_settings = settings["slicer_settings"].get("combing", {})
+        bead_width = settings["printer_settings"]["nozzle_diameter"]
+        self.distance = combing_settings.get("distance_ratio", 1.0) * bead_width
+        self.max_detour_ratio = combing_settings.get("max_detour_ratio", 2.0)
+        # Shorter travels are not retracted anyway
+        self.min_length = settings["printer_settings"]["retraction"]["required_distance"]
+
+        self.total_travels = 0
+        self.total_combed = 0
+
+    def comb_paths(self, outline, paths):
+        """ Returns the paths with every long travel that could be kept inside the outline replaced by a combed
+        travel, the number of combed travels and the number of long travels."""
+        part = None
+        combed_count = 0
+        total = 0
+        result = []
+        for lower, higher, is_extrusion, polyline, layers in paths:
+            points = polyline.points()
+            if is_extrusion or len(points) != 2 or distance(points[0], points[1]) < self.min_length:
+                result.append((lower, higher, is_extrusion, polyline, layers))
+                continue
+
+            # Only build the boundaries once a layer has a travel to comb
+            if part is None:
+                part, pull, rings = self.build_boundaries(outline)
+
+            total += 1
+            route = self.comb(part, pull, rings, (points[0].x(), points[0].y()), (points[1].x(), points[1].y()))
+            if route is None:
+                result.append((lower, higher, is_extrusion, polyline, layers))
+                continue
+            combed_count += 1
+            result.append((COMBED_TRAVEL, COMBED_TRAVEL, False, pv.Polyline2([pv.Point2(x, y) for x, y in route]), 1))
+
+        self.total_travels += total
+        self.total_combed += combed_count
+        return result, combed_count, total
+
+    def build_boundaries(self, outline):
+        # The part itself, a boundary halfway to the combing rings that shortcuts must stay inside, and the rings
+        part = EdgeGrid(polygon_rings(outline))
+        pull = EdgeGrid(polygon_rings(pv.Polygon2.Offset(outline, -self.distance / 2)))
+        rings = [simplification.simplify_ring(ring, self.distance / 4)
+                 for ring in polygon_rings(pv.Polygon2.Offset(outline, -self.distance))]
+        return part, pull, EdgeGrid(rings)
+
+    def comb(self, part, pull, rings, start, end):
+        straight = math.hypot(end[0] - start[0], end[1] - start[1])
+        if part.segment_inside(start, end):
+            return [start, end]
+        if not part.point_inside(start) or not part.point_inside(end):
+            return None
+
+        # Step onto the nearest combing ring, follow the straight line between the two ring points wherever it is
+        # inside the rings, walk along a ring wherever it is not, and step off to the end point
+        first = rings.nearest_point(start)
+        last = rings.nearest_point(end)
+        if first is None or last is None:
+            return None
+        a = first[2]
+        b = last[2]
+        route = [start, a]
+        length = math.hypot(b[0] - a[0], b[1] - a[1])
+        if length > 0:
+            step = min(1e-4 / length, 0.5)
+            inside = rings.point_inside((a[0] + step * (b[0] - a[0]), a[1] + step * (b[1] - a[1])))
+            events = [first] + [(ring_index, index, point) for t, ring_index, index, point in rings.crossings(a, b)
+                                if 1e-9 < t < 1 - 1e-9] + [last]
+            for k in range(len(events) - 1):
+                if not inside and events[k][0] == events[k + 1][0]:
+                    route.extend(self.ring_walk(rings.rings[events[k][0]], events[k], events[k + 1]))
+                route.append(events[k + 1][2])
+                inside = not inside
+        route.append(end)
+
+        route = self.pull(part, pull, route)
+        if route is None:
+            return None
+        length = sum(math.hypot(q[0] - p[0], q[1] - p[1]) for p, q in zip(route, route[1:]))
+        if length > self.max_detour_ratio * straight:
+            return None
+        return route
+
+    @staticmethod
+    def ring_walk(ring, exit_point, entry_point):
+        # Vertices between two (ring, edge, point) places on the same ring, going the shorter way around
+        n = len(ring)
+        first = exit_point[1]
+        last = entry_point[1]
+        if first == last:
+            return []
+        forward = [ring[(first + 1 + k) % n] for k in range((last - first) % n)]
+        backward = [ring[(first - k) % n] for k in range((first - last) % n)]
+
+        def length(points):
+            points = [exit_point[2]] + points + [entry_point[2]]
+            return sum(math.hypot(q[0] - p[0], q[1] - p[1]) for p, q in zip(points, points[1:]))
+
+        if length(forward) <= length(backward):
+            return forward
+        return backward
+
+    @staticmethod
+    def pull(part, pull, route):
+        # Skip corners as long as the shortcut stays inside. Legs from the start or to the end only have to stay
+        # inside the part, as those points lie on the walls themselves
+        last = len(route) - 1
+
+        def leg_inside(i, j):
+            boundary = part if i == 0 or j == last else pull
+            return boundary.segment_inside(route[i], route[j])
+
+        result = [route[0]]
+        i = 0
+        while i < last:
+            if not leg_inside(i, i + 1):
+                return None
+            j = i + 1
+            while j < last and leg_inside(i, j + 1):
+                j += 1
+            result.append(route[j])
+            i = j
+        return result
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressedOutputFile:
+    """ File-like object that hands buffered G-code text to a background thread through a bounded queue. The thread
+    compresses the stream (gzip, or zstd when the zstandard package is available) and writes it to disk, so that
+    compression overlaps with path generation and the uncompressed G-code is never written out."""
+
+    def __init__(self, filename, compression="gzip", level=6, queue_size=8, buffer_size=1 << 20):
+        if compression == "zstd" and zstandard is None:
+            print("\t-> zstandard is not installed, falling back to gzip compression")
+            compression = "gzip"
+        if compression == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.extension = ".zst"
+        elif compression == "gzip":
+            # A window size of 16 + 15 makes zlib write a gzip header and trailer
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.extension = ".gz"
+        else:
+            raise ValueError("Unknown output compression '{}'. Please use 'gzip' or 'zstd'".format(compression))
+        self.compression = compression
+
+        self.file = open(filename + self.extension, "wb")
+        self.filename = filename + self.extension
+        self.buffer = []
+        self.buffered_size = 0
+        self.buffer_size = buffer_size
+
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.compression_time = 0.0
+        self.start_time = time.perf_counter()
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if self.error is not None:
+                if chunk is None:
+                    return
+                continue
+            try:
+                start = time.perf_counter()
+                if chunk is None:
+                    data = self.compressor.flush()
+                else:
+                    data = self.compressor.compress(chunk)
+                self.file.write(data)
+                self.compressed_size += len(data)
+                self.compression_time += time.perf_counter() - start
+            except Exception as e:
+                # Keep draining the queue so the writer never blocks, the error is raised on the next write
+                self.error = e
+            if chunk is None:
+                return
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered_size += len(text)
+        if self.buffered_size >= self.buffer_size:
+            self.submit_buffer()
+
+    def submit_buffer(self):
+        # Hand the buffered text to the compression thread, blocking if it has fallen too far behind
+        self.check_error()
+        if self.buffered_size == 0:
+            return
+        data = "".join(self.buffer).encode("utf-8")
+        self.raw_size += len(data)
+        self.buffer = []
+        self.buffered_size = 0
+        self.queue.put(data)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.submit_buffer()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.file = None
+        self.check_error()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            "compression": self.compression,
+            "raw_size": self.raw_size,
+            "compressed_size": self.compressed_size,
+            "ratio": self.raw_size / max(self.compressed_size, 1),
+            "compression_throughput_mb_s": self.raw_size / 1e6 / max(self.compression_time, 1e-9),
+            "overall_throughput_mb_s": self.raw_size / 1e6 / max(elapsed, 1e-9)
+        }
@@ -0,0 +1,365 @@
+import io
+import math
+import arc_fitting
+
+
+class GCodeFormatter:
+    """ Turns a planned layer into G-code text. A plan (see GCodeWriter.plan_layer) holds plain numbers only and
+    carries the position and feedrate the layer starts with, so layers can be formatted independently of each other,
+    for example in a process pool, and the text concatenated in order."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.filament_diameter = settings["printer_settings"]["filament_diameter"]
+        self.bead_width = settings["printer_settings"]["nozzle_diameter"]
+        self.travel_speed = settings["printer_settings"]["speeds"]["travel"]
+        self.volume_max = settings["printer_settings"]["dimensions"]["max"]
+
+        self.use_retraction = settings["printer_settings"]["retraction"]["use"]
+        self.retraction_required_distance = settings["printer_settings"]["retraction"]["required_distance"]
+        self.retraction_length = settings["printer_settings"]["retraction"]["length"]
+        self.retraction_speed = settings["printer_settings"]["retraction"]["speed"]
+        self.un_retraction_length = settings["printer_settings"]["retraction"]["un_retract_length"]
+        self.un_retraction_speed = settings["printer_settings"]["retraction"]["un_retract_speed"]
+        self.coasting_distance = settings["printer_settings"]["coasting_distance"]
+        self.z_lift_height = settings["printer_settings"].get("z_lift_height", 0.0)
+
+        # Optional G2/G3 arc fitting of extrusion moves (not combined with coasting, which splits single segments)
+        arc_settings = settings["printer_settings"].get("arc_fitting", {})
+        self.use_arc_fitting = arc_settings.get("use", False) and self.coasting_distance == 0
+        self.arc_fitting_tolerance = arc_settings.get("tolerance", 0.01)
+        self.arc_buffer = []
+        self.arc_input_segments = 0
+        self.arc_output_lines = 0
+
+        # The move optimizer leaves out Z and feedrate words that would not change anything
+        self.drop_redundant_words = settings["slicer_settings"].get("move_optimization", {}).get("use", False)
+
+        self.layer_height = settings["slicer_settings"]["layer_height"]
+        self.flow_rate = settings["material_settings"]["flow_rate"] / 100.0
+        self.mode = settings["gradient_settings"]["mode"]
+        self.num_regions = settings["gradient_settings"]["num_regions"]
+
+        self.file = None
+        self.current_x = 0
+        self.current_y = 0
+        self.current_z = 0
+        self.current_lower = 0
+        self.current_higher = 0
+        self.current_layer_number = 0
+        self.current_feedrate = 0
+        self.desired_extrusion_feedrate = 0
+
+    def format_layer(self, plan):
+        """ Returns the text of a planned layer and the number of extrusion segments and moves written by arc
+        fitting."""
+        self.file = io.StringIO()
+        self.current_layer_number = plan["layer_number"]
+        self.current_z = plan["z"]
+        self.current_x = plan["x"]
+        self.current_y = plan["y"]
+        self.current_feedrate = plan["feedrate"]
+        self.desired_extrusion_feedrate = plan["desired_feedrate"]
+        self.arc_buffer = []
+        self.arc_input_segments = 0
+        self.arc_output_lines = 0
+
+        # Write the z change
+        self.write_comment("|===== Layer {} =====|".format(self.current_layer_number))
+        self.write_comment("LAYER_CHANGE")
+        self.write_comment("HEIGHT: {:.4f}".format(self.current_z))
+
+        # Set the fan speed based on the layer number
+        if self.current_layer_number == 1:
+            self.file.write("M107 ; Turn fan off for first layer\n")
+        elif self.current_layer_number == 2:
+            self.file.write("M106 S80\n")
+        elif self.current_layer_number == 3:
+            self.file.write("M106 S160\n")
+        elif self.current_layer_number == 4:
+            self.file.write("M106 S230\n")
+        else:
+            self.file.write("M106 S255\n")
+
+        # If this was the first layer, do initial un-retraction
+        if self.current_layer_number == 1:
+            self.file.write("G1 E1.2 F2400\t ;Initial un-retract\n")
+        elif plan["resume"]:
+            self.file.write("G1 E1.2 F2400\t ;Un-retract after resuming\n")
+
+        # Go to new z height
+        self.file.write("G1 Z{:.4f}\n".format(self.current_z))
+
+        for op in plan["ops"]:
+            if op[0] == "extrude":
+                self.write_extrusion_line(op[1], op[2], op[3], op[4], op[5], op[6] if len(op) > 6 else None)
+            elif op[0] == "travel":
+                self.write_travel(op[1], op[2], op[3], op[4])
+            elif op[0] == "comb":
+                self.write_travel(op[1], op[2], op[3], op[4], False)
+            elif op[0] == "mixture":
+                self.write_mixing_ratios(op[1], op[2])
+            elif op[0] == "big_un_retract":
+                self.write_big_un_retraction()
+        self.flush_arc_buffer()
+
+        text = self.file.getvalue()
+        self.file = None
+        return text, self.arc_input_segments, self.arc_output_lines
+
+    def calculate_extrusion_amount(self, source_x, source_y, end_x, end_y, layers=1):
+        """ Calculate the amount of extrusion needed for the segment using the capsule model. Combined infill
+        fills the height of several layers at once."""
+        segment_length = math.sqrt((end_x - source_x) ** 2 + (end_y - source_y) ** 2)
+        bead_width = self.bead_width
+        layer_height = self.layer_height * layers
+        filament_diameter = self.filament_diameter
+
+        volume_to_extrude = segment_length * bead_width * layer_height # 2
+        filament_radius = filament_diameter / 2
+        filament_length = volume_to_extrude / (math.pi * filament_radius ** 2)
+
+        return filament_length * self.flow_rate
+
+    def write_retraction(self):
+        self.flush_arc_buffer()
+        self.file.write("G1 E-{:.4f} F{:.4f} ; Retract\n".format(self.retraction_length, self.retraction_speed))
+        self.current_feedrate = self.retraction_speed
+
+    def write_un_retraction(self):
+        self.file.write("G1 E{:.4f} F{:.4f} ; Unretract\n".format(self.un_retraction_length, self.un_retraction_speed))
+        self.current_feedrate = self.un_retraction_speed
+
+    def write_big_retraction(self):
+        self.flush_arc_buffer()
+        self.file.write("G1 E-{:.4f} F{:.4f} ; Big retract\n".format(self.retraction_length * 4, self.retraction_speed))
+        self.current_feedrate = self.retraction_speed
+
+    def write_big_un_retraction(self):
+        self.file.write("G1 E{:.4f} F{:.4f} ; Big unretract\n".format(self.un_retraction_length * 4, self.un_retraction_speed))
+        self.current_feedrate = self.un_retraction_speed
+
+    def write_travel(self, start_x, start_y, end_x, end_y, allow_retraction=True):
+        self.flush_arc_buffer()
+        self.current_x = end_x
+        self.current_y = end_y
+
+        length = math.sqrt((end_x - start_x) ** 2 + (end_y - start_y) ** 2)
+
+        should_retract = False
+        if length > self.retraction_required_distance and self.use_retraction and allow_retraction:
+            should_retract = True
+
+        if should_retract:
+            self.write_retraction()
+
+        # Only perform Z-lift if height is greater than zero and the travel distance is long enough
+        if self.z_lift_height > 0 and length >= self.retraction_required_distance and allow_retraction:
+            # Step 1: Lift the nozzle
+            lifted_z = self.current_z + self.z_lift_height
+            self.file.write("G1 Z{:.4f}{}; Z-lift\n".format(lifted_z, self.travel_feedrate_word()))
+
+            # Step 2: Perform XY travel move with lifted Z
+            self.file.write("G1 X{:.4f} Y{:.4f}{}; Travel XY\n".format(
+                self.current_x, self.current_y, self.travel_feedrate_word()))
+            self.current_feedrate = self.travel_speed
+
+            # Step 3: Lower back to printing height
+            self.file.write("G1 Z{:.4f}{}; Z-lower\n".format(self.current_z, self.travel_feedrate_word()))
+        else:
+            # Just perform XY travel without changing Z
+            self.file.write("G1 X{:.4f} Y{:.4f}{}; Travel XY\n".format(
+                self.current_x, self.current_y, self.travel_feedrate_word()))
+            self.current_feedrate = self.travel_speed
+
+        if should_retract:
+            self.write_un_retraction()
+
+    def travel_feedrate_word(self):
+        if self.drop_redundant_words and self.current_feedrate == self.travel_speed:
+            return ""
+        self.current_feedrate = self.travel_speed
+        return " F{:.4f}".format(self.travel_speed)
+
+    def z_word(self):
+        # Layers and travels always come back to the layer height, so extrusions never change Z
+        if self.drop_redundant_words:
+            return ""
+        return " Z{:.4f}".format(self.current_z)
+
+    def write_extrusion_line(self, source_x, source_y, end_x, end_y, distance_to_next_travel, extrusion_amount=None):
+        # Merged moves carry the extrusion amount of the segments they replace
+        if extrusion_amount is None:
+            extrusion_amount = self.calculate_extrusion_amount(source_x, source_y, end_x, end_y)
+        if self.use_arc_fitting:
+            # Hold the move back so that runs of segments can be replaced by arcs once the polyline is complete
+            if len(self.arc_buffer) == 0:
+                self.arc_buffer.append((self.current_x, self.current_y, 0.0))
+            self.arc_buffer.append((end_x, end_y, extrusion_amount))
+            self.current_x = end_x
+            self.current_y = end_y
+            return
+
+        self.current_x = end_x
+        self.current_y = end_y
+
+        current_segment_length = math.sqrt((end_x - source_x) ** 2 + (end_y - source_y) ** 2)
+
+        if self.coasting_distance > 0 and distance_to_next_travel < self.coasting_distance:
+            extrusion_amount = 0
+
+        if self.coasting_distance > 0 and distance_to_next_travel == current_segment_length:
+            # Split the segment into two parts
+            ratio = (current_segment_length - self.coasting_distance) / current_segment_length
+            mid_x = source_x + ratio * (end_x - source_x)
+            mid_y = source_y + ratio * (end_y - source_y)
+
+            # First segment with extrusion
+            if self.current_feedrate != self.desired_extrusion_feedrate:
+                self.current_feedrate = self.desired_extrusion_feedrate
+                self.file.write("G1 X{:.4f} Y{:.4f}{} E{:.6f} F{:.4f}\n".format(
+                    mid_x, mid_y, self.z_word(), extrusion_amount * ratio, self.current_feedrate))
+
+                # Second segment without extrusion
+                self.file.write("G1 X{:.4f} Y{:.4f}{} F{:.4f}; Coast\n".format(
+                    self.current_x, self.current_y, self.z_word(), self.current_feedrate))
+            else:
+                self.file.write("G1 X{:.4f} Y{:.4f}{} E{:.6f}\n".format(
+                    mid_x, mid_y, self.z_word(), extrusion_amount * ratio))
+
+                # Second segment without extrusion
+                self.file.write("G1 X{:.4f} Y{:.4f}{}; Coast\n".format(
+                    self.current_x, self.current_y, self.z_word()))
+        else: # No splitting necessary of this segment
+            if self.current_feedrate != self.desired_extrusion_feedrate:
+                self.current_feedrate = self.desired_extrusion_feedrate
+                self.file.write("G1 X{:.4f} Y{:.4f}{} E{:.6f} F{:.4f}\n".format(
+                    self.current_x, self.current_y, self.z_word(), extrusion_amount, self.current_feedrate))
+            else:
+                self.file.write("G1 X{:.4f} Y{:.4f}{} E{:.6f}\n".format(
+                    self.current_x, self.current_y, self.z_word(), extrusion_amount))
+
+    def flush_arc_buffer(self):
+        if len(self.arc_buffer) < 2:
+            self.arc_buffer = []
+            return
+
+        points = [(x, y) for x, y, e in self.arc_buffer]
+        moves = arc_fitting.fit_arcs(points, self.arc_fitting_tolerance)
+        start = 0
+        for end, arc in moves:
+            # The arc extrudes exactly what the segments it replaces would have
+            extrusion_amount = sum(self.arc_buffer[k][2] for k in range(start + 1, end + 1))
+            feedrate = ""
+            if self.current_feedrate != self.desired_extrusion_feedrate:
+                self.current_feedrate = self.desired_extrusion_feedrate
+                feedrate = " F{:.4f}".format(self.current_feedrate)
+
+            x, y = points[end]
+            if arc is None:
+                self.file.write("G1 X{:.4f} Y{:.4f}{} E{:.6f}{}\n".format(
+                    x, y, self.z_word(), extrusion_amount, feedrate))
+            else:
+                center, clockwise = arc
+                self.file.write("{} X{:.4f} Y{:.4f} I{:.4f} J{:.4f} E{:.6f}{}\n".format(
+                    "G2" if clockwise else "G3", x, y, center[0] - points[start][0], center[1] - points[start][1],
+                    extrusion_amount, feedrate))
+            start = end
+
+        self.arc_input_segments += len(points) - 1
+        self.arc_output_lines += len(moves)
+        self.arc_buffer = []
+
+    def write_comment(self, comment):
+        self.flush_arc_buffer()
+        self.file.write(";{}\n".format(comment))
+
+    def write_mixing_ratios(self, lower, higher):
+        self.flush_arc_buffer()
+        self.current_lower = lower
+        self.current_higher = higher
+
+        if self.mode == "mixture":
+            def mixture_flow_rate_compensation(e0_pct, lower, upper):
+                # Create a linear flow rate modifier based on the mixture ratio. When e0_pct is 0, the flow rate is lower.
+                # When e0_pct is 1, the flow rate is upper.
+                return (e0_pct * (upper - lower) + lower) * 100.0
+
+            self.write_comment("Starting material mixture range: {:.4f} to {:.4f}".format(self.current_lower, self.current_higher))
+            middle_point = (self.current_lower + self.current_higher) / 2.0
+
+            if self.settings["gradient_settings"]["use_max_extents"]:
+                if middle_point < 0.5:
+                    middle_point = 0.0
+                else:
+                    middle_point = 1.0
+
+            # Write the gcode for a mixing ratio change using the M163 command for extruder 0 and 1
+            self.file.write("M163 S0 P{:.4f}\n".format(middle_point))
+            self.file.write("M163 S1 P{:.4f}\n".format(1.0 - middle_point))
+
+            # Save the new mixing ratios using the M164 command
+            self.file.write("M164 S0\n")
+        elif self.mode == "temperature":
+            middle_point = (self.current_lower + self.current_higher) / 2.0
+            if self.settings["gradient_settings"]["use_max_extents"]:
+                if middle_point < 0.5:
+                    middle_point = 0.0
+                else:
+                    middle_point = 1.0
+
+            if self.settings["gradient_settings"]["material"] == "PLA":
+                # Convert mixture to temperature using a linear mapping (205 to 240 degrees)
+                middle_point_temperature = 210 + middle_point * 20
+                # Compute new flow rate modifier based on the temperature (and therefore the foaming expansion)
+                flow_rate = ((0.000008354790481 * (middle_point_temperature ** 3)) - (0.005370745309190 * (middle_point_temperature ** 2)) + (1.133743061069320 * middle_point_temperature) - 77.813511184263700) * 100.0
+            elif self.settings["gradient_settings"]["material"] == "TPU":
+                # Convert mixture to temperature using a linear mapping (190 to 220 degrees)
+                middle_point_temperature = 190 + middle_point * 30
+                # Compute new flow rate modifier based on the temperature (and therefore the foaming expansion)
+                flow_rate = ((0.0003096373 * (middle_point_temperature ** 2)) - (0.1384006081 * middle_point_temperature) + 15.9560113114) * 100.0
+            else:
+                raise ValueError("Material not supported")
+
+            self.write_comment("Starting temperature of {:.4f} as midpoint for range: {:.4f} to {:.4f}".format(
+                middle_point_temperature, self.current_lower, self.current_higher))
+
+            dock_extruder = self.settings["printer_settings"]["dock_extruder"]
+            if dock_extruder:
+                self.write_big_retraction()
+
+                self.file.write("G1 F21000\t ; Setting travel speed\n")
+                self.current_feedrate = 21000
+
+                # Move to back left corner
+                self.file.write("G1 X0 Y{:.4f} Z{:.4f} F21000\t; Move to back left corner\n".format(self.volume_max[1],self.current_z))
+
+                # Park the tool so that the nozzle is sealed
+                self.file.write("P0 S1 L2 D0\t; Park the tool\n")
+
+                # Write the gcode for a temperature change using the M104 command and wait
+                self.file.write("M109 T0 R{:.4f}\t; Set new temp and wait\n".format(middle_point_temperature))
+
+                # Pick the tool back up
+                self.file.write("T0 S1 L0 D0\t; Pick the tool back up and resume\n")
+                self.file.write("G1 X0 Y{:.4f} Z{:.4f} F21000\t; Move to back left corner\n".format(self.volume_max[1], self.current_z))
+            else:
+                # Write the gcode for a temperature change using the M104 command and DO NOT wait
+                self.file.write("M104 T0 S{:.4f}\t; Set new temp and DO NOT wait\n".format(middle_point_temperature))
+
+            # Write the gcode for a flow rate change using the M221 command
+            self.file.write("M221 T0 S{:.4f}\t; Set flow rate to compensate for expansion\n".format(flow_rate))
+        elif self.mode == "switching":
+            # Write the gcode needed to switch the extruder tool
+            if self.num_regions > 5:
+                raise ValueError("Switching mode only supports up to 5 regions. Please use 'mixture' or 'temperature' mode instead.")
+
+            mid_point = (self.current_lower + self.current_higher) / 2.0
+            # Map the mid_point's scale of 0.0 to 1.0 into to the extruder number integer (0 to self.num_regions)
+            extruder_number = int(mid_point * (self.num_regions))
+
+            # Park the current tool so that the nozzle is sealed
+            self.file.write("P0 S1 L2 D0\t; Park the tool\n")
+
+            # Pick the tool back up
+            self.file.write(f"T{extruder_number} S1 L0 D0\t; Pick the new tool\n")
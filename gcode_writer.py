@@ -1,13 +1,64 @@
+import collections
+import concurrent.futures
 import math
-import pyvcad as pv
+import multiprocessing
+import os
+import threading
+import combing
+import gcode_statistics
+import gcode_formatter
+import move_optimizer
+import bgcode
+import compressed_output
 
 
 class GCodeWriter:
-    def __init__(self, filename, settings):
-        # Make a new file for writing
-        self.file = open(filename, "w")
-
+    def __init__(self, filename, settings, allow_format_pool=True):
         self.settings = settings
+        self.statistics_path = os.path.splitext(filename)[0] + ".stats.json"
+
+        # Layers are optionally formatted in a process pool while the next layers are planned. Forked workers do not
+        # re-run the script that started the slicer, but forking is only safe while no other thread runs, so the
+        # workers are all started here, before the output file, the compression thread or the pipeline exist
+        self.format_pool = None
+        self.pending_layers = collections.deque()
+        parallel_settings = settings["slicer_settings"].get("parallel_formatting", {})
+        self.max_pending_layers = parallel_settings.get("max_pending_layers", 16)
+        if parallel_settings.get("use", False) and (not allow_format_pool or threading.active_count() > 1):
+            print("\t-> Formatting {} on the writing thread, a format pool cannot be forked while other threads "
+                  "run".format(filename))
+        elif parallel_settings.get("use", False):
+            self.format_pool = self.start_format_pool(parallel_settings.get("workers", None))
+
+        # Make a new file for writing, either plain text, compressed text or Prusa binary G-code (which is already
+        # compressed, so output_compression does not apply to it)
+        self.output_format = settings["printer_settings"].get("output_format", "gcode")
+        self.bgcode_file = None
+        self.compressed_file = None
+        compression_settings = settings["slicer_settings"].get("output_compression", {})
+        if self.output_format == "bgcode":
+            filename = os.path.splitext(filename)[0] + ".bgcode"
+            self.bgcode_file = self.open_bgcode_file(filename)
+            self.file = self.bgcode_file
+        elif self.output_format == "gcode" and compression_settings.get("use", False):
+            # Compress the text on a background thread while the rest of the layers are written
+            self.compressed_file = compressed_output.CompressedOutputFile(
+                filename, compression_settings.get("format", "gzip"), compression_settings.get("level", 6),
+                compression_settings.get("queue_size", 8))
+            self.file = self.compressed_file
+            filename = self.compressed_file.filename
+        elif self.output_format == "gcode":
+            self.file = open(filename, "w")
+        else:
+            raise ValueError("Unknown output format '{}'. Please use 'gcode' or 'bgcode'".format(self.output_format))
+        self.filename = filename
+
+        # Optionally analyze the G-code while it is being written and save a JSON summary next to it
+        self.statistics = None
+        if settings["slicer_settings"].get("gcode_statistics", False):
+            # The acceleration is updated from any M204 found in the start script
+            self.statistics = gcode_statistics.GCodeStatistics(settings["printer_settings"].get("acceleration", 1000.0))
+            self.file = gcode_statistics.StatisticsFile(self.file, self.statistics)
 
         self.filament_diameter = settings["printer_settings"]["filament_diameter"]
         self.bead_width = settings["printer_settings"]["nozzle_diameter"]
@@ -27,6 +78,19 @@ class GCodeWriter:
         self.coasting_distance = settings["printer_settings"]["coasting_distance"]
         self.lookahead_distance = settings["printer_settings"]["lookahead_distance"]
         self.z_lift_height = settings["printer_settings"].get("z_lift_height", 0.0)
+        # How far the nozzle is raised off a partially printed part before X and Y are homed
+        self.resume_lift = settings["slicer_settings"].get("partial_slicing", {}).get("resume_lift", 5.0)
+
+        # Each layer is planned here, in order, and turned into text by the formatter. Formatting does not depend on
+        # other layers, so it can run in the format pool
+        self.formatter = gcode_formatter.GCodeFormatter(settings)
+        self.use_arc_fitting = self.formatter.use_arc_fitting
+        self.arc_input_segments = 0
+        self.arc_output_lines = 0
+        # Optional peephole pass over the planned moves before they are formatted
+        self.move_optimizer = None
+        if settings["slicer_settings"].get("move_optimization", {}).get("use", False):
+            self.move_optimizer = move_optimizer.MoveOptimizer(settings, self.formatter)
 
         self.layer_height = settings["slicer_settings"]["layer_height"]
         self.flow_rate = settings["material_settings"]["flow_rate"] / 100.0
@@ -62,6 +126,7 @@ class GCodeWriter:
         self.distance_to_next_mixture = -1
         self.next_lower = 0
         self.next_higher = 0
+        self.next_mixture_known = False
 
         self.num_regions = settings["gradient_settings"]["num_regions"]
 
@@ -74,8 +139,61 @@ class GCodeWriter:
         self.current_feedrate = self.desired_extrusion_feedrate
         self.toolchange_inserted = False
         self.already_inserted_mixture_change = False
+        self.skipped_mixture_changes = 0
+        self.resuming = False  # The next layer is the first one written after a resume header
+
+    @staticmethod
+    def start_format_pool(workers):
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        format_pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+        # Workers are otherwise forked at the first submitted layer, when the pipeline threads already run. One task
+        # per worker is submitted at once so that every worker is started now
+        for future in [format_pool.submit(int) for i in range(workers)]:
+            future.result()
+        return format_pool
+
+    def open_bgcode_file(self, filename):
+        bgcode_settings = self.settings["printer_settings"].get("bgcode", {})
+        material_settings = self.settings["material_settings"]
+        slicer_settings = self.settings["slicer_settings"]
+
+        # The firmware checks the printer model of a binary G-code file against the printer it runs on
+        if len(bgcode_settings.get("printer_model", "")) == 0:
+            raise ValueError("Binary G-code output needs printer_settings.bgcode.printer_model, e.g. 'MK4S'")
+
+        # The metadata blocks come before the G-code, so they can only hold what is known before slicing
+        printer_metadata = {
+            "printer_model": bgcode_settings["printer_model"],
+            "filament_type": self.settings["gradient_settings"]["material"],
+            "nozzle_diameter": self.settings["printer_settings"]["nozzle_diameter"],
+            "bed_temperature": material_settings["bed_temperature"],
+            "temperature": material_settings["extruder_temperature"],
+            "layer_height": slicer_settings["layer_height"],
+            "fill_density": "{}%".format(slicer_settings["infill_density"])
+        }
+        print_metadata = {
+            "filament_type": self.settings["gradient_settings"]["material"]
+        }
+        slicer_metadata = {
+            "generator": "VCAD-Slicer",
+            "slicer_mode": slicer_settings["mode"],
+            "gradient_mode": self.settings["gradient_settings"]["mode"],
+            "num_regions": self.settings["gradient_settings"]["num_regions"]
+        }
+        return bgcode.BGCodeFile(filename, printer_metadata, print_metadata, slicer_metadata,
+                                 bgcode_settings.get("compression", "heatshrink_12_4"),
+                                 bgcode_settings.get("meatpack", True),
+                                 bgcode_settings.get("metadata_compression", "deflate"))
+
+    def write_header(self, pmin, pmax, resume=False):
+        if resume:
+            self.write_resume_header()
+            return
 
-    def write_header(self, pmin, pmax):
         file_path = self.start_script
 
         replacement_dict = {
@@ -103,7 +221,46 @@ class GCodeWriter:
             # Write the start gcode to the file
             self.file.write(start_gcode)
 
+    def write_resume_header(self):
+        """ Header for a print that continues on top of a partially printed part. The start script homes Z and probes
+        the bed, which the part is in the way of, so only X and Y are homed and Z is expected to still be known. The
+        nozzle is lifted by a relative move first, so that homing does not drag it across the part. The mixture,
+        temperature or tool of the first range is selected by its first extrusion as usual."""
+        self.file.write(";Resuming a partially printed part\n")
+        self.file.write("M140 S{}\t; set bed temp\n".format(self.bed_temperature))
+        if self.mode == "switching":
+            temperatures = [self.t0_temperature, self.t1_temperature, self.t2_temperature, self.t3_temperature,
+                            self.t4_temperature][:self.num_regions]
+            for tool, temperature in enumerate(temperatures):
+                self.file.write("M104 T{} S{}\t; set extruder temp\n".format(tool, temperature))
+            self.file.write("M190 S{}\t; wait for bed temp\n".format(self.bed_temperature))
+            for tool, temperature in enumerate(temperatures):
+                self.file.write("M109 T{} S{}\t; wait for extruder temp\n".format(tool, temperature))
+        else:
+            self.file.write("M104 S{}\t; set extruder temp\n".format(self.extruder_temperature))
+            self.file.write("M190 S{}\t; wait for bed temp\n".format(self.bed_temperature))
+            self.file.write("M109 S{}\t; wait for extruder temp\n".format(self.extruder_temperature))
+        self.file.write("G91\t; use relative coordinates\n")
+        self.file.write("G1 Z{:.4f} F600\t; lift the nozzle off the part\n".format(self.resume_lift))
+        self.file.write("G90\t; use absolute coordinates\n")
+        self.file.write("M83\t; use relative distances for extrusion\n")
+        self.file.write("G28 X Y\t; home X and Y only, the part is still on the bed\n")
+        self.file.write("G92 E0\t; reset extruder position\n")
+        self.resuming = True
+
     def write_footer(self):
+        if self.format_pool is not None:
+            self.write_finished_layers(0)
+            self.format_pool.shutdown()
+            self.format_pool = None
+        if self.move_optimizer is not None:
+            print("\t-> Move optimizer removed {} lines ({} merged segments, {} zero-length moves, {} folded travels)".format(
+                self.move_optimizer.removed_lines, self.move_optimizer.merged_segments,
+                self.move_optimizer.dropped_moves, self.move_optimizer.folded_travels))
+        if self.use_arc_fitting and self.arc_output_lines > 0:
+            print("\t-> Arc fitting wrote {} extrusion segments as {} moves (compression ratio {:.2f})".format(
+                self.arc_input_segments, self.arc_output_lines, self.arc_input_segments / self.arc_output_lines))
+
         file_path = self.end_script
         # Read the end gcode from the file
         with open(file_path, "r") as end_gcode_file:
@@ -111,195 +268,147 @@ class GCodeWriter:
             # Write the end gcode to the file
             self.file.write(end_gcode)
 
-    def calculate_extrusion_amount(self, segment):
-        """ Calculate the amount of extrusion needed for the segment using the capsule model."""
-        source = segment.source()
-        end = segment.target()
-        segment_length = math.sqrt((end.x() - source.x()) ** 2 + (end.y() - source.y()) ** 2)
-        bead_width = self.bead_width
-        layer_height = self.layer_height
-        filament_diameter = self.filament_diameter
-
-        volume_to_extrude = segment_length * bead_width * layer_height # 2
-        filament_radius = filament_diameter / 2
-        filament_length = volume_to_extrude / (math.pi * filament_radius ** 2)
-
-        return filament_length * self.flow_rate
-
-    def write_retraction(self):
-        self.file.write("G1 E-{:.4f} F{:.4f} ; Retract\n".format(self.retraction_length, self.retraction_speed))
-        self.current_feedrate = self.retraction_speed
-
-    def write_un_retraction(self):
-        self.file.write("G1 E{:.4f} F{:.4f} ; Unretract\n".format(self.un_retraction_length, self.un_retraction_speed))
-        self.current_feedrate = self.un_retraction_speed
-
-    def write_big_retraction(self):
-        self.file.write("G1 E-{:.4f} F{:.4f} ; Big retract\n".format(self.retraction_length * 4, self.retraction_speed))
-        self.current_feedrate = self.retraction_speed
-
-    def write_big_un_retraction(self):
-        self.file.write("G1 E{:.4f} F{:.4f} ; Big unretract\n".format(self.un_retraction_length * 4, self.un_retraction_speed))
-        self.current_feedrate = self.un_retraction_speed
-
-    def write_travel(self, segment):
-        start = segment.source()
-        end = segment.target()
-        self.current_x = end.x()
-        self.current_y = end.y()
-
-        length = math.sqrt((end.x() - start.x()) ** 2 + (end.y() - start.y()) ** 2)
-
-        should_retract = False
-        if length > self.retraction_required_distance and self.use_retraction:
-            should_retract = True
-
-        if should_retract:
-            self.write_retraction()
-
-        # Only perform Z-lift if height is greater than zero and the travel distance is long enough
-        if self.z_lift_height > 0 and length >= self.retraction_required_distance:
-            # Step 1: Lift the nozzle
-            lifted_z = self.current_z + self.z_lift_height
-            self.file.write("G1 Z{:.4f} F{:.4f}; Z-lift\n".format(lifted_z, self.travel_speed))
-
-            # Step 2: Perform XY travel move with lifted Z
-            self.file.write("G1 X{:.4f} Y{:.4f} F{:.4f}; Travel XY\n".format(
-                self.current_x, self.current_y, self.travel_speed))
-            self.current_feedrate = self.travel_speed
-
-            # Step 3: Lower back to printing height
-            self.file.write("G1 Z{:.4f} F{:.4f}; Z-lower\n".format(self.current_z, self.travel_speed))
-        else:
-            # Just perform XY travel without changing Z
-            self.file.write("G1 X{:.4f} Y{:.4f} F{:.4f}; Travel XY\n".format(
-                self.current_x, self.current_y, self.travel_speed))
-            self.current_feedrate = self.travel_speed
-
-        if should_retract:
-            self.write_un_retraction()
-
-    def write_extrusion_line(self, segment, distance_to_next_travel):
-        end = segment.target()
-        self.current_x = end.x()
-        self.current_y = end.y()
-
-        current_segment_length = math.sqrt((end.x() - segment.source().x()) ** 2 + (end.y() - segment.source().y()) ** 2)
-        # extrusion_amount = self.calculate_extrusion_amount(segment)
-        # if self.current_feedrate != self.desired_extrusion_feedrate:
-        #     self.current_feedrate = self.desired_extrusion_feedrate
-        #     self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} E{:.6f} F{:.4f}\n".format(
-        #         self.current_x, self.current_y, self.current_z, extrusion_amount, self.current_feedrate))
-        # else:
-        #     self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} E{:.6f}\n".format(
-        #         self.current_x, self.current_y, self.current_z, extrusion_amount))
-
-        if self.coasting_distance > 0 and distance_to_next_travel < self.coasting_distance:
-            extrusion_amount = 0
-        else:
-            extrusion_amount = self.calculate_extrusion_amount(segment)
-
-        if self.coasting_distance > 0 and distance_to_next_travel == current_segment_length:
-            # Split the segment into two parts
-            ratio = (current_segment_length - self.coasting_distance) / current_segment_length
-            mid_x = segment.source().x() + ratio * (segment.target().x() - segment.source().x())
-            mid_y = segment.source().y() + ratio * (segment.target().y() - segment.source().y())
-
-            # First segment with extrusion
-            if self.current_feedrate != self.desired_extrusion_feedrate:
-                self.current_feedrate = self.desired_extrusion_feedrate
-                self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} E{:.6f} F{:.4f}\n".format(
-                    mid_x, mid_y, self.current_z, extrusion_amount * ratio, self.current_feedrate))
-
-                # Second segment without extrusion
-                self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} F{:.4f}; Coast\n".format(
-                    self.current_x, self.current_y, self.current_z, self.current_feedrate))
-            else:
-                self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} E{:.6f}\n".format(
-                    mid_x, mid_y, self.current_z, extrusion_amount * ratio))
-
-                # Second segment without extrusion
-                self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f}; Coast\n".format(
-                    self.current_x, self.current_y, self.current_z))
-        else: # No splitting necessary of this segment
-            if self.current_feedrate != self.desired_extrusion_feedrate:
-                self.current_feedrate = self.desired_extrusion_feedrate
-                self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} E{:.6f} F{:.4f}\n".format(
-                    self.current_x, self.current_y, self.current_z, extrusion_amount, self.current_feedrate))
-            else:
-                self.file.write("G1 X{:.4f} Y{:.4f} Z{:.4f} E{:.6f}\n".format(
-                    self.current_x, self.current_y, self.current_z, extrusion_amount))
-
-    def compute_distance_to_next_mixture(self, segments, paths):
+        if self.statistics is not None:
+            summary = self.statistics.write_summary(self.statistics_path)
+            print("\t-> Estimated print time: {:.1f} minutes, statistics written to {}".format(
+                summary["estimated_print_time_s"] / 60.0, self.statistics_path))
+
+        self.file.close()
+        if self.compressed_file is not None:
+            report = self.compressed_file.report()
+            print("\t-> Compressed {} bytes of G-code to {} bytes with {} ({:.2f}x, {:.1f} MB/s)".format(
+                report["raw_size"], report["compressed_size"], report["compression"], report["ratio"],
+                report["compression_throughput_mb_s"]))
+        if self.bgcode_file is not None:
+            print("\t-> Binary G-code is {} bytes, {:.2f}x smaller than the {} bytes of text".format(
+                self.bgcode_file.written_size, self.bgcode_file.raw_size / max(self.bgcode_file.written_size, 1),
+                self.bgcode_file.raw_size))
+
+    def feedrate_after(self, op, feedrate):
+        # The feedrate the formatter is left with after writing a planned move
+        if op[0] == "extrude":
+            return self.desired_extrusion_feedrate
+        elif op[0] == "comb":
+            return self.travel_speed
+        elif op[0] == "travel":
+            # Long travels end with an un-retraction, which leaves its feedrate behind
+            length = math.sqrt((op[3] - op[1]) ** 2 + (op[4] - op[2]) ** 2)
+            if length > self.retraction_required_distance and self.use_retraction:
+                return self.un_retraction_speed
+            return self.travel_speed
+        elif op[0] == "big_un_retract":
+            return self.un_retraction_speed
+        elif op[0] == "mixture" and self.mode == "temperature" and self.settings["printer_settings"]["dock_extruder"]:
+            return 21000
+        return feedrate
+
+    def plan_travel(self, ops, start_x, start_y, end_x, end_y, combed=False):
+        # Combed travels stay inside the part and are never retracted
+        ops.append(("comb" if combed else "travel", start_x, start_y, end_x, end_y))
+        self.current_x = end_x
+        self.current_y = end_y
+        self.current_feedrate = self.feedrate_after(ops[-1], self.current_feedrate)
+
+    def compute_distance_to_next_mixture(self, segments, paths, layers=1):
+        # Distances are extrusion lengths, combined infill counts once per layer it is printed for since it pushes that
+        # much more material through the mixer
         if self.distance_to_next_mixture == -1: # Must compute a new
-            total_length = sum(math.sqrt((segment.target().x() - segment.source().x()) ** 2 +
-                                         (segment.target().y() - segment.source().y()) ** 2)
-                               for segment in segments)
+            total_length = layers * sum(math.sqrt((segment.target().x() - segment.source().x()) ** 2 +
+                                                  (segment.target().y() - segment.source().y()) ** 2)
+                                        for segment in segments)
 
-            for lower, higher, is_extrusion, polyline in paths:
+            for lower, higher, is_extrusion, polyline, path_layers in paths:
                 if is_extrusion:
                     if lower != self.current_lower:  # This is a new mixture
                         self.distance_to_next_mixture = total_length
+                        self.next_mixture_known = True
                         self.next_lower = lower
                         self.next_higher = higher
                         return total_length, lower, higher
-                    total_length += sum(math.sqrt((segment.target().x() - segment.source().x()) ** 2 +
-                                                  (segment.target().y() - segment.source().y()) ** 2)
-                                        for segment in polyline.segments())
-            # If we have not returned yet, there are no more mixtures
-            self.distance_to_next_mixture = total_length
-            return total_length, self.current_lower, self.current_higher
+                    total_length += path_layers * sum(math.sqrt((segment.target().x() - segment.source().x()) ** 2 +
+                                                                (segment.target().y() - segment.source().y()) ** 2)
+                                                      for segment in polyline.segments())
+            # If we have not returned yet, there are no more mixtures in the paths we were given. When layers are
+            # written while later ones are still being sliced, more paths may be known by the time we get within the
+            # lookahead distance of the end of these, so check again at that point
+            self.distance_to_next_mixture = max(total_length - self.lookahead_distance, 0)
+            self.next_lower = self.current_lower
+            self.next_higher = self.current_higher
+            self.next_mixture_known = False
+            return float('inf'), self.current_lower, self.current_higher
 
         else: # Return the previously computed distance minus this segment's length
-            this_segment_length = math.sqrt((segments[0].target().x() - segments[0].source().x()) ** 2 +
-                                            (segments[0].target().y() - segments[0].source().y()) ** 2)
+            this_segment_length = layers * math.sqrt((segments[0].target().x() - segments[0].source().x()) ** 2 +
+                                                     (segments[0].target().y() - segments[0].source().y()) ** 2)
             new_distance = self.distance_to_next_mixture - this_segment_length
             self.distance_to_next_mixture = new_distance
+            if not self.next_mixture_known:
+                return float('inf'), self.next_lower, self.next_higher
             return new_distance, self.next_lower, self.next_higher
 
     def write_layer(self, layer, future_layers):
+        # Hand the previous layer's text to the compression thread
+        if self.compressed_file is not None:
+            self.compressed_file.submit_buffer()
+
+        plan = self.plan_layer(layer, future_layers)
+        if self.move_optimizer is not None:
+            self.move_optimizer.optimize(plan)
+            # Folded travels can change whether the layer ends on a retraction, so follow the optimized moves
+            self.current_feedrate = plan["feedrate"]
+            for op in plan["ops"]:
+                self.current_feedrate = self.feedrate_after(op, self.current_feedrate)
+
+        if self.format_pool is None:
+            self.write_formatted_layer(self.formatter.format_layer(plan))
+        else:
+            self.pending_layers.append(self.format_pool.submit(self.formatter.format_layer, plan))
+            self.write_finished_layers(self.max_pending_layers)
+
+    def write_formatted_layer(self, formatted):
+        text, arc_input_segments, arc_output_lines = formatted
+        self.file.write(text)
+        self.arc_input_segments += arc_input_segments
+        self.arc_output_lines += arc_output_lines
+
+    def write_finished_layers(self, max_pending):
+        # Write formatted layers in order, waiting for the oldest one while too many are outstanding
+        while len(self.pending_layers) > 0 and (self.pending_layers[0].done() or
+                                                len(self.pending_layers) > max_pending):
+            self.write_formatted_layer(self.pending_layers.popleft().result())
+
+    def plan_layer(self, layer, future_layers):
+        """ Resolves everything in a layer that depends on the state left behind by the previous ones: mixture change
+        points, tool change travels, coasting distances and the starting position and feedrate. The result holds
+        plain numbers only and is turned into text by GCodeFormatter.format_layer."""
         self.current_layer_number += 1
+        if self.resuming:
+            # Continue the numbering of the full slice, so that speeds and fan settings match it
+            self.current_layer_number = layer.get_layer_num()
         self.current_z = layer.get_z_height()
 
         future_layer_paths = []
         for future_layer in future_layers:
             future_layer_paths.extend(future_layer.get_paths())
 
-        # Write the z change
-        self.write_comment("|===== Layer {} =====|".format(self.current_layer_number))
-        self.write_comment("LAYER_CHANGE")
-        self.write_comment("HEIGHT: {:.4f}".format(self.current_z))
-
-        # Set the fan speed based on the layer number
-        if self.current_layer_number == 1:
-            self.file.write("M107 ; Turn fan off for first layer\n")
-        elif self.current_layer_number == 2:
-            self.file.write("M106 S80\n")
-        elif self.current_layer_number == 3:
-            self.file.write("M106 S160\n")
-        elif self.current_layer_number == 4:
-            self.file.write("M106 S230\n")
-        else:
-            self.file.write("M106 S255\n")
-
         # Set feedrate settings based on the layer number
         if self.current_layer_number == 1:
             self.desired_extrusion_feedrate = self.settings["printer_settings"]["speeds"]["first_layer_extrusion"]
         else:
             self.desired_extrusion_feedrate = self.settings["printer_settings"]["speeds"]["other_layer_extrusion"]
 
-        # If this was the first layer, do initial un-retraction
-        if self.current_layer_number == 1:
-            self.file.write("G1 E1.2 F2400\t ;Initial un-retract\n")
-
-        # if self.use_retraction:
-        #     self.write_retraction()
-
-        # Go to new z height
-        self.file.write("G1 Z{:.4f}\n".format(self.current_z))
-
-        # if self.use_retraction:
-        #     self.write_un_retraction()
+        ops = []
+        plan = {
+            "layer_number": self.current_layer_number,
+            "z": self.current_z,
+            "x": self.current_x,
+            "y": self.current_y,
+            "feedrate": self.current_feedrate,
+            "desired_feedrate": self.desired_extrusion_feedrate,
+            "resume": self.resuming,
+            "ops": ops
+        }
+        self.resuming = False
 
         def distance_to_next_travel(segments, paths):
             total_length = 0
@@ -307,7 +416,7 @@ class GCodeWriter:
                 total_length += math.sqrt((segment.target().x() - segment.source().x()) ** 2 + (
                         segment.target().y() - segment.source().y()) ** 2)
 
-            for lower, higher, is_extrusion, polyline in paths:
+            for lower, higher, is_extrusion, polyline, layers in paths:
                 if not is_extrusion:
                     return total_length
                 for segment in polyline.segments():
@@ -318,13 +427,16 @@ class GCodeWriter:
         added_first_mixture = False
         range_index = 0
         paths = layer.get_paths()
-        for lower, higher, is_extrusion, polyline in paths:
+        for lower, higher, is_extrusion, polyline, layers in paths:
             segments = polyline.segments()
             index = 0
-            for segment in polyline.segments():
+            for segment in segments:
+                source = segment.source()
+                target = segment.target()
                 if is_extrusion:
-                    if self.current_layer_number == 1 and not added_first_mixture:
-                        self.write_mixing_ratios((lower, higher))
+                    # The first layer written selects its mixture up front, as nothing has been selected before it
+                    if (self.current_layer_number == 1 or plan["resume"]) and not added_first_mixture:
+                        self.plan_mixing_ratios(ops, (lower, higher))
                         added_first_mixture = True
 
                     if self.distance_to_next_mixture <= 0:
@@ -338,126 +450,59 @@ class GCodeWriter:
 
                         mixture_distance, new_lower, new_higher = self.compute_distance_to_next_mixture(
                             segments[index:],
-                            all_future_paths)
+                            all_future_paths, layers)
                         if mixture_distance < self.lookahead_distance and self.already_inserted_mixture_change == False:
-                            self.write_mixing_ratios((new_lower, new_higher))
+                            self.plan_mixing_ratios(ops, (new_lower, new_higher))
                             self.already_inserted_mixture_change = True
                     elif (self.lookahead_distance <= 0 and
                          self.do_mixing_ratios_diff((lower, higher))):
-                            self.write_mixing_ratios((lower, higher))
+                            self.plan_mixing_ratios(ops, (lower, higher))
 
                     if self.toolchange_inserted:
                         # Add a travel back to the segment
-                        new_travel = pv.Segment2(pv.Point2(self.current_x, self.current_y), segment.source())
-                        self.write_travel(new_travel)
-                        self.write_big_un_retraction()
+                        self.plan_travel(ops, self.current_x, self.current_y, source.x(), source.y())
+                        ops.append(("big_un_retract",))
+                        self.current_feedrate = self.feedrate_after(ops[-1], self.current_feedrate)
                         self.toolchange_inserted = False
 
                     if self.coasting_distance > 0:
                         distance = distance_to_next_travel(segments[index:], paths[range_index+1:])
                     else:
                         distance = 0
-                    self.write_extrusion_line(segment, distance)
+                    if layers == 1:
+                        ops.append(("extrude", source.x(), source.y(), target.x(), target.y(), distance))
+                    else:
+                        # Combined infill is printed for several layers at once
+                        amount = self.formatter.calculate_extrusion_amount(source.x(), source.y(), target.x(),
+                                                                          target.y(), layers)
+                        ops.append(("extrude", source.x(), source.y(), target.x(), target.y(), distance, amount))
+                    self.current_x = target.x()
+                    self.current_y = target.y()
+                    self.current_feedrate = self.feedrate_after(ops[-1], self.current_feedrate)
                 else:
-                    self.write_travel(segment)
+                    self.plan_travel(ops, source.x(), source.y(), target.x(), target.y(),
+                                     lower == combing.COMBED_TRAVEL)
                 index += 1
             range_index += 1
-
-    def write_comment(self, comment):
-        self.file.write(";{}\n".format(comment))
+        return plan
 
     def do_mixing_ratios_diff(self, new_ranges):
         if new_ranges[0] != self.current_lower or new_ranges[1] != self.current_higher:
             return True
         return False
 
-    def write_mixing_ratios(self, new_range):
+    def plan_mixing_ratios(self, ops, new_range):
         assert new_range[0] != 0.0 or new_range[1] != 1.0
+        # Changing to the mixture that is already loaded would only cost a park/pick or a temperature wait
+        if not self.do_mixing_ratios_diff(new_range):
+            self.skipped_mixture_changes += 1
+            return
         self.current_lower = new_range[0]
         self.current_higher = new_range[1]
+        ops.append(("mixture", self.current_lower, self.current_higher))
+        self.current_feedrate = self.feedrate_after(ops[-1], self.current_feedrate)
 
-        if self.mode == "mixture":
-            def mixture_flow_rate_compensation(e0_pct, lower, upper):
-                # Create a linear flow rate modifier based on the mixture ratio. When e0_pct is 0, the flow rate is lower.
-                # When e0_pct is 1, the flow rate is upper.
-                return (e0_pct * (upper - lower) + lower) * 100.0
-
-            self.write_comment("Starting material mixture range: {:.4f} to {:.4f}".format(self.current_lower, self.current_higher))
-            middle_point = (self.current_lower + self.current_higher) / 2.0
-
-            if self.settings["gradient_settings"]["use_max_extents"]:
-                if middle_point < 0.5:
-                    middle_point = 0.0
-                else:
-                    middle_point = 1.0
-
-            # Write the gcode for a mixing ratio change using the M163 command for extruder 0 and 1
-            self.file.write("M163 S0 P{:.4f}\n".format(middle_point))
-            self.file.write("M163 S1 P{:.4f}\n".format(1.0 - middle_point))
-
-            # Save the new mixing ratios using the M164 command
-            self.file.write("M164 S0\n")
-        elif self.mode == "temperature":
-            middle_point = (self.current_lower + self.current_higher) / 2.0
-            if self.settings["gradient_settings"]["use_max_extents"]:
-                if middle_point < 0.5:
-                    middle_point = 0.0
-                else:
-                    middle_point = 1.0
-
-            if self.settings["gradient_settings"]["material"] == "PLA":
-                # Convert mixture to temperature using a linear mapping (205 to 240 degrees)
-                middle_point_temperature = 210 + middle_point * 20
-                # Compute new flow rate modifier based on the temperature (and therefore the foaming expansion)
-                flow_rate = ((0.000008354790481 * (middle_point_temperature ** 3)) - (0.005370745309190 * (middle_point_temperature ** 2)) + (1.133743061069320 * middle_point_temperature) - 77.813511184263700) * 100.0
-            elif self.settings["gradient_settings"]["material"] == "TPU":
-                # Convert mixture to temperature using a linear mapping (190 to 220 degrees)
-                middle_point_temperature = 190 + middle_point * 30
-                # Compute new flow rate modifier based on the temperature (and therefore the foaming expansion)
-                flow_rate = ((0.0003096373 * (middle_point_temperature ** 2)) - (0.1384006081 * middle_point_temperature) + 15.9560113114) * 100.0
-            else:
-                raise ValueError("Material not supported")
-
-            self.write_comment("Starting temperature of {:.4f} as midpoint for range: {:.4f} to {:.4f}".format(
-                middle_point_temperature, self.current_lower, self.current_higher))
-
-            dock_extruder = self.settings["printer_settings"]["dock_extruder"]
-            if dock_extruder:
-                self.write_big_retraction()
-
-                self.file.write("G1 F21000\t ; Setting travel speed\n")
-                self.current_feedrate = 21000
-
-                # Move to back left corner
-                self.file.write("G1 X0 Y{:.4f} Z{:.4f} F21000\t; Move to back left corner\n".format(self.volume_max[1],self.current_z))
-
-                # Park the tool so that the nozzle is sealed
-                self.file.write("P0 S1 L2 D0\t; Park the tool\n")
-
-                # Write the gcode for a temperature change using the M104 command and wait
-                self.file.write("M109 T0 R{:.4f}\t; Set new temp and wait\n".format(middle_point_temperature))
-
-                # Pick the tool back up
-                self.file.write("T0 S1 L0 D0\t; Pick the tool back up and resume\n")
-                self.file.write("G1 X0 Y{:.4f} Z{:.4f} F21000\t; Move to back left corner\n".format(self.volume_max[1], self.current_z))
-                self.toolchange_inserted = True
-            else:
-                # Write the gcode for a temperature change using the M104 command and DO NOT wait
-                self.file.write("M104 T0 S{:.4f}\t; Set new temp and DO NOT wait\n".format(middle_point_temperature))
-
-            # Write the gcode for a flow rate change using the M221 command
-            self.file.write("M221 T0 S{:.4f}\t; Set flow rate to compensate for expansion\n".format(flow_rate))
-        elif self.mode == "switching":
-            # Write the gcode needed to switch the extruder tool
-            if self.num_regions > 5:
-                raise ValueError("Switching mode only supports up to 5 regions. Please use 'mixture' or 'temperature' mode instead.")
-
-            mid_point = (self.current_lower + self.current_higher) / 2.0
-            # Map the mid_point's scale of 0.0 to 1.0 into to the extruder number integer (0 to self.num_regions)
-            extruder_number = int(mid_point * (self.num_regions))
-
-            # Park the current tool so that the nozzle is sealed
-            self.file.write("P0 S1 L2 D0\t; Park the tool\n")
-
-            # Pick the tool back up
-            self.file.write(f"T{extruder_number} S1 L0 D0\t; Pick the new tool\n")
+        # Docking the extruder for a temperature change moves away from the part, so the next extrusion has to
+        # travel back to where it left off
+        if self.mode == "temperature" and self.settings["printer_settings"]["dock_extruder"]:
+            self.toolchange_inserted = True
@@ -1,4 +1,5 @@
 import pyvcad as pv
+import combing
 
 
 def get_global_bounding_box(outlines):
@@ -29,3 +30,61 @@ def generate_rectilinear_infill(outlines, spacing):
     result = pv.Polygon2.Clip(outlines, infill_lines)[1]
 
     return result
+
+
+def link_rectilinear_infill(lines, boundaries, max_link_length):
+    """ Joins the segments of neighbouring scanlines into continuous zigzag polylines. The end of a segment is linked
+    to the closest end of a segment on the next scanline when the link is at most max_link_length long and stays
+    inside every boundary (lists of polygons), so the link runs along the edge of the infill area."""
+    grids = [combing.EdgeGrid(combing.polygon_rings(polygons)) for polygons in boundaries]
+
+    # Group the segments by scanline, from bottom to top and left to right
+    scanlines = {}
+    for line in lines:
+        points = line.points()
+        if len(points) < 2:
+            continue
+        start = (points[0].x(), points[0].y())
+        end = (points[-1].x(), points[-1].y())
+        if start[0] > end[0]:
+            start, end = end, start
+        scanlines.setdefault(round(start[1], 6), []).append([start, end, False])
+    keys = sorted(scanlines.keys())
+    for key in keys:
+        scanlines[key].sort()
+
+    def link_inside(a, b):
+        for grid in grids:
+            if not grid.segment_inside(a, b, 1e-3):
+                return False
+        return True
+
+    result = []
+    for k in range(len(keys)):
+        for segment in scanlines[keys[k]]:
+            if segment[2]:
+                continue
+            segment[2] = True
+            chain = [segment[0], segment[1]]
+            scanline = k + 1
+            while scanline < len(keys):
+                # Closest free end on the next scanline that can be linked to
+                end = chain[-1]
+                best = None
+                best_distance = max_link_length
+                for candidate in scanlines[keys[scanline]]:
+                    if candidate[2]:
+                        continue
+                    for near, far in ((candidate[0], candidate[1]), (candidate[1], candidate[0])):
+                        distance = ((near[0] - end[0]) ** 2 + (near[1] - end[1]) ** 2) ** 0.5
+                        if distance <= best_distance and link_inside(end, near):
+                            best = (candidate, near, far)
+                            best_distance = distance
+                if best is None:
+                    break
+                best[0][2] = True
+                chain.append(best[1])
+                chain.append(best[2])
+                scanline += 1
+            result.append(pv.Polyline2([pv.Point2(x, y) for x, y in chain]))
+    return result
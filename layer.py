@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import pyvcad as pv
 import infill
+import simplification
 import visualization as vis
 
 
@@ -14,12 +15,30 @@ class Layer:
 
         self.walls = []
         self.infill = []
+        self.infill_outline = []
+        self.infill_spacing = 0
+        # Sparse infill combined over several layers is printed once, infill_thickness layers high
+        self.combined_infill = []
+        self.infill_thickness = 1
+
+        # Layer cache fingerprint and the material ranges it was computed from, if the cache is used
+        self.fingerprint = None
+        self.material_ranges = None
 
         self.ranged_walls = []
         self.ranged_infill = []
+        self.ranged_combined_infill = []
+
+        # Ranges that contain walls or infill on this layer, computed during cutting
+        self.occupied_ranges = []
+        self.skipped_ranges = 0
 
         self.connected_paths = []
 
+        # Route optimizer statistics
+        self.travel_saved = 0.0
+        self.retractions_avoided = 0
+
         self.purge_tower_walls = 100
         self.purge_tower_centers = purge_tower_centers
         self.purge_tower_x_size = purge_tower_x_size
@@ -48,7 +67,9 @@ class Layer:
         for i in range(1, number):
             self.walls.append(pv.Polygon2.Offset(outline, -self.bead_width * i))
 
-    def generate_infill(self, density_percentage):
+    def generate_infill(self, density_percentage, region=None, thickness=1):
+        # Fills the region (all of the layer if None) at the given density. A layer can be filled at several
+        # densities, one region at a time
         infill_spacing = self.bead_width / density_percentage
 
         outline = None
@@ -60,12 +81,23 @@ class Layer:
         # Generate the infill outline as the outline offset by the bead width
         infill_outline = pv.Polygon2.Offset(outline, -self.bead_width)
 
-        self.infill = infill.generate_rectilinear_infill(infill_outline, infill_spacing)
+        lines = infill.generate_rectilinear_infill(infill_outline, infill_spacing)
+        if region is not None:
+            lines = pv.Polygon2.Clip(region, lines)[1]
+        if thickness > 1:
+            self.combined_infill.extend(lines)
+            self.infill_thickness = thickness
+        else:
+            self.infill.extend(lines)
+        self.infill_outline = infill_outline
+        self.infill_spacing = max(self.infill_spacing, infill_spacing)
 
-    def generate_purge_tower(self, start_pt, desired_range):
+    def generate_purge_tower(self, start_pt, desired_range, extrusion_range=None, purge_planner=None):
+        # Returns the printed extrusion length and the length of the full tower. With a purge planner only the rings
+        # it sizes the tower to are printed, from the outside in
         # If the purge tower size is zero, skip this step
         if self.purge_tower_x_size == 0 or self.purge_tower_y_size == 0:
-            return
+            return 0.0, 0.0
 
         # Get the center of the purge tower for this range
         center = None
@@ -74,6 +106,10 @@ class Layer:
                 center = c
                 break
 
+        # Print the tower with the range's own material unless another one was requested
+        if extrusion_range is None:
+            extrusion_range = desired_range
+
         # Create a box around the center
         half_size_x = self.purge_tower_x_size / 2.0
         half_size_y = self.purge_tower_y_size / 2.0
@@ -87,29 +123,36 @@ class Layer:
         for i in range(0, self.purge_tower_walls):
             walls.append(pv.Polygon2.Offset([box], -self.bead_width * i))
 
-        polylines = []
+        rings = []
         for wall in walls:
             if len(wall) == 0:
                 continue
+            rings.append(wall[0].to_polyline())
+        full_length = sum(polyline.length() for polyline in rings)
+        # The tower is stacked, so every layer prints the same rings and none is printed over air
+        if purge_planner is not None:
+            rings = rings[:purge_planner.tower_rings(desired_range, [polyline.length() for polyline in rings])]
 
-            polyline = wall[0].to_polyline()
+        polylines = []
+        total_length = 0
+        for polyline in rings:
             # Add travel from the start point to the first point
             travel = pv.Polyline2([start_pt, polyline.points()[0]])
-            polylines.append((0, 0, False, travel))
-            polylines.append((desired_range[0], desired_range[1], True, polyline))
+            polylines.append((0, 0, False, travel, 1))
+            polylines.append((extrusion_range[0], extrusion_range[1], True, polyline, 1))
             start_pt = polyline.points()[-1]
-
-        # Calculate total length of purge tower extrusion
-        total_length = 0
-        for lower, higher, is_extrusion, polyline in polylines:
-            if is_extrusion:
-                total_length += polyline.length()
+            total_length += polyline.length()
         # print("Purge tower extrusion length: {:.4f}".format(total_length))
 
         self.connected_paths.extend(polylines)
+        return total_length, full_length
 
-    def cut_into_ranges(self, desired_ranges, slicer, reverse):
-        ranges = slicer.slice_material(self.z_height, 1, desired_ranges)
+    def cut_into_ranges(self, desired_ranges, slicer, reverse, infill_link_ratio=0):
+        # The material ranges may already have been sampled for the layer cache
+        if self.material_ranges is not None:
+            ranges = list(self.material_ranges)
+        else:
+            ranges = slicer.slice_material(self.z_height, 1, desired_ranges)
 
         if reverse:
             ranges.reverse()
@@ -122,17 +165,31 @@ class Layer:
 
         for lower, higher, polygons in ranges:
             resulting_walls = []
-            resulting_infill_lines = []
             clipped_walls = pv.Polygon2.Clip(polygons, concatenated_walls)[1]
             for polyline in clipped_walls:
                 resulting_walls.append(polyline)
 
-            clipped_infill = pv.Polygon2.Clip(polygons, self.infill)[1]
-            for polyline in clipped_infill:
-                resulting_infill_lines.append(polyline)
-
             self.ranged_walls.append((lower, higher, resulting_walls))
-            self.ranged_infill.append((lower, higher, resulting_infill_lines))
+            self.ranged_infill.append((lower, higher, self.clip_infill(polygons, self.infill, infill_link_ratio)))
+            self.ranged_combined_infill.append((lower, higher, self.clip_infill(polygons, self.combined_infill,
+                                                                                infill_link_ratio)))
+
+        self.update_range_occupancy()
+
+    def clip_infill(self, polygons, lines, infill_link_ratio=0):
+        if len(lines) == 0:
+            return []
+        resulting_infill_lines = []
+        clipped_infill = pv.Polygon2.Clip(polygons, lines)[1]
+        for polyline in clipped_infill:
+            resulting_infill_lines.append(polyline)
+
+        # Join the scanlines of this range into zigzags that stay inside both the infill area and the range
+        if infill_link_ratio > 0 and len(resulting_infill_lines) > 1:
+            resulting_infill_lines = infill.link_rectilinear_infill(resulting_infill_lines,
+                                                                    [self.infill_outline, polygons],
+                                                                    infill_link_ratio * self.infill_spacing)
+        return resulting_infill_lines
 
     @staticmethod
     def find_and_stitch_wall(paths, new_polyline):
@@ -180,17 +237,13 @@ class Layer:
 
         for lower, higher, polygons in ranges:
             resulting_walls = []
-            resulting_infill_lines = []
             clipped_walls = pv.Polygon2.Clip(polygons, concatenated_walls)[1]
             for polyline in clipped_walls:
                 resulting_walls.append(polyline)
 
-            clipped_infill = pv.Polygon2.Clip(polygons, self.infill)[1]
-            for polyline in clipped_infill:
-                resulting_infill_lines.append(polyline)
-
             self.ranged_walls.append((lower, higher, resulting_walls))
-            self.ranged_infill.append((lower, higher, resulting_infill_lines))
+            self.ranged_infill.append((lower, higher, self.clip_infill(polygons, self.infill)))
+            self.ranged_combined_infill.append((lower, higher, self.clip_infill(polygons, self.combined_infill)))
 
         for i in range(1, len(self.ranged_walls) - 1, 2):
             left_walls = self.ranged_walls[i - 1][2]
@@ -219,10 +272,23 @@ class Layer:
             self.ranged_walls[i] = (reset_lower, reset_higher, self.ranged_walls[i][2])
 
         # Do the same for the infill
-        for i in range(1, len(self.ranged_infill) - 1, 2):
-            left_infill = self.ranged_infill[i - 1][2]
-            overlap_infill = self.ranged_infill[i][2]
-            right_infill = self.ranged_infill[i + 1][2]
+        self.ranged_infill = self.merge_overlap_infill(self.ranged_infill, desired_ranges)
+        self.ranged_combined_infill = self.merge_overlap_infill(self.ranged_combined_infill, desired_ranges)
+
+        # Reverse the order of the ranges
+        if reverse:
+            self.ranged_walls.reverse()
+            self.ranged_infill.reverse()
+            self.ranged_combined_infill.reverse()
+
+        self.update_range_occupancy()
+
+    @staticmethod
+    def merge_overlap_infill(ranged_infill, desired_ranges):
+        for i in range(1, len(ranged_infill) - 1, 2):
+            left_infill = ranged_infill[i - 1][2]
+            overlap_infill = ranged_infill[i][2]
+            right_infill = ranged_infill[i + 1][2]
 
             infill_index = 0
             last_avg = 0
@@ -236,64 +302,95 @@ class Layer:
                     coin_flip = not coin_flip
                     last_avg = average_y
                 if coin_flip:
-                    if not self.find_and_stitch_wall(left_infill, polyline):
+                    if not Layer.find_and_stitch_wall(left_infill, polyline):
                         left_infill.append(polyline)
                 else:
-                    if not self.find_and_stitch_wall(right_infill, polyline):
+                    if not Layer.find_and_stitch_wall(right_infill, polyline):
                         right_infill.append(polyline)
                 infill_index += 1
 
         # Remove the overlap infill
-        self.ranged_infill = [self.ranged_infill[i] for i in range(0, len(self.ranged_infill), 2)]
+        ranged_infill = [ranged_infill[i] for i in range(0, len(ranged_infill), 2)]
 
-        for i in range(0, len(self.ranged_infill)):
+        for i in range(0, len(ranged_infill)):
             reset_lower = desired_ranges[i][0]
             reset_higher = desired_ranges[i][1]
-            self.ranged_infill[i] = (reset_lower, reset_higher, self.ranged_infill[i][2])
-
-        # Reverse the order of the ranges
-        if reverse:
-            self.ranged_walls.reverse()
-            self.ranged_infill.reverse()
+            ranged_infill[i] = (reset_lower, reset_higher, ranged_infill[i][2])
+        return ranged_infill
 
     # Static method to compute the distance between two points
     @staticmethod
     def distance(p1, p2):
         return ((p1.x() - p2.x()) ** 2 + (p1.y() - p2.y()) ** 2) ** 0.5
 
-    def connect_paths_in_range(self, start_point, desired_range):
-        available_paths = []
+    def connect_paths_in_range(self, start_point, desired_range, path_optimizer=None, purge_planner=None):
+        wall_paths = []
         for lower, higher, walls in self.ranged_walls:
             if lower < desired_range[0] or higher > desired_range[1]:
                 continue
             for wall in walls:
-                available_paths.append((lower, higher, True, wall))  # True indicates that this is an extrusion path
-        for lower, higher, infill in self.ranged_infill:
-            if lower < desired_range[0] or higher > desired_range[1]:
-                continue
-            for line in infill:
-                available_paths.append((lower, higher, True, line))  # True indicates that this is an extrusion path
+                wall_paths.append((lower, higher, True, wall, 1))  # True indicates that this is an extrusion path
+        # The last field is the number of layers a path is printed for, so that the writer extrudes the matching amount
+        infill_paths = []
+        for ranged_infill, layers in [(self.ranged_infill, 1), (self.ranged_combined_infill, self.infill_thickness)]:
+            for lower, higher, infill in ranged_infill:
+                if lower < desired_range[0] or higher > desired_range[1]:
+                    continue
+                for line in infill:
+                    infill_paths.append((lower, higher, True, line, layers))
+
+        if purge_planner is not None:
+            self.connect_purged_range(start_point, desired_range, wall_paths, infill_paths, path_optimizer,
+                                      purge_planner)
+            return
 
+        available_paths = wall_paths + infill_paths
         if len(available_paths) == 0:
             return
 
         if self.layer_num % 2 == 0:
             available_paths.reverse()
 
+        ordered_paths = self.order_paths(start_point, available_paths, path_optimizer)
+        self.append_ordered_paths(start_point, ordered_paths)
+
+    def connect_purged_range(self, start_point, desired_range, wall_paths, infill_paths, path_optimizer,
+                             purge_planner):
+        # The infill of the new range is printed first so that it absorbs the material flushed after the change,
+        # whatever it cannot take goes into the purge tower before the walls are printed
+        purge_volume = purge_planner.start_range(desired_range)
+
+        infill_length = 0
+        if len(infill_paths) > 0:
+            if self.layer_num % 2 == 0:
+                infill_paths.reverse()
+            ordered_infill = self.order_paths(start_point, infill_paths, path_optimizer)
+            self.append_ordered_paths(start_point, ordered_infill)
+            start_point = self.connected_paths[-1][3].points()[-1]
+            for lower, higher, is_extrusion, line, layers in ordered_infill:
+                infill_length += line.length() * layers
+
+        infill_volume = min(purge_planner.length_to_volume(infill_length), purge_volume)
+        tower_length, full_length = self.generate_purge_tower(start_point, desired_range, None, purge_planner)
+        purge_planner.record(purge_volume, infill_volume, tower_length, full_length)
+        if len(self.connected_paths) > 0:
+            start_point = self.connected_paths[-1][3].points()[-1]
+
+        if len(wall_paths) > 0:
+            if self.layer_num % 2 == 0:
+                wall_paths.reverse()
+            self.append_ordered_paths(start_point, self.order_paths(start_point, wall_paths, path_optimizer))
+
+    def order_paths(self, start_point, available_paths, path_optimizer=None):
         current_path = available_paths[0]
         available_paths.remove(current_path)
+        ordered_paths = [current_path]
 
-        # Add a travel move to the first path
-        travel = pv.Polyline2([start_point, current_path[3].points()[0]])
-        self.connected_paths.append((0, 0, False, travel))
-        self.connected_paths.append(current_path)
-
-        # Connect the paths by adding travel moves
-        # This is done by finding the closest path to the current path and adding a travel move to it.
+        # Order the paths by finding the closest path to the current path.
         # We need to check the start point and end point of each polyline. If the end is closer we need to
         # reverse the polyline
-        # Once the nearest path is found, we add a travel move to it and remove it from the available paths
-        # This process is repeated until all paths are connected
+        # Once the nearest path is found, we add it to the ordered paths and remove it from the available paths
+        # This process is repeated until all paths are ordered
         while len(available_paths) > 0:
             current_end = current_path[3].points()[-1]
             min_distance = float('inf')
@@ -315,36 +412,116 @@ class Layer:
             if needs_reversal:
                 nearest_path[3].reverse()
 
-            # Add travel segment if the min distance is non-zero
-            if min_distance > 0.05:
-                travel = pv.Polyline2([current_end, nearest_path[3].points()[0]])
-                self.connected_paths.append((0, 0, False, travel))  # False indicates that this is a travel move
-            self.connected_paths.append(nearest_path)
+            ordered_paths.append(nearest_path)
             available_paths.remove(nearest_path)
             current_path = nearest_path
 
-    def connect_paths(self):
+        # Optionally refine the greedy order to remove backtracking travels
+        if path_optimizer is not None:
+            ordered_paths, travel_saved, retractions_avoided = path_optimizer.optimize(start_point, ordered_paths)
+            self.travel_saved += travel_saved
+            self.retractions_avoided += retractions_avoided
+        return ordered_paths
+
+    def append_ordered_paths(self, start_point, ordered_paths):
+        # Add a travel move to the first path
+        travel = pv.Polyline2([start_point, ordered_paths[0][3].points()[0]])
+        self.connected_paths.append((0, 0, False, travel, 1))
+        self.connected_paths.append(ordered_paths[0])
+
+        # Connect the ordered paths by adding travel moves between them
+        for previous_path, next_path in zip(ordered_paths, ordered_paths[1:]):
+            previous_end = previous_path[3].points()[-1]
+            next_start = next_path[3].points()[0]
+
+            # Add travel segment if the distance is non-zero
+            if Layer.distance(previous_end, next_start) > 0.05:
+                travel = pv.Polyline2([previous_end, next_start])
+                self.connected_paths.append((0, 0, False, travel, 1))  # False indicates that this is a travel move
+            self.connected_paths.append(next_path)
+
+    def update_range_occupancy(self):
+        # Record, in cut order, the ranges that contain at least one path on this layer
+        self.occupied_ranges = []
+        for (lower, higher, walls), (_, _, infill), (_, _, combined_infill) in zip(
+                self.ranged_walls, self.ranged_infill, self.ranged_combined_infill):
+            if len(walls) > 0 or len(infill) > 0 or len(combined_infill) > 0:
+                self.occupied_ranges.append((lower, higher))
+
+    def get_occupied_ranges(self):
+        return self.occupied_ranges
+
+    def visited_ranges(self, range_order=None):
+        # The occupied ranges in the order they are connected: the scheduled order if one was provided, otherwise the
+        # order they were cut in
+        if len(self.ranged_walls) == 0 and len(self.ranged_infill) == 0:
+            return []
+        if range_order is None:
+            range_order = [(lower, higher) for lower, higher, walls in self.ranged_walls]
+        return [r for r in range_order if r in self.occupied_ranges]
+
+    def purge_infill_length(self, desired_range):
+        # Extrusion length of the infill that is printed first after a change to the range, and absorbs its purge
+        infill_length = 0.0
+        for ranged_infill, layers in [(self.ranged_infill, 1), (self.ranged_combined_infill, self.infill_thickness)]:
+            for lower, higher, infill in ranged_infill:
+                if lower < desired_range[0] or higher > desired_range[1]:
+                    continue
+                infill_length += sum(line.length() for line in infill) * layers
+        return infill_length
+
+    def connect_paths(self, path_optimizer=None, range_order=None, support_towers=None, purge_planner=None):
         # If the layer is empty, return
         if len(self.ranged_walls) == 0 and len(self.ranged_infill) == 0:
             return
 
-        ranges = []
-        for lower, higher, walls in self.ranged_walls:
-            ranges.append((lower, higher))
+        # Ranges with nothing to print on this layer get neither a purge tower nor a mixture change
+        self.skipped_ranges = len(self.ranged_walls) - len(self.occupied_ranges)
 
         previous_end = pv.Point2(0,0)  # Start at the origin
-        for lower, higher in ranges:
-            self.generate_purge_tower(previous_end, (lower, higher))
+        current_range = None
+        for lower, higher in self.visited_ranges(range_order):
+            # With a purge planner the tower is sized and placed while the range is connected
+            if purge_planner is None:
+                self.generate_purge_tower(previous_end, (lower, higher))
 
-            self.connect_paths_in_range(previous_end, (lower, higher))
+            self.connect_paths_in_range(previous_end, (lower, higher), path_optimizer, purge_planner)
             if len(self.connected_paths) > 0:
                 previous_end = self.connected_paths[-1][3].points()[-1]
+            current_range = (lower, higher)
+
+        # Towers of empty ranges that are still needed on later layers keep growing, but are printed with the
+        # current material so that they do not cost a mixture change
+        if support_towers is None:
+            return
+        for lower, higher in support_towers:
+            if (lower, higher) in self.occupied_ranges:
+                continue
+            if purge_planner is None:
+                self.generate_purge_tower(previous_end, (lower, higher), current_range)
+            else:
+                tower_length, full_length = self.generate_purge_tower(previous_end, (lower, higher), current_range,
+                                                                      purge_planner)
+                purge_planner.record(0.0, 0.0, tower_length, full_length)
+            if len(self.connected_paths) > 0:
+                previous_end = self.connected_paths[-1][3].points()[-1]
+
+    def simplify_paths(self, tolerance):
+        # Drop near-collinear vertices from the connected extrusion paths, returns the vertex counts before and after
+        self.connected_paths, before, after = simplification.simplify_labeled_paths(self.connected_paths, tolerance)
+        return before, after
+
+    def comb_travels(self, combing_planner):
+        # Route long travels inside the outline so that they do not need a retraction, returns the number of combed
+        # travels and the number of long travels
+        self.connected_paths, combed, total = combing_planner.comb_paths(self.outline, self.connected_paths)
+        return combed, total
 
     def get_bounds(self):
         min = [float('inf'), float('inf')]
         max = [-float('inf'), -float('inf')]
         # Iterate over all of the paths to find the min and max x and y values
-        for lower, higher, is_extrusion, polyline in self.connected_paths:
+        for lower, higher, is_extrusion, polyline, layers in self.connected_paths:
             for point in polyline.points():
                 if point.x() < min[0]:
                     min[0] = point.x()
@@ -358,7 +535,7 @@ class Layer:
         return min, max
 
     def translate_paths(self, xy_translation, z_translation):
-        for lower, higher, is_extrusion, polyline in self.connected_paths:
+        for lower, higher, is_extrusion, polyline, layers in self.connected_paths:
             polyline.translate(xy_translation)
         self.z_height += z_translation
 
@@ -367,7 +544,7 @@ class Layer:
         polyline = []
         for wall in self.walls:
             polygons.extend(wall)
-        for line in self.infill:
+        for line in self.infill + self.combined_infill:
             polyline.append(line)
         vis.plot_polygons_and_polylines(polygons, polyline, figsize=(20, 12))
 
@@ -380,7 +557,7 @@ class Layer:
 
             for wall in walls:
                 lines.append((wall, (lower + higher) / 2.0))
-        for lower, higher, infill in self.ranged_infill:
+        for lower, higher, infill in self.ranged_infill + self.ranged_combined_infill:
             # Skip any lower, higher ranges that are not in the desired ranges
             if ranges is not None and (lower, higher) not in ranges:
                 continue
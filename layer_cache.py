@@ -0,0 +1,107 @@
+import collections
+import hashlib
+import pyvcad as pv
+
+
+def polyline_points(polyline):
+    return [(p.x(), p.y()) for p in polyline.points()]
+
+
+def make_polyline(points):
+    return pv.Polyline2([pv.Point2(x, y) for x, y in points])
+
+
+class LayerCache:
+    """ Reuses the toolpaths of layers that are geometrically identical to an earlier one. A layer's fingerprint
+    hashes its quantized outline, the quantized polygons of its material ranges, its parity (cutting and ordering
+    alternate direction on every other layer) and its infill densities and regions. Layers whose fingerprint has a
+    stored cut copy its ranged walls and infill instead of generating and cutting their own, and also copy the stored
+    connected paths when they are connected with the same range order and support towers. Only the z height of the
+    layer differs. Both are kept for the max_entries most recently used fingerprints. Entries are kept as plain
+    coordinates so that later changes to a layer's paths (centering, reversal during ordering) never leak into the
+    cache."""
+
+    def __init__(self, settings):
+        cache_settings = settings["slicer_settings"].get("layer_cache", {})
+        self.quantum = cache_settings.get("quantum", 0.0001)
+        # Only the most recently used cuts and connected paths are kept
+        self.max_entries = cache_settings.get("max_entries", 64)
+
+        self.cuts = collections.OrderedDict()
+        self.paths = collections.OrderedDict()
+
+        self.cut_hits = 0
+        self.path_hits = 0
+        self.misses = 0
+
+    def quantize_polygons(self, polygons):
+        rings = []
+        for polygon in polygons:
+            for ring in [polygon] + list(polygon.holes()):
+                rings.append(tuple((round(p.x() / self.quantum), round(p.y() / self.quantum)) for p in ring))
+        return tuple(rings)
+
+    def fingerprint(self, outlines, material_ranges, parity, fills):
+        data = (self.quantize_polygons(outlines),
+                tuple((lower, higher, self.quantize_polygons(polygons)) for lower, higher, polygons in material_ranges),
+                parity,
+                tuple((density, None if region is None else self.quantize_polygons(region), layers)
+                      for density, region, layers in fills))
+        return hashlib.sha1(repr(data).encode()).hexdigest()
+
+    @staticmethod
+    def remember(entries, key, value, max_entries):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > max_entries:
+            entries.popitem(last=False)
+
+    def has_cut(self, fingerprint):
+        return fingerprint in self.cuts
+
+    def store_cut(self, layer):
+        walls = [(lower, higher, [polyline_points(p) for p in paths]) for lower, higher, paths in layer.ranged_walls]
+        infill = [(lower, higher, [polyline_points(p) for p in paths]) for lower, higher, paths in layer.ranged_infill]
+        combined_infill = [(lower, higher, [polyline_points(p) for p in paths])
+                           for lower, higher, paths in layer.ranged_combined_infill]
+        self.remember(self.cuts, layer.fingerprint, (walls, infill, combined_infill, layer.infill_thickness),
+                      self.max_entries)
+        self.misses += 1
+
+    def restore_cut(self, layer):
+        walls, infill, combined_infill, thickness = self.cuts[layer.fingerprint]
+        self.cuts.move_to_end(layer.fingerprint)
+        layer.ranged_walls = [(lower, higher, [make_polyline(p) for p in paths]) for lower, higher, paths in walls]
+        layer.ranged_infill = [(lower, higher, [make_polyline(p) for p in paths]) for lower, higher, paths in infill]
+        layer.ranged_combined_infill = [(lower, higher, [make_polyline(p) for p in paths])
+                                        for lower, higher, paths in combined_infill]
+        layer.infill_thickness = thickness
+        layer.update_range_occupancy()
+        self.cut_hits += 1
+
+    @staticmethod
+    def paths_key(layer, range_order, support_towers):
+        return (layer.fingerprint,
+                None if range_order is None else tuple(range_order),
+                None if support_towers is None else tuple(support_towers))
+
+    def store_paths(self, layer, key):
+        paths = [(lower, higher, is_extrusion, polyline_points(polyline), layers)
+                 for lower, higher, is_extrusion, polyline, layers in layer.connected_paths]
+        self.remember(self.paths, key, (paths, layer.skipped_ranges), self.max_entries)
+
+    def restore_paths(self, layer, key):
+        """ Copies the connected paths stored under the key into the layer, returns False if there are none."""
+        if key not in self.paths:
+            return False
+        paths, skipped_ranges = self.paths[key]
+        self.paths.move_to_end(key)
+        layer.connected_paths = [(lower, higher, is_extrusion, make_polyline(points), layers)
+                                 for lower, higher, is_extrusion, points, layers in paths]
+        layer.skipped_ranges = skipped_ranges
+        self.path_hits += 1
+        return True
+
+    def report(self):
+        print("\t-> Layer cache reused {} cut layers ({} fully connected) and computed {} layers".format(
+            self.cut_hits, self.path_hits, self.misses))
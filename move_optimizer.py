@@ -0,0 +1,113 @@
+import math
+
+
+class MoveOptimizer:
+    """ Peephole optimizer over the moves of a planned layer (see GCodeWriter.plan_layer). It removes zero-length
+    moves, folds back-to-back travels into one (which also drops the retract/un-retract pair between them) and merges
+    runs of collinear extrusion segments into a single move that extrudes their combined amount. The formatter drops
+    the unchanged Z and feedrate words from the remaining moves."""
+
+    def __init__(self, settings, formatter):
+        optimizer_settings = settings["slicer_settings"].get("move_optimization", {})
+        self.collinear_tolerance = optimizer_settings.get("collinear_tolerance", 0.001)
+        self.max_merged_segments = optimizer_settings.get("max_merged_segments", 100)
+        # Moves shorter than half of the output resolution do not change the written position
+        self.min_length = optimizer_settings.get("min_length", 0.00005)
+        self.formatter = formatter
+
+        self.use_retraction = settings["printer_settings"]["retraction"]["use"]
+        self.retraction_required_distance = settings["printer_settings"]["retraction"]["required_distance"]
+        self.z_lift_height = settings["printer_settings"].get("z_lift_height", 0.0)
+        # Coasting works on the distance to the next travel of every single segment, so those are not merged
+        self.merge_extrusions = settings["printer_settings"]["coasting_distance"] == 0
+
+        self.merged_segments = 0
+        self.dropped_moves = 0
+        self.folded_travels = 0
+        self.removed_lines = 0
+
+    def travel_lines(self, op):
+        # Number of lines the formatter writes for a travel, combed travels are never retracted or lifted
+        if op[0] == "comb":
+            return 1
+        length = math.sqrt((op[3] - op[1]) ** 2 + (op[4] - op[2]) ** 2)
+        lines = 1
+        if length > self.retraction_required_distance and self.use_retraction:
+            lines += 2
+        if self.z_lift_height > 0 and length >= self.retraction_required_distance:
+            lines += 2
+        return lines
+
+    def is_collinear(self, points):
+        # All points must lie within the tolerance of the chord and move forward along it
+        sx, sy = points[0]
+        ex, ey = points[-1]
+        dx = ex - sx
+        dy = ey - sy
+        length = math.sqrt(dx * dx + dy * dy)
+        if length == 0:
+            return False
+        previous = 0.0
+        for px, py in points[1:]:
+            if abs((px - sx) * dy - (py - sy) * dx) / length > self.collinear_tolerance:
+                return False
+            along = (px - sx) * dx + (py - sy) * dy
+            if along <= previous:
+                return False
+            previous = along
+        return True
+
+    def extrusion_amount(self, op):
+        if len(op) > 6:
+            return op[6]
+        return self.formatter.calculate_extrusion_amount(op[1], op[2], op[3], op[4])
+
+    def optimize(self, plan):
+        """ Optimizes the moves of a plan in place and returns the number of lines removed."""
+        result = []
+        run_points = []  # Points of the extrusion run that ends the result so far
+        removed_lines = 0
+        for op in plan["ops"]:
+            if op[0] == "extrude" or op[0] == "travel" or op[0] == "comb":
+                if math.sqrt((op[3] - op[1]) ** 2 + (op[4] - op[2]) ** 2) < self.min_length:
+                    self.dropped_moves += 1
+                    removed_lines += 1 if op[0] == "extrude" else self.travel_lines(op)
+                    continue
+
+            previous = result[-1] if len(result) > 0 else None
+            if op[0] == "travel" and previous is not None and previous[0] == "travel" and \
+                    previous[3] == op[1] and previous[4] == op[2]:
+                folded = ("travel", previous[1], previous[2], op[3], op[4])
+                removed_lines += self.travel_lines(previous) + self.travel_lines(op)
+                result.pop()
+                self.folded_travels += 1
+                if math.sqrt((folded[3] - folded[1]) ** 2 + (folded[4] - folded[2]) ** 2) < self.min_length:
+                    # The travels went out and came back to the same spot
+                    self.dropped_moves += 1
+                else:
+                    removed_lines -= self.travel_lines(folded)
+                    result.append(folded)
+                run_points = []
+                continue
+
+            if op[0] == "extrude" and self.merge_extrusions and previous is not None and previous[0] == "extrude" \
+                    and previous[3] == op[1] and previous[4] == op[2] and len(run_points) <= self.max_merged_segments:
+                points = run_points + [(op[3], op[4])]
+                if self.is_collinear(points):
+                    merged = ("extrude", previous[1], previous[2], op[3], op[4], previous[5],
+                              self.extrusion_amount(previous) + self.extrusion_amount(op))
+                    result[-1] = merged
+                    run_points = points
+                    self.merged_segments += 1
+                    removed_lines += 1
+                    continue
+
+            result.append(op)
+            if op[0] == "extrude":
+                run_points = [(op[1], op[2]), (op[3], op[4])]
+            else:
+                run_points = []
+
+        plan["ops"] = result
+        self.removed_lines += removed_lines
+        return removed_lines
@@ -0,0 +1,167 @@
+import copy
+import json
+import queue
+import threading
+import pyvcad as pv
+import pipeline
+
+# Gradient settings that only change how the writer prints a range, the rest changes the toolpaths themselves
+GRADIENT_WRITER_KEYS = ["mode", "material", "use_max_extents"]
+
+
+def target_settings(settings, target):
+    """ Returns the settings of one output target: the shared settings with the printer and material settings of the
+    target's profile (a settings file) and any sections given inline, and the writer-only gradient settings."""
+    merged = copy.deepcopy(settings)
+    profile = {}
+    if "settings_path" in target:
+        with open(target["settings_path"], "r") as profile_file:
+            profile = json.load(profile_file)
+
+    for source in [profile, target]:
+        for section in ["printer_settings", "material_settings"]:
+            if section in source:
+                merged[section].update(copy.deepcopy(source[section]))
+        for key in GRADIENT_WRITER_KEYS:
+            if key in source.get("gradient_settings", {}):
+                merged["gradient_settings"][key] = source["gradient_settings"][key]
+
+    # The extrusion amounts follow from the bead width, so the shared toolpaths need the same nozzle
+    if merged["printer_settings"]["nozzle_diameter"] != settings["printer_settings"]["nozzle_diameter"]:
+        raise ValueError("Output target {} has a different nozzle diameter than the slice".format(
+            target.get("name", "")))
+    return merged
+
+
+def bed_translation(settings):
+    # Same centering as the slicers, on the bed of the given printer
+    printer_min = settings["printer_settings"]["dimensions"]["min"]
+    printer_max = settings["printer_settings"]["dimensions"]["max"]
+    xy_translation = pv.Point2((printer_max[0] - printer_min[0]) / 2, (printer_max[1] - printer_min[1]) / 2)
+    user_translate = settings["object_settings"]["translation"]
+    if user_translate is not None:
+        xy_translation = pv.Point2(xy_translation.x() + user_translate[0], xy_translation.y() + user_translate[1])
+    return xy_translation
+
+
+def check_bed_bounds(settings, bounds_min, bounds_max, filename):
+    # The slice is centered on every bed on its own, so a part that fits one printer may not fit a smaller one
+    printer_min = settings["printer_settings"]["dimensions"]["min"]
+    printer_max = settings["printer_settings"]["dimensions"]["max"]
+    if bounds_min[0] < printer_min[0] - 1e-6 or bounds_min[1] < printer_min[1] - 1e-6 or \
+            bounds_max[0] > printer_max[0] + 1e-6 or bounds_max[1] > printer_max[1] + 1e-6:
+        raise ValueError("The part and its purge towers span ({:.2f}, {:.2f}) to ({:.2f}, {:.2f}), which does not fit "
+                         "on the bed of the printer of {}".format(bounds_min[0], bounds_min[1], bounds_max[0],
+                                                                   bounds_max[1], filename))
+
+
+class TranslatedLayer:
+    """ A sliced layer as one printer sees it, moved onto that printer's bed. The sliced layer is shared by every
+    target and never changed, its paths are copied the first time they are asked for."""
+
+    def __init__(self, layer, xy_translation, z_translation):
+        self.layer = layer
+        self.xy_translation = xy_translation
+        self.z_translation = z_translation
+        self.paths = None
+
+    def get_z_height(self):
+        return self.layer.get_z_height() + self.z_translation
+
+    def get_layer_num(self):
+        return self.layer.get_layer_num()
+
+    def get_paths(self):
+        if self.paths is None:
+            dx = self.xy_translation.x()
+            dy = self.xy_translation.y()
+            self.paths = [(lower, higher, is_extrusion,
+                           pv.Polyline2([pv.Point2(p.x() + dx, p.y() + dy) for p in polyline.points()]), layers)
+                          for lower, higher, is_extrusion, polyline, layers in self.layer.get_paths()]
+        return self.paths
+
+    def write_layer(self, gcode_writer, future_layers):
+        gcode_writer.write_layer(self, future_layers)
+
+
+def slice_and_write_targets(part_slicer, ranges, targets, queue_size=8, z_start=None, z_end=None, resume=True):
+    """ Slices the part once and writes it for several printers at the same time. targets holds (settings,
+    gcode_writer) pairs. Every layer is handed, uncentered, to one queue per target, and each target centers it on
+    its own bed and writes it on its own thread the way slice_and_write does, so the slowest writer sets the pace
+    instead of the sum of them. Every target is checked to fit its bed before anything is sliced. The writers must not
+    use a parallel formatting pool, which would be forked from the writer threads."""
+    part_slicer.set_z_window(z_start, z_end, resume)
+    part_slicer.prepare_layers(ranges)
+    slice_xy, slice_z = part_slicer.get_translation()
+    pmin, pmax = part_slicer.estimate_bounds()
+    translations = [bed_translation(settings) for settings, gcode_writer in targets]
+    target_bounds = []
+    for (settings, gcode_writer), xy_translation in zip(targets, translations):
+        if gcode_writer.format_pool is not None:
+            raise ValueError("Parallel formatting cannot be combined with several output targets")
+        dx = xy_translation.x() - slice_xy.x()
+        dy = xy_translation.y() - slice_xy.y()
+        bounds_min = [pmin[0] + dx, pmin[1] + dy]
+        bounds_max = [pmax[0] + dx, pmax[1] + dy]
+        check_bed_bounds(settings, bounds_min, bounds_max, gcode_writer.filename)
+        target_bounds.append((bounds_min, bounds_max))
+
+    target_queues = [queue.Queue(maxsize=queue_size) for target in targets]
+    failed = [False for target in targets]
+    distributed = threading.Event()
+    done = object()
+
+    def distribute():
+        try:
+            for l in part_slicer.process_layers(ranges, translate=False):
+                z_translation = part_slicer.get_translation()[1]
+                for i, xy_translation in enumerate(translations):
+                    if not failed[i]:
+                        target_queues[i].put(TranslatedLayer(l, xy_translation, z_translation))
+            for target_queue in target_queues:
+                target_queue.put(done)
+        except Exception as e:
+            for target_queue in target_queues:
+                target_queue.put(e)
+        distributed.set()
+
+    def target_layers(target_queue):
+        while True:
+            item = target_queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    errors = []
+
+    def write_target(i, gcode_writer):
+        bounds_min, bounds_max = target_bounds[i]
+        try:
+            pipeline.write_pipelined(target_layers(target_queues[i]), gcode_writer, bounds_min, bounds_max,
+                                     gcode_writer.lookahead_distance, queue_size, part_slicer.resume)
+        except Exception as e:
+            errors.append(e)
+            # Stop receiving layers and empty the queue, so that a failed target does not hold up the others
+            failed[i] = True
+            while not distributed.is_set():
+                try:
+                    target_queues[i].get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    writer_threads = []
+    for i, (settings, gcode_writer) in enumerate(targets):
+        writer_thread = threading.Thread(target=write_target, args=(i, gcode_writer), daemon=True)
+        writer_thread.start()
+        writer_threads.append(writer_thread)
+    distribute()
+    for writer_thread in writer_threads:
+        writer_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+    for settings, gcode_writer in targets:
+        print("\t-> Skipped {} redundant mixture changes in {}".format(gcode_writer.skipped_mixture_changes,
+                                                                      gcode_writer.filename))
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import pyvcad as pv
 import infill
+import simplification
 import visualization as vis
 
 
@@ -15,8 +16,16 @@ class OutlineLayer:
 
         self.ranged_walls = []
 
+        # Ranges that contain walls on this layer, computed during cutting
+        self.occupied_ranges = []
+        self.skipped_ranges = 0
+
         self.connected_paths = []
 
+        # Route optimizer statistics
+        self.travel_saved = 0.0
+        self.retractions_avoided = 0
+
         self.layer_num = layer_num
 
         self.fill_with_infill = fill_with_infill
@@ -44,7 +53,7 @@ class OutlineLayer:
     def write_layer(self, gcode_writer, future_layers):
         gcode_writer.write_layer(self, future_layers)
 
-    def generate_walls(self, desired_ranges, slicer, reverse):
+    def generate_walls(self, desired_ranges, slicer, reverse, simplify_tolerance=0, infill_link_ratio=0):
         # Iterate over the desired ranges switch any value that is zero to -1 and value that is 1 to 2
         # This is a workaround
         copied_ranges = desired_ranges.copy()
@@ -71,6 +80,10 @@ class OutlineLayer:
             ranges.reverse()
 
         for lower, higher, polygons in ranges:
+            # Remove voxel staircase vertices from the sampled range outlines before offsetting them
+            if simplify_tolerance > 0:
+                polygons = simplification.simplify_polygons(polygons, simplify_tolerance)[0]
+
             paths = []
             for poly in polygons:
                 # Offset polygon by half the bead width inwards
@@ -89,6 +102,9 @@ class OutlineLayer:
                         # Offset polygon by half the bead width inwards
                         inset_polygon = polygon.offset(-self.bead_width / 2.0)
                         new_infill =  infill.generate_rectilinear_infill(inset_polygon, self.bead_width)
+                        if infill_link_ratio > 0 and len(new_infill) > 1:
+                            new_infill = infill.link_rectilinear_infill(new_infill, [inset_polygon],
+                                                                        infill_link_ratio * self.bead_width)
                         paths.extend(new_infill)
                     else:
                         for i in range(num_wall_to_try):
@@ -110,10 +126,14 @@ class OutlineLayer:
                                 break
             self.ranged_walls.append((lower, higher, paths))
 
-    def generate_purge_tower(self, start_pt, desired_range):
+        self.update_range_occupancy()
+
+    def generate_purge_tower(self, start_pt, desired_range, extrusion_range=None, purge_planner=None):
+        # Returns the printed extrusion length and the length of the full tower. With a purge planner only the rings
+        # it sizes the tower to are printed, from the outside in
         # If the purge tower size is zero, skip this step
         if self.purge_tower_x_size == 0 or self.purge_tower_y_size == 0:
-            return
+            return 0.0, 0.0
 
         # Get the center of the purge tower for this range
         center = None
@@ -122,6 +142,10 @@ class OutlineLayer:
                 center = c
                 break
 
+        # Print the tower with the range's own material unless another one was requested
+        if extrusion_range is None:
+            extrusion_range = desired_range
+
         # Create a box around the center
         half_size_x = self.purge_tower_x_size / 2.0
         half_size_y = self.purge_tower_y_size / 2.0
@@ -135,57 +159,55 @@ class OutlineLayer:
         for i in range(0, self.purge_tower_walls):
             walls.append(pv.Polygon2.Offset([box], -self.bead_width * i))
 
-        polylines = []
+        rings = []
         for wall in walls:
             if len(wall) == 0:
                 continue
+            rings.append(wall[0].to_polyline())
+        full_length = sum(polyline.length() for polyline in rings)
+        # The tower is stacked, so every layer prints the same rings and none is printed over air
+        if purge_planner is not None:
+            rings = rings[:purge_planner.tower_rings(desired_range, [polyline.length() for polyline in rings])]
 
-            polyline = wall[0].to_polyline()
+        polylines = []
+        total_length = 0
+        for polyline in rings:
             # Add travel from the start point to the first point
             travel = pv.Polyline2([start_pt, polyline.points()[0]])
-            polylines.append((0, 0, False, travel))
-            polylines.append((desired_range[0], desired_range[1], True, polyline))
+            polylines.append((0, 0, False, travel, 1))
+            polylines.append((extrusion_range[0], extrusion_range[1], True, polyline, 1))
             start_pt = polyline.points()[-1]
-
-        # Calculate total length of purge tower extrusion
-        total_length = 0
-        for lower, higher, is_extrusion, polyline in polylines:
-            if is_extrusion:
-                total_length += polyline.length()
+            total_length += polyline.length()
         # print("Purge tower extrusion length: {:.4f}".format(total_length))
 
         self.connected_paths.extend(polylines)
+        return total_length, full_length
 
     # Static method to compute the distance between two points
     @staticmethod
     def distance(p1, p2):
         return ((p1.x() - p2.x()) ** 2 + (p1.y() - p2.y()) ** 2) ** 0.5
 
-    def connect_paths_in_range(self, start_point, desired_range):
+    def connect_paths_in_range(self, start_point, desired_range, path_optimizer=None):
         available_paths = []
         for lower, higher, walls in self.ranged_walls:
             if lower < desired_range[0] or higher > desired_range[1]:
                 continue
             for wall in walls:
-                available_paths.append((lower, higher, True, wall))  # True indicates that this is an extrusion path
+                available_paths.append((lower, higher, True, wall, 1))  # True indicates that this is an extrusion path
 
         if len(available_paths) == 0:
             return
 
         current_path = available_paths[0]
         available_paths.remove(current_path)
+        ordered_paths = [current_path]
 
-        # Add a travel move to the first path
-        travel = pv.Polyline2([start_point, current_path[3].points()[0]])
-        self.connected_paths.append((0, 0, False, travel))
-        self.connected_paths.append(current_path)
-
-        # Connect the paths by adding travel moves
-        # This is done by finding the closest path to the current path and adding a travel move to it.
+        # Order the paths by finding the closest path to the current path.
         # We need to check the start point and end point of each polyline. If the end is closer we need to
         # reverse the polyline
-        # Once the nearest path is found, we add a travel move to it and remove it from the available paths
-        # This process is repeated until all paths are connected
+        # Once the nearest path is found, we add it to the ordered paths and remove it from the available paths
+        # This process is repeated until all paths are ordered
         while len(available_paths) > 0:
             current_end = current_path[3].points()[-1]
             min_distance = float('inf')
@@ -207,37 +229,114 @@ class OutlineLayer:
             if needs_reversal:
                 nearest_path[3].reverse()
 
-            # Add travel segment if the min distance is non-zero
-            if min_distance > 0.05:
-                travel = pv.Polyline2([current_end, nearest_path[3].points()[0]])
-                self.connected_paths.append((0, 0, False, travel))  # False indicates that this is a travel move
-            self.connected_paths.append(nearest_path)
+            ordered_paths.append(nearest_path)
             available_paths.remove(nearest_path)
             current_path = nearest_path
 
-    def connect_paths(self):
+        # Optionally refine the greedy order to remove backtracking travels
+        if path_optimizer is not None:
+            ordered_paths, travel_saved, retractions_avoided = path_optimizer.optimize(start_point, ordered_paths)
+            self.travel_saved += travel_saved
+            self.retractions_avoided += retractions_avoided
+
+        # Add a travel move to the first path
+        travel = pv.Polyline2([start_point, ordered_paths[0][3].points()[0]])
+        self.connected_paths.append((0, 0, False, travel, 1))
+        self.connected_paths.append(ordered_paths[0])
+
+        # Connect the ordered paths by adding travel moves between them
+        for previous_path, next_path in zip(ordered_paths, ordered_paths[1:]):
+            previous_end = previous_path[3].points()[-1]
+            next_start = next_path[3].points()[0]
+
+            # Add travel segment if the distance is non-zero
+            if OutlineLayer.distance(previous_end, next_start) > 0.05:
+                travel = pv.Polyline2([previous_end, next_start])
+                self.connected_paths.append((0, 0, False, travel, 1))  # False indicates that this is a travel move
+            self.connected_paths.append(next_path)
+
+    def update_range_occupancy(self):
+        # Record, in cut order, the ranges that contain at least one path on this layer
+        self.occupied_ranges = []
+        for lower, higher, walls in self.ranged_walls:
+            if len(walls) > 0:
+                self.occupied_ranges.append((lower, higher))
+
+    def get_occupied_ranges(self):
+        return self.occupied_ranges
+
+    def visited_ranges(self, range_order=None):
+        # The occupied ranges in the order they are connected: the scheduled order if one was provided, otherwise the
+        # order they were cut in
+        if len(self.ranged_walls) == 0:
+            return []
+        if range_order is None:
+            range_order = [(lower, higher) for lower, higher, walls in self.ranged_walls]
+        return [r for r in range_order if r in self.occupied_ranges]
+
+    def purge_infill_length(self, desired_range):
+        # Infill is part of the walls here, so none of the purge is absorbed before the tower
+        return 0.0
+
+    def connect_paths(self, path_optimizer=None, range_order=None, support_towers=None, purge_planner=None):
         # If the layer is empty, return
         if len(self.ranged_walls) == 0:
             return
 
-        ranges = []
-        for lower, higher, walls in self.ranged_walls:
-            ranges.append((lower, higher))
+        # Ranges with nothing to print on this layer get neither a purge tower nor a mixture change
+        self.skipped_ranges = len(self.ranged_walls) - len(self.occupied_ranges)
 
         previous_end = pv.Point2(-8, 10)  # Start at the origin
-        for lower, higher in ranges:
-            if self.use_purge_tower:
+        current_range = None
+        for lower, higher in self.visited_ranges(range_order):
+            if self.use_purge_tower and purge_planner is None:
                 self.generate_purge_tower(previous_end, (lower, higher))
+            elif self.use_purge_tower:
+                # Infill is part of the walls here, so the whole purge volume goes into a tower sized to match
+                purge_volume = purge_planner.start_range((lower, higher))
+                tower_length, full_length = self.generate_purge_tower(previous_end, (lower, higher), None,
+                                                                      purge_planner)
+                purge_planner.record(purge_volume, 0.0, tower_length, full_length)
+                if len(self.connected_paths) > 0:
+                    previous_end = self.connected_paths[-1][3].points()[-1]
+
+            self.connect_paths_in_range(previous_end, (lower, higher), path_optimizer)
+            if len(self.connected_paths) > 0:
+                previous_end = self.connected_paths[-1][3].points()[-1]
+            current_range = (lower, higher)
 
-            self.connect_paths_in_range(previous_end, (lower, higher))
+        # Towers of empty ranges that are still needed on later layers keep growing, but are printed with the
+        # current material so that they do not cost a mixture change
+        if support_towers is None or not self.use_purge_tower:
+            return
+        for lower, higher in support_towers:
+            if (lower, higher) in self.occupied_ranges:
+                continue
+            if purge_planner is None:
+                self.generate_purge_tower(previous_end, (lower, higher), current_range)
+            else:
+                tower_length, full_length = self.generate_purge_tower(previous_end, (lower, higher), current_range,
+                                                                      purge_planner)
+                purge_planner.record(0.0, 0.0, tower_length, full_length)
             if len(self.connected_paths) > 0:
                 previous_end = self.connected_paths[-1][3].points()[-1]
 
+    def simplify_paths(self, tolerance):
+        # Drop near-collinear vertices from the connected extrusion paths, returns the vertex counts before and after
+        self.connected_paths, before, after = simplification.simplify_labeled_paths(self.connected_paths, tolerance)
+        return before, after
+
+    def comb_travels(self, combing_planner):
+        # Route long travels inside the outline so that they do not need a retraction, returns the number of combed
+        # travels and the number of long travels
+        self.connected_paths, combed, total = combing_planner.comb_paths(self.outline, self.connected_paths)
+        return combed, total
+
     def get_bounds(self):
         min = [float('inf'), float('inf')]
         max = [-float('inf'), -float('inf')]
         # Iterate over all of the paths to find the min and max x and y values
-        for lower, higher, is_extrusion, polyline in self.connected_paths:
+        for lower, higher, is_extrusion, polyline, layers in self.connected_paths:
             for point in polyline.points():
                 if point.x() < min[0]:
                     min[0] = point.x()
@@ -251,7 +350,7 @@ class OutlineLayer:
         return min, max
 
     def translate_paths(self, xy_translation, z_translation):
-        for lower, higher, is_extrusion, polyline in self.connected_paths:
+        for lower, higher, is_extrusion, polyline, layers in self.connected_paths:
             polyline.translate(xy_translation)
         self.z_height += z_translation
 
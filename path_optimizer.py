@@ -0,0 +1,225 @@
+import math
+import time
+
+
+class PathOptimizer:
+    """ Refines a greedy path order with 2-opt and Or-opt moves to cut travel length and retractions."""
+
+    def __init__(self, settings):
+        optimization_settings = settings["slicer_settings"].get("path_optimization", {})
+        self.time_limit = optimization_settings.get("time_limit", 0.05)  # Seconds allowed per call
+        self.num_neighbours = optimization_settings.get("neighbours", 8)
+        self.max_block_length = optimization_settings.get("max_block_length", 3)
+        # Extra cost (in mm of travel) charged for every travel long enough to need a retraction
+        self.retraction_penalty = optimization_settings.get("retraction_penalty", 5.0)
+
+        self.use_retraction = settings["printer_settings"]["retraction"]["use"]
+        self.retraction_required_distance = settings["printer_settings"]["retraction"]["required_distance"]
+
+        self.total_travel_saved = 0.0
+        self.total_retractions_avoided = 0
+
+    @staticmethod
+    def distance(p1, p2):
+        return math.hypot(p1[0] - p2[0], p1[1] - p2[1])
+
+    def edge_cost(self, p1, p2):
+        length = self.distance(p1, p2)
+        if self.use_retraction and length > self.retraction_required_distance:
+            return length + self.retraction_penalty
+        return length
+
+    def travel_cost(self, start_point, tour, starts, ends):
+        # Returns the total travel length and the number of travels that would require a retraction
+        total_length = 0.0
+        retractions = 0
+        previous_end = start_point
+        for node, reversed_flag in tour:
+            start = ends[node] if reversed_flag else starts[node]
+            length = self.distance(previous_end, start)
+            total_length += length
+            if self.use_retraction and length > self.retraction_required_distance:
+                retractions += 1
+            previous_end = starts[node] if reversed_flag else ends[node]
+        return total_length, retractions
+
+    def build_neighbour_lists(self, starts, ends):
+        # Bucket every endpoint into a uniform grid so nearest neighbours can be found without an O(n^2) scan
+        n = len(starts)
+        points = [(starts[i], i) for i in range(n)] + [(ends[i], i) for i in range(n)]
+        min_x = min(p[0][0] for p in points)
+        min_y = min(p[0][1] for p in points)
+        max_x = max(p[0][0] for p in points)
+        max_y = max(p[0][1] for p in points)
+        cell_size = max(max_x - min_x, max_y - min_y, 1e-6) / max(math.sqrt(n), 1.0)
+
+        grid = {}
+        for point, node in points:
+            key = (int((point[0] - min_x) / cell_size), int((point[1] - min_y) / cell_size))
+            grid.setdefault(key, []).append((point, node))
+
+        neighbours = []
+        for node in range(n):
+            candidates = {}
+            for point in (starts[node], ends[node]):
+                cx = int((point[0] - min_x) / cell_size)
+                cy = int((point[1] - min_y) / cell_size)
+                ring = 0
+                found = []
+                # Grow the search ring until enough candidates are found (one extra ring keeps the result exact enough)
+                while True:
+                    for gx in range(cx - ring, cx + ring + 1):
+                        for gy in range(cy - ring, cy + ring + 1):
+                            if max(abs(gx - cx), abs(gy - cy)) != ring:
+                                continue
+                            for other_point, other_node in grid.get((gx, gy), []):
+                                if other_node != node:
+                                    found.append((self.distance(point, other_point), other_node))
+                    if len(found) >= self.num_neighbours * 2 or ring * cell_size > (max_x - min_x) + (max_y - min_y):
+                        break
+                    ring += 1
+                for dist, other_node in found:
+                    if other_node not in candidates or dist < candidates[other_node]:
+                        candidates[other_node] = dist
+            ordered = sorted(candidates.items(), key=lambda item: item[1])
+            neighbours.append([other_node for other_node, dist in ordered[:self.num_neighbours]])
+        return neighbours
+
+    def optimize(self, start_point, ordered_paths):
+        """ Takes paths already ordered and oriented by the greedy connector and returns a refined order along with
+        the travel length saved and retractions avoided. Paths that end up reversed are reversed in place."""
+        n = len(ordered_paths)
+        if n < 3:
+            return ordered_paths, 0.0, 0
+
+        deadline = time.perf_counter() + self.time_limit
+        origin = (start_point.x(), start_point.y())
+        starts = []
+        ends = []
+        for path in ordered_paths:
+            points = path[3].points()
+            starts.append((points[0].x(), points[0].y()))
+            ends.append((points[-1].x(), points[-1].y()))
+
+        tour = [(i, False) for i in range(n)]
+        initial_length, initial_retractions = self.travel_cost(origin, tour, starts, ends)
+        neighbours = self.build_neighbour_lists(starts, ends)
+
+        dist = self.edge_cost
+
+        def start_of(k):
+            node, reversed_flag = tour[k]
+            return ends[node] if reversed_flag else starts[node]
+
+        def end_of(k):
+            if k < 0:
+                return origin
+            node, reversed_flag = tour[k]
+            return starts[node] if reversed_flag else ends[node]
+
+        def try_two_opt(i, j):
+            # Reverse the positions i..j (inclusive) and flip the direction of every path in between
+            if i >= j:
+                return 0.0
+            delta = dist(end_of(i - 1), end_of(j)) - dist(end_of(i - 1), start_of(i))
+            if j < n - 1:
+                delta += dist(start_of(i), start_of(j + 1)) - dist(end_of(j), start_of(j + 1))
+            return delta
+
+        def try_or_opt(i, length, p):
+            # Move the block at positions i..i+length-1 so that it follows position p, returns (delta, reverse)
+            last = i + length - 1
+            removal = -dist(end_of(i - 1), start_of(i))
+            if last < n - 1:
+                removal += dist(end_of(i - 1), start_of(last + 1)) - dist(end_of(last), start_of(last + 1))
+            anchor = end_of(p)
+            if p < n - 1:
+                following = start_of(p + 1)
+                base = -dist(anchor, following)
+                forward = base + dist(anchor, start_of(i)) + dist(end_of(last), following)
+                backward = base + dist(anchor, end_of(last)) + dist(start_of(i), following)
+            else:
+                forward = dist(anchor, start_of(i))
+                backward = dist(anchor, end_of(last))
+            if backward < forward:
+                return removal + backward, True
+            return removal + forward, False
+
+        positions = [0] * n
+        for k, (node, reversed_flag) in enumerate(tour):
+            positions[node] = k
+
+        improved = True
+        timed_out = False
+        while improved and not timed_out:
+            improved = False
+            i = 0
+            while i < n:
+                if time.perf_counter() > deadline:
+                    timed_out = True
+                    break
+
+                # 2-opt: try to connect the end before position i to a nearby path
+                anchor_node = tour[i - 1][0] if i > 0 else tour[0][0]
+                best_delta = -1e-9
+                best_move = None
+                for other in neighbours[anchor_node]:
+                    j = positions[other]
+                    for a, b in ((i, j), (j + 1, i - 1)):
+                        if 0 <= a < b < n:
+                            delta = try_two_opt(a, b)
+                            if delta < best_delta:
+                                best_delta = delta
+                                best_move = ("2opt", a, b)
+
+                # Or-opt: try to move a short block starting at i next to one of its neighbours
+                for length in range(1, self.max_block_length + 1):
+                    if i + length > n:
+                        break
+                    for other in neighbours[tour[i][0]]:
+                        q = positions[other]
+                        for p in (q - 1, q):
+                            if p < -1 or i - 1 <= p <= i + length - 1:
+                                continue
+                            delta, reverse_block = try_or_opt(i, length, p)
+                            if delta < best_delta:
+                                best_delta = delta
+                                best_move = ("oropt", i, length, p, reverse_block)
+
+                if best_move is None:
+                    i += 1
+                    continue
+
+                if best_move[0] == "2opt":
+                    a, b = best_move[1], best_move[2]
+                    tour[a:b + 1] = [(node, not reversed_flag) for node, reversed_flag in reversed(tour[a:b + 1])]
+                else:
+                    start, length, p, reverse_block = best_move[1:]
+                    block = tour[start:start + length]
+                    if reverse_block:
+                        block = [(node, not reversed_flag) for node, reversed_flag in reversed(block)]
+                    remaining = tour[:start] + tour[start + length:]
+                    insert_at = p + 1 if p < start else p + 1 - length
+                    tour[:] = remaining[:insert_at] + block + remaining[insert_at:]
+                for k, (node, reversed_flag) in enumerate(tour):
+                    positions[node] = k
+                improved = True
+
+        final_length, final_retractions = self.travel_cost(origin, tour, starts, ends)
+        initial_cost = initial_length + initial_retractions * self.retraction_penalty
+        final_cost = final_length + final_retractions * self.retraction_penalty
+        if final_cost >= initial_cost:
+            return ordered_paths, 0.0, 0
+
+        result = []
+        for node, reversed_flag in tour:
+            path = ordered_paths[node]
+            if reversed_flag:
+                path[3].reverse()
+            result.append(path)
+
+        travel_saved = initial_length - final_length
+        retractions_avoided = initial_retractions - final_retractions
+        self.total_travel_saved += travel_saved
+        self.total_retractions_avoided += retractions_avoided
+        return result, travel_saved, retractions_avoided
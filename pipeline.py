@@ -0,0 +1,65 @@
+import collections
+import queue
+import threading
+
+
+def extrusion_length(layers):
+    # Combined infill counts once per layer it is printed for, the way the writer measures the mixture lookahead
+    total_length = 0.0
+    for l in layers:
+        for lower, higher, is_extrusion, polyline, path_layers in l.get_paths():
+            if is_extrusion:
+                total_length += polyline.length() * path_layers
+    return total_length
+
+
+def write_pipelined(layers, gcode_writer, pmin, pmax, lookahead_distance, queue_size=8, resume=False):
+    """ Writes layers while later ones are still being produced. `layers` is an iterable (usually a generator that
+    slices, cuts, connects and centers one layer at a time) which is consumed on a background thread. Each layer is
+    written once enough future layers are known to cover twice the mixture lookahead distance, so the mixture
+    changes come out the same as when every layer is known up front."""
+    layer_queue = queue.Queue(maxsize=queue_size)
+    done = object()
+
+    def produce():
+        try:
+            for l in layers:
+                layer_queue.put(l)
+            layer_queue.put(done)
+        except Exception as e:
+            layer_queue.put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    gcode_writer.write_header(pmin, pmax, resume)
+
+    window = collections.deque()
+    window_length = 0.0  # Extrusion length of the layers in the window after the one being written
+    finished = False
+    index = 1
+    while True:
+        # Make sure there is a layer to write and enough future layers for the mixture lookahead
+        while not finished and (len(window) == 0 or window_length < 2 * lookahead_distance):
+            item = layer_queue.get()
+            if item is done:
+                finished = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                if len(window) > 0:
+                    window_length += extrusion_length([item])
+                window.append(item)
+
+        if len(window) == 0:
+            break
+
+        l = window.popleft()
+        if len(window) > 0:
+            window_length -= extrusion_length([window[0]])
+        print("\t-> Writing layer {}".format(index))
+        l.write_layer(gcode_writer, list(window))
+        index += 1
+
+    producer.join()
+    gcode_writer.write_footer()
@@ -0,0 +1,121 @@
+import math
+import pyvcad as pv
+import pyvcad_compilers as pvc
+
+
+class PreScanner:
+    """ Samples the object on a coarse voxel grid to find the heights that hold geometry and how far the geometry
+    reaches in XY over each occupied interval. The fine slicing then only visits layers inside those intervals and
+    samples each interval through a cross-sectioner whose window is narrowed to the interval's extent. Windows are
+    aligned to the fine voxel grid, so the positions that are sampled do not change. Intervals and extents are
+    padded by one coarse voxel, since the coarse grid only sees geometry at its own sample heights."""
+
+    def __init__(self, root, min, max, voxel_size, settings, make_sectioner=None):
+        scan_settings = settings["slicer_settings"].get("prescan", {})
+        self.voxel_scale = scan_settings.get("voxel_scale", 4)
+        self.narrow_windows = scan_settings.get("narrow_windows", True)
+        if self.voxel_scale < 1:
+            raise ValueError("The pre-scan voxel scale must be at least 1")
+
+        self.root = root
+        self.min = min
+        self.max = max
+        self.voxel_size = voxel_size
+        # Builds the fine cross-sectioner of a window, from its min and max corners
+        self.make_sectioner = make_sectioner
+        if self.make_sectioner is None:
+            self.make_sectioner = lambda window_min, window_max: pvc.CrossSectionSlicer(root, window_min, window_max,
+                                                                                       voxel_size)
+        self.coarse_voxel_size = pv.Vec3(voxel_size.x * self.voxel_scale, voxel_size.y * self.voxel_scale,
+                                         voxel_size.z * self.voxel_scale)
+
+        self.scanned = False
+        self.windows = []  # (z_low, z_high, cross-sectioner) for every occupied interval
+
+    @staticmethod
+    def outline_extent(outlines):
+        min_x = min_y = float('inf')
+        max_x = max_y = float('-inf')
+        for outline in outlines:
+            for point in outline:
+                min_x = min(min_x, point.x())
+                min_y = min(min_y, point.y())
+                max_x = max(max_x, point.x())
+                max_y = max(max_y, point.y())
+        return min_x, min_y, max_x, max_y
+
+    def align(self, value, origin, step, rounding, low, high):
+        # Snap a window bound onto the fine voxel grid and keep it inside the bounding box
+        return min(max(origin + rounding((value - origin) / step) * step, low), high)
+
+    def scan(self, fine_sectioner):
+        """ Finds the occupied intervals, fine_sectioner is used for every window when windows are not narrowed."""
+        coarse_sectioner = pvc.CrossSectionSlicer(self.root, self.min, self.max, self.coarse_voxel_size)
+        step = self.coarse_voxel_size.z
+
+        # Coarse samples from the bottom to the top of the bounding box, the top itself is always sampled
+        heights = []
+        z = self.min.z
+        while z < self.max.z:
+            heights.append(z)
+            z += step
+        heights.append(self.max.z)
+
+        intervals = []  # [z_low, z_high, min_x, min_y, max_x, max_y]
+        previous_occupied = False
+        for z in heights:
+            outlines = coarse_sectioner.slice_geometry(z)
+            if len(outlines) == 0:
+                previous_occupied = False
+                continue
+            min_x, min_y, max_x, max_y = self.outline_extent(outlines)
+            if previous_occupied:
+                interval = intervals[-1]
+                interval[1] = z
+                interval[2:] = [min(interval[2], min_x), min(interval[3], min_y),
+                                max(interval[4], max_x), max(interval[5], max_y)]
+            else:
+                intervals.append([z, z, min_x, min_y, max_x, max_y])
+            previous_occupied = True
+
+        self.windows = []
+        for z_low, z_high, min_x, min_y, max_x, max_y in intervals:
+            z_low = max(z_low - step, self.min.z)
+            z_high = min(z_high + step, self.max.z)
+            sectioner = fine_sectioner
+            if self.narrow_windows:
+                pad_x = self.coarse_voxel_size.x
+                pad_y = self.coarse_voxel_size.y
+                window_min = pv.Vec3(
+                    self.align(min_x - pad_x, self.min.x, self.voxel_size.x, math.floor, self.min.x, self.max.x),
+                    self.align(min_y - pad_y, self.min.y, self.voxel_size.y, math.floor, self.min.y, self.max.y),
+                    self.align(z_low, self.min.z, self.voxel_size.z, math.floor, self.min.z, self.max.z))
+                window_max = pv.Vec3(
+                    self.align(max_x + pad_x, self.min.x, self.voxel_size.x, math.ceil, self.min.x, self.max.x),
+                    self.align(max_y + pad_y, self.min.y, self.voxel_size.y, math.ceil, self.min.y, self.max.y),
+                    self.align(z_high, self.min.z, self.voxel_size.z, math.ceil, self.min.z, self.max.z))
+                sectioner = self.make_sectioner(window_min, window_max)
+            self.windows.append((z_low, z_high, sectioner))
+
+        self.scanned = True
+        self.report(heights, intervals)
+        return self.windows
+
+    def report(self, heights, intervals):
+        height = self.max.z - self.min.z
+        occupied = sum(z_high - z_low for z_low, z_high, sectioner in self.windows)
+        area = (self.max.x - self.min.x) * (self.max.y - self.min.y)
+        window_area = 0.0
+        for z_low, z_high, min_x, min_y, max_x, max_y in intervals:
+            window_area = max(window_area, (max_x - min_x) * (max_y - min_y))
+        print("\t-> Pre-scan sampled {} coarse layers and found {} occupied intervals covering {:.2f} of {:.2f} mm"
+              .format(len(heights), len(self.windows), occupied, height))
+        if area > 0 and self.narrow_windows:
+            print("\t-> Largest occupied XY extent is {:.1f}% of the bounding box".format(100.0 * window_area / area))
+
+    def window_for(self, z):
+        """ Returns the cross-sectioner for the interval holding z, or None if the height is empty."""
+        for z_low, z_high, sectioner in self.windows:
+            if z_low <= z <= z_high:
+                return sectioner
+        return None
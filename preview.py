@@ -0,0 +1,78 @@
+import copy
+import threading
+import time
+
+# Features that only refine the toolpaths or protect a long job, they are left to the full resolution slice
+REFINEMENT_FEATURES = ["path_optimization", "combing", "simplification", "infill_linking", "in_object_purging",
+                       "layer_cache", "pipelined", "checkpointing", "sparse_infill"]
+
+
+def preview_settings(settings):
+    """ Returns a copy of the settings for a coarse preview slice: every few layers, a coarser voxel grid, at most
+    a few walls and none of the refinement features. Sparse infill is one of them, as the thicker preview layers
+    would make even uncombined sparse infill thicker than the nozzle."""
+    preview = settings["slicer_settings"].get("preview", {})
+    voxel_scale = preview.get("voxel_scale", 4)
+    layer_step = preview.get("layer_step", 4)
+    max_walls = preview.get("max_walls", 1)
+    if voxel_scale < 1 or layer_step < 1:
+        raise ValueError("The preview voxel scale and layer step must be at least 1")
+
+    coarse = copy.deepcopy(settings)
+    coarse["object_settings"]["voxel_size"] = [size * voxel_scale for size in settings["object_settings"]["voxel_size"]]
+    coarse["slicer_settings"]["layer_height"] = settings["slicer_settings"]["layer_height"] * layer_step
+    coarse["slicer_settings"]["num_walls"] = min(settings["slicer_settings"]["num_walls"], max_walls)
+    for feature in REFINEMENT_FEATURES:
+        if feature in coarse["slicer_settings"]:
+            coarse["slicer_settings"][feature]["use"] = False
+    return coarse
+
+
+def path_lengths(layer):
+    extrusion = 0.0
+    travel = 0.0
+    for lower, higher, is_extrusion, polyline, layers in layer.connected_paths:
+        if is_extrusion:
+            extrusion += polyline.length()
+        else:
+            travel += polyline.length()
+    return extrusion, travel
+
+
+def stream_preview(preview_slicer, ranges):
+    """ Slices the preview and prints the statistics of every layer as soon as it is done. Returns the preview
+    layers."""
+    start = time.time()
+    preview_slicer.prepare_layers(ranges)
+    layers = []
+    total_extrusion = 0.0
+    for l in preview_slicer.process_layers(ranges):
+        extrusion, travel = path_lengths(l)
+        total_extrusion += extrusion
+        print("\t-> Preview layer {} at z = {:.2f}: {} ranges, {:.1f} mm extruded, {:.1f} mm of travel".format(
+            len(layers) + 1, l.get_z_height(), len(l.get_occupied_ranges()), extrusion, travel))
+        layers.append(l)
+    print("\t-> Preview of {} layers ({:.1f} mm extruded) took {:.2f} seconds".format(
+        len(layers), total_extrusion, time.time() - start))
+    return layers
+
+
+def refine_in_background(refine, layers, visualize_every=0):
+    """ Runs refine() (the full resolution slice) on a background thread while every visualize_every-th preview
+    layer is plotted, plotting has to stay on the main thread. Errors of the refinement are raised here."""
+    errors = []
+
+    def run():
+        try:
+            refine()
+        except BaseException as e:
+            errors.append(e)
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    if visualize_every > 0:
+        for l in layers[::visualize_every]:
+            l.visualize_paths()
+    worker.join()
+    if len(errors) > 0:
+        raise errors[0]
@@ -0,0 +1,106 @@
+class PurgePlanner:
+    """ Works out how much material has to be flushed after each change of material range and where it goes. The
+    volume of a transition comes from a configured matrix (indexed by the ranges, lowest first) or, without one, from
+    a base volume plus a volume per unit of mixture difference. It is spent first on the infill of the new range,
+    which is hidden inside the part, and only the leftover goes into the purge tower. A tower is stacked, so it keeps
+    the same rings on every layer. When every layer is known before it is connected, the rings are sized by
+    size_towers for the largest leftover of any layer, otherwise for the largest transition into the range."""
+
+    def __init__(self, settings):
+        purging_settings = settings["slicer_settings"].get("in_object_purging", {})
+        self.base_volume = purging_settings.get("base_volume", 2.0)
+        self.volume_per_fraction = purging_settings.get("volume_per_fraction", 20.0)
+        self.matrix = purging_settings.get("matrix", None)
+        # Rings printed on every tower regardless of the purge volume, so that the towers keep a solid shell
+        self.min_tower_rings = purging_settings.get("min_tower_rings", 2)
+
+        self.bead_width = settings["printer_settings"]["nozzle_diameter"]
+        self.layer_height = settings["slicer_settings"]["layer_height"]
+
+        self.ranges = []
+        self.previous_range = None
+        self.leftover_lengths = None  # Largest tower length any layer needs for each range, if known up front
+        self.tower_ring_counts = {}
+
+        self.transitions = 0
+        self.required_volume = 0.0
+        self.infill_volume = 0.0
+        self.tower_volume = 0.0
+        self.full_tower_volume = 0.0
+        self.unflushed_volume = 0.0
+
+    def set_ranges(self, ranges):
+        self.ranges = sorted(ranges)
+        if self.matrix is not None:
+            if len(self.matrix) != len(self.ranges) or any(len(row) != len(self.ranges) for row in self.matrix):
+                raise ValueError("The purge volume matrix must have one row and one column for each of the {} ranges"
+                                 .format(len(self.ranges)))
+
+    def transition_volume(self, old_range, new_range):
+        if old_range is None or old_range == new_range:
+            return 0.0
+        if self.matrix is not None:
+            return self.matrix[self.ranges.index(old_range)][self.ranges.index(new_range)]
+        difference = abs((new_range[0] + new_range[1]) / 2.0 - (old_range[0] + old_range[1]) / 2.0)
+        return self.base_volume + self.volume_per_fraction * difference
+
+    def start_range(self, new_range):
+        """ Returns the volume that has to be flushed before the new range is printed cleanly."""
+        volume = self.transition_volume(self.previous_range, new_range)
+        self.previous_range = new_range
+        if volume > 0:
+            self.transitions += 1
+            self.required_volume += volume
+        return volume
+
+    def size_towers(self, layers, range_orders):
+        """ Finds the largest purge leftover of every range over the layers, in the order they will be connected:
+        the transition volume into the range less what the layer's infill of the range absorbs of it."""
+        self.leftover_lengths = {}
+        previous_range = self.previous_range
+        for l, range_order in zip(layers, range_orders):
+            for r in l.visited_ranges(range_order):
+                volume = self.transition_volume(previous_range, r)
+                leftover = volume - min(self.length_to_volume(l.purge_infill_length(r)), volume)
+                self.leftover_lengths[r] = max(self.leftover_lengths.get(r, 0.0), self.volume_to_length(leftover))
+                previous_range = r
+        self.tower_ring_counts = {}
+
+    def tower_rings(self, tower_range, ring_lengths):
+        """ Returns how many of the rings (outermost first) the tower of the range prints on every layer."""
+        if tower_range not in self.tower_ring_counts:
+            if self.leftover_lengths is not None:
+                largest_length = self.leftover_lengths.get(tower_range, 0.0)
+            else:
+                largest_length = self.volume_to_length(max([self.transition_volume(r, tower_range)
+                                                            for r in self.ranges] + [0.0]))
+            count = 0
+            length = 0.0
+            while count < len(ring_lengths) and (count < self.min_tower_rings or length < largest_length):
+                length += ring_lengths[count]
+                count += 1
+            self.tower_ring_counts[tower_range] = count
+        return self.tower_ring_counts[tower_range]
+
+    def volume_to_length(self, volume):
+        return volume / (self.bead_width * self.layer_height)
+
+    def length_to_volume(self, length):
+        return length * self.bead_width * self.layer_height
+
+    def record(self, purge_volume, infill_volume, tower_length, full_tower_length):
+        # Infill volume is what the infill of the new range absorbed of the purge, not its whole volume
+        self.infill_volume += infill_volume
+        self.tower_volume += self.length_to_volume(tower_length)
+        self.full_tower_volume += self.length_to_volume(full_tower_length)
+        # Only a tower that has run out of rings leaves purge unflushed
+        self.unflushed_volume += max(purge_volume - infill_volume - self.length_to_volume(tower_length), 0.0)
+
+    def report(self):
+        print("\t-> Purging: {} transitions needed {:.2f} mm^3, {:.2f} mm^3 went into infill".format(
+            self.transitions, self.required_volume, self.infill_volume))
+        print("\t-> Purge towers extruded {:.2f} mm^3 instead of {:.2f} mm^3 (saved {:.2f} mm^3)".format(
+            self.tower_volume, self.full_tower_volume, self.full_tower_volume - self.tower_volume))
+        if self.unflushed_volume > 1e-6:
+            print("\t-> {:.2f} mm^3 of purge did not fit into the infill or the full purge towers".format(
+                self.unflushed_volume))
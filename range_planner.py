@@ -0,0 +1,133 @@
+class RangePlanner:
+    """ Picks the material ranges for a region budget from a volume-weighted histogram of the material fractions in
+    the part. Every range is printed at its midpoint, so the boundaries are placed to minimize the volume-weighted
+    error between the sampled fractions and the midpoint of the range they fall in. The ranges always cover 0 to 1
+    without gaps, since fractions that were not sampled may still occur between the sampled layers. Stretches that hold
+    no sampled material never cost a range of their own, they are split between the neighbouring ranges wherever
+    that moves their midpoints the least."""
+
+    def __init__(self, settings):
+        planning_settings = settings["slicer_settings"].get("range_planning", {})
+        self.bins = planning_settings.get("bins", 50)
+        self.sample_layers = planning_settings.get("sample_layers", 20)
+        # "squared" weighs large mismatches more (perceptual), "absolute" treats every unit of error the same
+        self.error = planning_settings.get("error", "squared")
+        # Largest acceptable RMS (or mean absolute) fraction error, the fewest ranges that reach it are used
+        self.max_error = planning_settings.get("max_error", 0.0)
+        if self.error not in ("squared", "absolute"):
+            raise ValueError("Unknown range planning error {}. Please use 'squared' or 'absolute'".format(self.error))
+        if self.bins < 1 or self.sample_layers < 1:
+            raise ValueError("Range planning needs at least one bin and one sampled layer")
+
+        self.histogram = [0.0] * self.bins
+
+    @staticmethod
+    def ring_area(ring):
+        points = [(p.x(), p.y()) for p in ring]
+        area = 0.0
+        for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+            area += x1 * y2 - x2 * y1
+        return abs(area) / 2.0
+
+    def polygon_area(self, polygon):
+        area = self.ring_area(polygon)
+        for hole in polygon.holes():
+            area -= self.ring_area(hole)
+        return area
+
+    def sample_histogram(self, cross_sectioner, min_z, max_z):
+        # Material fractions exactly at 0 or 1 are only found with widened outer bounds, as in OutlineLayer
+        bins = [(i / self.bins, (i + 1) / self.bins) for i in range(self.bins)]
+        bins[0] = (-1, bins[0][1])
+        bins[-1] = (bins[-1][0], 2)
+
+        self.histogram = [0.0] * self.bins
+        for k in range(self.sample_layers):
+            z = min_z + (k + 0.5) * (max_z - min_z) / self.sample_layers
+            for lower, higher, polygons in cross_sectioner.slice_material(z, 1, bins):
+                middle = (max(lower, 0.0) + min(higher, 1.0)) / 2.0
+                index = min(max(int(middle * self.bins), 0), self.bins - 1)
+                for polygon in polygons:
+                    self.histogram[index] += self.polygon_area(polygon)
+        return self.histogram
+
+    def range_cost(self, first, last):
+        # Weighted error of printing bins first..last - 1 at the midpoint of their range
+        middle = (first + last) / (2.0 * self.bins)
+        cost = 0.0
+        for i in range(first, last):
+            difference = (i + 0.5) / self.bins - middle
+            if self.error == "squared":
+                cost += self.histogram[i] * difference * difference
+            else:
+                cost += self.histogram[i] * abs(difference)
+        return cost
+
+    def normalized_error(self, cost):
+        total = sum(self.histogram)
+        if total == 0:
+            return 0.0
+        if self.error == "squared":
+            return (cost / total) ** 0.5
+        return cost / total
+
+    def ranges_cost(self, ranges):
+        # Cost of arbitrary ranges, fractions outside of every range count as fully wrong
+        cost = 0.0
+        for i in range(self.bins):
+            center = (i + 0.5) / self.bins
+            difference = 1.0
+            for lower, higher in ranges:
+                if lower <= center <= higher:
+                    difference = center - (lower + higher) / 2.0
+                    break
+            if self.error == "squared":
+                cost += self.histogram[i] * difference * difference
+            else:
+                cost += self.histogram[i] * abs(difference)
+        return cost
+
+    def plan(self, max_ranges):
+        """ Returns at most max_ranges (lower, higher) ranges for the sampled histogram, lowest first. The ranges are
+        contiguous, the first starts at 0 and the last ends at 1."""
+        n = self.bins
+        inf = float('inf')
+        cost = [[inf] * (n + 1) for _ in range(n + 1)]
+        empty = [[False] * (n + 1) for _ in range(n + 1)]
+        for first in range(n):
+            weight = 0.0
+            for last in range(first + 1, n + 1):
+                weight += self.histogram[last - 1]
+                cost[first][last] = self.range_cost(first, last)
+                empty[first][last] = weight == 0
+        if empty[0][n] or max_ranges < 1:
+            return [(0.0, 1.0)]
+
+        # best[k][j]: lowest cost of covering the first j bins with k ranges that each hold sampled material. The
+        # empty bins a range spans are part of its cost, as they move its midpoint
+        best = [[inf] * (n + 1) for _ in range(max_ranges + 1)]
+        choice = [[None] * (n + 1) for _ in range(max_ranges + 1)]
+        best[0][0] = 0.0
+        for k in range(1, max_ranges + 1):
+            for j in range(1, n + 1):
+                for i in range(j):
+                    if not empty[i][j] and best[k - 1][i] + cost[i][j] < best[k][j]:
+                        best[k][j] = best[k - 1][i] + cost[i][j]
+                        choice[k][j] = i
+
+        # Use the fewest ranges that reach the lowest (or the acceptable) error
+        lowest = min(best[k][n] for k in range(1, max_ranges + 1))
+        count = max_ranges
+        for k in range(1, max_ranges + 1):
+            if best[k][n] <= lowest + 1e-12 or self.normalized_error(best[k][n]) <= self.max_error:
+                count = k
+                break
+
+        ranges = []
+        j = n
+        for k in range(count, 0, -1):
+            i = choice[k][j]
+            ranges.append((i / n, j / n))
+            j = i
+        ranges.reverse()
+        return ranges
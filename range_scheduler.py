@@ -0,0 +1,54 @@
+class RangeScheduler:
+    """ Picks the order in which each layer visits its material ranges so that every layer starts with the range the
+    previous layer finished on. Only ranges that actually contain paths are scheduled."""
+
+    def __init__(self):
+        self.previous_last = None
+        self.direction = 1  # 1 sweeps towards higher ranges, -1 towards lower ranges
+
+        self.transitions = 0
+        self.default_transitions = 0
+        self.default_previous_last = None
+
+    @staticmethod
+    def count_transitions(order, previous_last):
+        transitions = 0
+        for r in order:
+            if previous_last is not None and r != previous_last:
+                transitions += 1
+            previous_last = r
+        return transitions
+
+    def schedule(self, occupied_ranges):
+        # Keep track of what the unscheduled (as cut) order would have cost for reporting
+        self.default_transitions += self.count_transitions(occupied_ranges, self.default_previous_last)
+        if len(occupied_ranges) > 0:
+            self.default_previous_last = occupied_ranges[-1]
+
+        if len(occupied_ranges) == 0:
+            return []
+
+        sorted_ranges = sorted(occupied_ranges)
+        if self.previous_last is None:
+            start_index = 0 if self.direction == 1 else len(sorted_ranges) - 1
+        else:
+            # Start on the previous layer's last range, or the closest range to it if it is not present on this layer
+            previous_mid = (self.previous_last[0] + self.previous_last[1]) / 2.0
+            start_index = min(range(len(sorted_ranges)),
+                              key=lambda i: abs((sorted_ranges[i][0] + sorted_ranges[i][1]) / 2.0 - previous_mid))
+
+        # Sweep in the current direction from the starting range, then pick up the rest of the ranges on the way back.
+        # The sweep direction flips whenever the layer ends at the far side so the next layer can sweep back
+        if self.direction == 1:
+            order = sorted_ranges[start_index:] + list(reversed(sorted_ranges[:start_index]))
+        else:
+            order = list(reversed(sorted_ranges[:start_index + 1])) + sorted_ranges[start_index + 1:]
+
+        if order[-1] == sorted_ranges[-1]:
+            self.direction = -1
+        elif order[-1] == sorted_ranges[0]:
+            self.direction = 1
+
+        self.transitions += self.count_transitions(order, self.previous_last)
+        self.previous_last = order[-1]
+        return order
@@ -0,0 +1,117 @@
+import pyvcad as pv
+
+
+def point_segment_distance(p, a, b):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        return ((p[0] - a[0]) ** 2 + (p[1] - a[1]) ** 2) ** 0.5
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length_squared
+    t = max(0.0, min(1.0, t))
+    px = a[0] + t * dx - p[0]
+    py = a[1] + t * dy - p[1]
+    return (px * px + py * py) ** 0.5
+
+
+def douglas_peucker(points, tolerance):
+    # Iterative Douglas-Peucker, returns the indices of the points to keep (always including both ends)
+    n = len(points)
+    if n < 3:
+        return list(range(n))
+
+    keep = [False] * n
+    keep[0] = True
+    keep[n - 1] = True
+    stack = [(0, n - 1)]
+    while len(stack) > 0:
+        start, end = stack.pop()
+        max_distance = 0.0
+        index = -1
+        for i in range(start + 1, end):
+            distance = point_segment_distance(points[i], points[start], points[end])
+            if distance > max_distance:
+                max_distance = distance
+                index = i
+        if index != -1 and max_distance > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return [i for i in range(n) if keep[i]]
+
+
+def simplify_points(points, tolerance):
+    return [points[i] for i in douglas_peucker(points, tolerance)]
+
+
+def simplify_ring(points, tolerance):
+    # Closed rings are split at the point farthest from the first one so that each half has well defined ends
+    closed = len(points) > 1 and points[0] == points[-1]
+    ring = points[:-1] if closed else points
+    if len(ring) < 4:
+        return points
+
+    far_index = max(range(len(ring)), key=lambda i: (ring[i][0] - ring[0][0]) ** 2 + (ring[i][1] - ring[0][1]) ** 2)
+    first_half = simplify_points(ring[:far_index + 1], tolerance)
+    second_half = simplify_points(ring[far_index:] + [ring[0]], tolerance)
+    simplified = first_half[:-1] + second_half[:-1]
+    if len(simplified) < 3:
+        return points
+    if closed:
+        simplified.append(simplified[0])
+    return simplified
+
+
+def simplify_polyline(polyline, tolerance):
+    points = [(p.x(), p.y()) for p in polyline.points()]
+    simplified = simplify_points(points, tolerance)
+    if len(simplified) == len(points):
+        return polyline, len(points), len(points)
+    return pv.Polyline2([pv.Point2(x, y) for x, y in simplified]), len(points), len(simplified)
+
+
+def simplify_polygon(polygon, tolerance):
+    # The outer ring and every hole are simplified on their own, and the polygon is rebuilt by cutting the holes out
+    # of the outer ring. A polygon whose rings came to cross each other is kept as it was
+    rings = [[(p.x(), p.y()) for p in ring] for ring in [polygon] + list(polygon.holes())]
+    simplified_rings = [simplify_ring(points, tolerance) for points in rings]
+    before = sum(len(points) for points in rings)
+    after = sum(len(points) for points in simplified_rings)
+    if after == before:
+        return polygon, before, before
+
+    outer = pv.Polygon2([pv.Point2(x, y) for x, y in simplified_rings[0]])
+    if len(rings) == 1:
+        return outer, before, after
+    holes = [pv.Polygon2([pv.Point2(x, y) for x, y in points]) for points in simplified_rings[1:]]
+    rebuilt = pv.Polygon2.Difference([outer], holes)
+    if len(rebuilt) != 1 or len(rebuilt[0].holes()) != len(holes):
+        return polygon, before, before
+    return rebuilt[0], before, after
+
+
+def simplify_polygons(polygons, tolerance):
+    """ Removes near-collinear vertices from the outer rings and holes of sampled outlines."""
+    result = []
+    before = 0
+    after = 0
+    for polygon in polygons:
+        polygon, count_before, count_after = simplify_polygon(polygon, tolerance)
+        result.append(polygon)
+        before += count_before
+        after += count_after
+    return result, before, after
+
+
+def simplify_labeled_paths(paths, tolerance):
+    # Simplifies the extrusion polylines of a list of (lower, higher, is_extrusion, polyline, layers) paths
+    result = []
+    before = 0
+    after = 0
+    for lower, higher, is_extrusion, polyline, layers in paths:
+        if is_extrusion:
+            polyline, count_before, count_after = simplify_polyline(polyline, tolerance)
+            before += count_before
+            after += count_after
+        result.append((lower, higher, is_extrusion, polyline, layers))
+    return result, before, after
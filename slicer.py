@@ -1,15 +1,39 @@
+import collections
 import pyvcad as pv
 import pyvcad_compilers as pvc
+import build_plate
+import checkpoint
+import combing
+import layer_cache
+import path_optimizer
+import prescan
+import purging
+import range_scheduler
+import simplification
+import tiled_sampling
+import pipeline
 import layer
 
 
 class Slicer:
     def __init__(self, root, min, max, voxel_size, settings):
         self.settings = settings
-        self.cross_sectioner = pvc.CrossSectionSlicer(root, min, max, voxel_size)
+        self.root = root
         self.min = min
         self.max = max
         self.voxel_size = voxel_size
+
+        # Optional sampling of the XY domain in tiles, so that the raster of a sample is bounded by the tile size
+        self.tiled_sampling = settings["slicer_settings"].get("tiled_sampling", {}).get("use", False)
+        self.cross_sectioner = self.make_cross_sectioner(min, max)
+
+        # Optional coarse pre-scan that skips empty heights and narrows the sampled window of occupied ones
+        self.prescanner = None
+        if settings["slicer_settings"].get("prescan", {}).get("use", False):
+            if isinstance(root, build_plate.BuildPlate):
+                raise ValueError("The pre-scan cannot be combined with a build plate, it samples a single object")
+            self.prescanner = prescan.PreScanner(root, min, max, voxel_size, settings, self.make_cross_sectioner)
+
         self.model_bottom_z = min.z
         self.purge_min = settings["purge_tower_settings"]["min"]
         self.purge_max = settings["purge_tower_settings"]["max"]
@@ -25,9 +49,86 @@ class Slicer:
         printer_max = settings["printer_settings"]["dimensions"]["max"]
         self.center_point = ((printer_max[0] - printer_min[0]) / 2, (printer_max[1] - printer_min[1]) / 2)
 
+        # Optional route optimizer that refines the greedy path order of every layer
+        self.path_optimizer = None
+        if settings["slicer_settings"].get("path_optimization", {}).get("use", False):
+            self.path_optimizer = path_optimizer.PathOptimizer(settings)
+
+        # Optional scheduler that orders each layer's ranges to continue from the previous layer's last range
+        self.range_scheduler = None
+        if settings["gradient_settings"].get("range_scheduling", False):
+            self.range_scheduler = range_scheduler.RangeScheduler()
+
+        # Optional simplification of sampled outlines and connected paths, with a tolerance relative to the bead width
+        self.simplify_tolerance = 0
+        simplification_settings = settings["slicer_settings"].get("simplification", {})
+        if simplification_settings.get("use", False):
+            self.simplify_tolerance = simplification_settings.get("tolerance_ratio", 0.05) * \
+                                      settings["printer_settings"]["nozzle_diameter"]
+
+        # Optional combing of long travels inside the part, so that they do not need a retraction
+        self.combing_planner = None
+        if settings["slicer_settings"].get("combing", {}).get("use", False):
+            self.combing_planner = combing.CombingPlanner(settings)
+
+        # Optional linking of the infill scanlines into zigzags, with links up to a multiple of the infill spacing
+        self.infill_link_ratio = 0
+        infill_linking_settings = settings["slicer_settings"].get("infill_linking", {})
+        if infill_linking_settings.get("use", False):
+            self.infill_link_ratio = infill_linking_settings.get("max_link_ratio", 3.0)
+
+        # Optional purging into the infill of the next range, with purge towers only as large as the leftover needs
+        self.purge_planner = None
+        if settings["slicer_settings"].get("in_object_purging", {}).get("use", False):
+            self.purge_planner = purging.PurgePlanner(settings)
+
+        # Optional reuse of the toolpaths of layers that are identical to an earlier one
+        self.layer_cache = None
+        self.cache_ranges = []
+        if settings["slicer_settings"].get("layer_cache", {}).get("use", False):
+            if self.purge_planner is not None:
+                raise ValueError("The layer cache cannot be combined with in-object purging, which depends on the "
+                                 "ranges printed before each layer")
+            self.layer_cache = layer_cache.LayerCache(settings)
+
+        # Optional checkpoints of the cut and connected layers, so that a job that dies can be resumed
+        self.checkpointer = None
+        if settings["slicer_settings"].get("checkpointing", {}).get("use", False):
+            self.checkpointer = checkpoint.Checkpointer(settings)
+
+        if self.checkpointer is not None and self.layer_cache is not None:
+            raise ValueError("Checkpointing cannot be combined with the layer cache, which only keeps the layers it cut")
+
+        # Optional sparse infill of the interior, optionally printed once every few layers at the combined height
+        sparse_infill_settings = settings["slicer_settings"].get("sparse_infill", {})
+        self.use_sparse_infill = sparse_infill_settings.get("use", False)
+        self.sparse_infill_density = sparse_infill_settings.get("density", 20) / 100.0
+        self.combine_infill_layers = sparse_infill_settings.get("combine_layers", 1)
+        self.solid_infill_layers = sparse_infill_settings.get("solid_layers", 3)
+        if self.use_sparse_infill:
+            if self.sparse_infill_density <= 0 or self.combine_infill_layers < 1:
+                raise ValueError("Sparse infill needs a positive density and at least one combined layer")
+            if self.combine_infill_layers * settings["slicer_settings"]["layer_height"] > \
+                    settings["printer_settings"]["nozzle_diameter"]:
+                raise ValueError("Combined infill would be thicker than the nozzle diameter. Please reduce combine_layers")
+
+        # Optional window of heights to slice. Layers below it are only counted, so that their numbering and parity
+        # match a full slice. A resumed print keeps the heights of the full slice, otherwise the window starts on the bed
+        self.z_start = None
+        self.z_end = None
+        self.resume = False
+        self.window_bottom_z = None
+        # Ranges printed below a resumed window, in the order they were started
+        self.ranges_below_window = []
+
         self.layers = []
+        self.total_skipped = 0
 
-    def slice(self, ranges):
+    def slice(self, ranges, z_start=None, z_end=None, resume=True):
+        self.set_z_window(z_start, z_end, resume)
+        self.cache_ranges = ranges
+        if self.checkpointer is not None:
+            self.checkpointer.open(ranges, self.cross_sectioner, self.min, self.max)
         print("1. Generating purge tower base locations")
         self.compute_purge_tower_centers(ranges)
         print("2. Generating paths")
@@ -39,6 +140,15 @@ class Slicer:
         print("5.Centering paths on the bed")
         self.center_paths()
 
+    def set_z_window(self, z_start=None, z_end=None, resume=True):
+        if z_start is not None and z_end is not None and z_end < z_start:
+            raise ValueError("The end of the sliced z window must not be below its start")
+        self.z_start = z_start
+        self.z_end = z_end
+        self.resume = resume and z_start is not None
+        self.window_bottom_z = None
+        self.ranges_below_window = []
+
     def compute_purge_tower_centers(self, ranges):
         self.purge_tower_centers = []
         min_x = self.purge_min[0] - self.center_point[0]
@@ -60,59 +170,305 @@ class Slicer:
         for i in range(len(ranges)):
             self.purge_tower_centers.append((ranges[i][0], ranges[i][1], possible_centers[i]))
 
-    def generate_paths(self):
+        if self.purge_planner is not None:
+            self.purge_planner.set_ranges(ranges)
+
+    def make_cross_sectioner(self, window_min, window_max):
+        if isinstance(self.root, build_plate.BuildPlate):
+            # Every object on the plate is sampled through a cross-sectioner of its own
+            return build_plate.PlateCrossSectioner(self.root, self.voxel_size, self.settings)
+        if self.tiled_sampling:
+            return tiled_sampling.TiledCrossSectioner(self.root, window_min, window_max, self.voxel_size, self.settings)
+        return pvc.CrossSectionSlicer(self.root, window_min, window_max, self.voxel_size)
+
+    def sectioner_for(self, z):
+        # The cross-sectioner that samples the given height, None if the pre-scan found it empty
+        if self.prescanner is None:
+            return self.cross_sectioner
+        return self.prescanner.window_for(z)
+
+    def sample_heights(self):
+        # Yields the height, cross-sectioner and outlines of every layer height. Heights the pre-scan found empty have
+        # no cross-sectioner
         layer_height = self.settings["slicer_settings"]["layer_height"]
+        if self.prescanner is not None and not self.prescanner.scanned:
+            self.prescanner.scan(self.cross_sectioner)
+        z = self.min.z
+        while z <= self.max.z:
+            sectioner = self.sectioner_for(z)
+            outlines = []
+            if sectioner is not None:
+                outlines = sectioner.slice_geometry(z)
+                if self.simplify_tolerance > 0 and len(outlines) > 0:
+                    outlines, before, after = simplification.simplify_polygons(outlines, self.simplify_tolerance)
+                    print("\t-> Simplified outlines at z = {} from {} to {} vertices".format(z, before, after))
+            yield z, sectioner, outlines
+            z += layer_height
+
+    def find_interiors(self, heights):
+        # Adds the interior of every height, the part of its outlines that is also inside the outlines of the
+        # solid_layers heights below and above it. The rest of the outlines is a bottom or top surface
+        solid_layers = self.solid_infill_layers
+        below = collections.deque(maxlen=max(solid_layers, 1))
+        pending = collections.deque()
+
+        def with_interior(entry):
+            interior = []
+            if len(below) >= solid_layers and len(pending) >= solid_layers:
+                interior = entry[2]
+                for outlines in list(below)[len(below) - solid_layers:] + [e[2] for e in pending]:
+                    if len(interior) == 0:
+                        break
+                    interior = pv.Polygon2.Intersection(interior, outlines)
+            below.append(entry[2])
+            return entry + (interior,)
+
+        for entry in heights:
+            pending.append(entry)
+            if len(pending) > solid_layers:
+                yield with_interior(pending.popleft())
+        while len(pending) > 0:
+            yield with_interior(pending.popleft())
+
+    def plan_infill(self, heights):
+        # Adds the infill of every height as (density, region, layers) fills, a region of None is the whole layer
+        infill_density = self.settings["slicer_settings"]["infill_density"] / 100.0
+        if not self.use_sparse_infill:
+            for z, sectioner, outlines in heights:
+                yield z, sectioner, outlines, [(infill_density, None, 1)] if infill_density > 0 else []
+            return
+
+        # Heights with an interior are grouped, up to combine_layers of them, so that they can share their infill
+        group = []
+        for z, sectioner, outlines, interior in self.find_interiors(heights):
+            if len(interior) == 0:
+                yield from self.plan_group(group)
+                group = []
+                yield z, sectioner, outlines, [(infill_density, None, 1)] if infill_density > 0 else []
+                continue
+            group.append((z, sectioner, outlines, interior))
+            if len(group) == self.combine_infill_layers:
+                yield from self.plan_group(group)
+                group = []
+        yield from self.plan_group(group)
+
+    def plan_group(self, group):
+        # The interior shared by every height of the group is filled once, on the top height and for the whole group.
+        # The rest of each interior gets sparse infill of its own, the rest of the outlines solid infill
+        infill_density = self.settings["slicer_settings"]["infill_density"] / 100.0
+        shared = group[0][3] if len(group) > 1 else []
+        for z, sectioner, outlines, interior in group[1:]:
+            if len(shared) == 0:
+                break
+            shared = pv.Polygon2.Intersection(shared, interior)
+
+        for i, (z, sectioner, outlines, interior) in enumerate(group):
+            fills = []
+            surface = pv.Polygon2.Difference(outlines, interior)
+            if infill_density > 0 and len(surface) > 0:
+                fills.append((infill_density, surface, 1))
+            own = interior if len(shared) == 0 else pv.Polygon2.Difference(interior, shared)
+            if len(own) > 0:
+                fills.append((self.sparse_infill_density, own, 1))
+            if len(shared) > 0 and i == len(group) - 1:
+                fills.append((self.sparse_infill_density, shared, len(group)))
+            yield z, sectioner, outlines, fills
+
+    def generate_layers(self):
+        # Yields the layers one at a time, so that they can be processed while the rest of the part is being sliced
         bead_width = self.settings["printer_settings"]["nozzle_diameter"]
         num_walls = self.settings["slicer_settings"]["num_walls"]
-        infill_density = self.settings["slicer_settings"]["infill_density"] / 100.0
 
-        min_z = self.min.z
-        max_z = self.max.z
-        z = min_z
         layer_num = 1
-        while z <= max_z:
-            outlines = self.cross_sectioner.slice_geometry(z)
+        for z, sectioner, outlines, fills in self.plan_infill(self.sample_heights()):
+            if self.z_end is not None and z > self.z_end + 1e-9:
+                break
+            if sectioner is None:
+                continue
             if layer_num == 1:
                 self.model_bottom_z = z
 
             if len(outlines) > 0:
+                if self.z_start is not None and z < self.z_start - 1e-9:
+                    if self.resume:
+                        self.record_ranges_below_window(sectioner, z)
+                    layer_num += 1
+                    continue
+                if self.window_bottom_z is None:
+                    self.window_bottom_z = z
+
                 print("\t-> Generating paths for layer {} at z = {}".format(layer_num, z))
                 new_layer = layer.Layer(outlines, z, bead_width, self.purge_tower_centers,
                                         self.purge_tower_x_size, self.purge_tower_y_size, layer_num)
-                if num_walls > 0:
-                    new_layer.generate_walls(num_walls)
-                if infill_density > 0:
-                    new_layer.generate_infill(infill_density)
-                self.layers.append(new_layer)
+
+                # Layers whose cut is already stored get their walls and infill from it when they are cut, which
+                # happens before any other cut is stored when the layers are processed one at a time
+                has_cut = False
+                if self.layer_cache is not None:
+                    new_layer.material_ranges = sectioner.slice_material(z, 1, self.cache_ranges)
+                    new_layer.fingerprint = self.layer_cache.fingerprint(outlines, new_layer.material_ranges,
+                                                                         layer_num % 2, fills)
+                    has_cut = self.layer_cache.has_cut(new_layer.fingerprint)
+                if self.checkpointer is not None and self.checkpointer.has_cut(layer_num, z):
+                    has_cut = True
+                if not has_cut:
+                    if num_walls > 0:
+                        new_layer.generate_walls(num_walls)
+                    for density, region, layers in fills:
+                        new_layer.generate_infill(density, region, layers)
+                yield new_layer
                 layer_num += 1
             else:
                 print("\t-> Skipping layer at z = {}, no geometry found".format(z))
-            z += layer_height
+
+    def record_ranges_below_window(self, sectioner, z):
+        for lower, higher, polygons in sectioner.slice_material(z, 1, self.cache_ranges):
+            if len(polygons) > 0 and (lower, higher) not in self.ranges_below_window:
+                self.ranges_below_window.append((lower, higher))
+
+    def generate_paths(self):
+        for new_layer in self.generate_layers():
+            self.layers.append(new_layer)
+
+    def cut_layer(self, l, desired_ranges):
+        layer_number = l.get_layer_num()
+        if self.checkpointer is not None:
+            cut = self.checkpointer.restore_cut(layer_number, l.get_z_height())
+            if cut is not None:
+                print("\t-> Restored the cut of layer {} from a checkpoint".format(layer_number))
+                l.ranged_walls, l.ranged_infill, l.ranged_combined_infill, l.infill_thickness = cut
+                l.update_range_occupancy()
+                return
+        if l.fingerprint is not None and self.layer_cache.has_cut(l.fingerprint):
+            print("\t-> Reusing the cut of an identical layer for layer {}".format(layer_number))
+            self.layer_cache.restore_cut(l)
+            return
+        print("\t-> Cutting layer {} into ranges".format(layer_number))
+        if self.interlink:
+            l.cut_into_ranges_interdigitated(desired_ranges, self.sectioner_for(l.get_z_height()), layer_number % 2 == 0, self.settings["gradient_settings"]["overlap_amount"])
+        else:
+            l.cut_into_ranges(desired_ranges, self.sectioner_for(l.get_z_height()), layer_number % 2 == 0, self.infill_link_ratio)
+        if l.fingerprint is not None:
+            self.layer_cache.store_cut(l)
+        if self.checkpointer is not None:
+            self.checkpointer.store_cut(layer_number, l.get_z_height(), l.ranged_walls, l.ranged_infill,
+                                        l.ranged_combined_infill, l.infill_thickness)
+        l.material_ranges = None
 
     def cut_into_ranges(self, desired_ranges):
         for l in self.layers:
-            layer_number = l.get_layer_num()
-            print("\t-> Cutting layer {} into ranges".format(layer_number))
-            if self.interlink:
-                l.cut_into_ranges_interdigitated(desired_ranges, self.cross_sectioner, layer_number % 2 == 0, self.settings["gradient_settings"]["overlap_amount"])
-            else:
-                l.cut_into_ranges(desired_ranges, self.cross_sectioner, layer_number % 2 == 0)
+            self.cut_layer(l, desired_ranges)
+
+    def schedule_ranges(self, l):
+        # The order the layer visits its ranges in, None to keep the order they were cut in
+        if self.range_scheduler is None:
+            return None
+        return self.range_scheduler.schedule(l.get_occupied_ranges())
+
+    def connect_layer(self, l, index, support_towers, range_order):
+        print("\t-> Connecting paths for layer {}".format(index))
+
+        if self.checkpointer is not None:
+            connected = self.checkpointer.restore_connected(l.get_layer_num(), l.get_z_height())
+            if connected is not None:
+                print("\t\t-> Restored the paths from a checkpoint")
+                l.connected_paths, l.skipped_ranges, purge_range = connected
+                if self.purge_planner is not None:
+                    self.purge_planner.previous_range = purge_range
+                self.total_skipped += l.skipped_ranges
+                return
+
+        cache_key = None
+        if l.fingerprint is not None:
+            cache_key = self.layer_cache.paths_key(l, range_order, support_towers)
+            if self.layer_cache.restore_paths(l, cache_key):
+                print("\t\t-> Reused the paths of an identical layer")
+                self.total_skipped += l.skipped_ranges
+                return
+
+        l.connect_paths(self.path_optimizer, range_order, support_towers, self.purge_planner)
+        if self.simplify_tolerance > 0:
+            before, after = l.simplify_paths(self.simplify_tolerance)
+            print("\t\t-> Simplified paths from {} to {} vertices".format(before, after))
+        if self.combing_planner is not None:
+            combed, total = l.comb_travels(self.combing_planner)
+            print("\t\t-> Combed {} of {} long travels".format(combed, total))
+        if cache_key is not None:
+            self.layer_cache.store_paths(l, cache_key)
+        if self.checkpointer is not None:
+            purge_range = None
+            if self.purge_planner is not None:
+                purge_range = self.purge_planner.previous_range
+            self.checkpointer.store_connected(l.get_layer_num(), l.get_z_height(), l.connected_paths,
+                                              l.skipped_ranges, purge_range)
+        if l.skipped_ranges > 0:
+            print("\t\t-> Skipped {} empty ranges".format(l.skipped_ranges))
+        self.total_skipped += l.skipped_ranges
+        if self.path_optimizer is not None:
+            print("\t\t-> Route optimizer saved {:.2f} mm of travel and {} retractions".format(
+                l.travel_saved, l.retractions_avoided))
 
     def connect_paths(self):
+        # A purge tower has to keep growing up to the last layer its range is printed on
+        last_occupied_layer = {}
+        for i in range(len(self.layers)):
+            for r in self.layers[i].get_occupied_ranges():
+                last_occupied_layer[r] = i
+
+        # Every layer is scheduled before any is connected, so that the purge towers can be sized for the largest
+        # leftover of the whole part. A window of heights is sized like a streamed part, so that the towers of
+        # windows printed on top of each other match
+        range_orders = [self.schedule_ranges(l) for l in self.layers]
+        if self.purge_planner is not None and self.z_start is None and self.z_end is None:
+            self.purge_planner.size_towers(self.layers, range_orders)
+
         index = 1
-        for l in self.layers:
-            print("\t-> Connecting paths for layer {}".format(index))
-            l.connect_paths()
+        self.total_skipped = 0
+        for l, range_order in zip(self.layers, range_orders):
+            support_towers = [r for r, last in last_occupied_layer.items() if last >= index - 1]
+            self.connect_layer(l, index, support_towers, range_order)
             index += 1
+        self.report_connection_statistics()
 
-    def center_paths(self):
+    def report_connection_statistics(self):
+        print("\t-> Skipped {} empty ranges in total".format(self.total_skipped))
+
+        if self.path_optimizer is not None:
+            print("\t-> Route optimizer saved {:.2f} mm of travel and {} retractions in total".format(
+                self.path_optimizer.total_travel_saved, self.path_optimizer.total_retractions_avoided))
+
+        if self.combing_planner is not None:
+            print("\t-> Combed {} of {} long travels in total".format(
+                self.combing_planner.total_combed, self.combing_planner.total_travels))
+
+        if self.purge_planner is not None:
+            self.purge_planner.report()
+
+        if self.layer_cache is not None:
+            self.layer_cache.report()
+
+        if self.checkpointer is not None:
+            self.checkpointer.report()
+
+        if self.range_scheduler is not None:
+            print("\t-> Range scheduling needs {} range transitions ({} without scheduling)".format(
+                self.range_scheduler.transitions, self.range_scheduler.default_transitions))
+
+    def get_translation(self):
         xy_translation = pv.Point2(self.center_point[0], self.center_point[1])
 
         user_translate = self.settings["object_settings"]["translation"]
         if user_translate is not None:
             xy_translation = pv.Point2(xy_translation.x() + user_translate[0], xy_translation.y() + user_translate[1])
 
-        z_translation = -self.model_bottom_z + self.settings["slicer_settings"]["layer_height"]
+        bottom_z = self.model_bottom_z
+        if self.z_start is not None and not self.resume and self.window_bottom_z is not None:
+            bottom_z = self.window_bottom_z
+        z_translation = -bottom_z + self.settings["slicer_settings"]["layer_height"]
+        return xy_translation, z_translation
+
+    def center_paths(self):
+        xy_translation, z_translation = self.get_translation()
         for l in self.layers:
             l.translate_paths(xy_translation, z_translation)
 
@@ -131,7 +487,7 @@ class Slicer:
     def write_gcode(self, gcode_writer):
         print("6. Writing GCode")
         pmin, pmax = self.get_bounds()
-        gcode_writer.write_header(pmin, pmax)
+        gcode_writer.write_header(pmin, pmax, self.resume)
         i = 0
         for l in self.layers:
             future_layers = self.layers[i + 1:]
@@ -139,6 +495,70 @@ class Slicer:
             l.write_layer(gcode_writer, future_layers)
             i += 1
         gcode_writer.write_footer()
+        print("\t-> Skipped {} redundant mixture changes".format(gcode_writer.skipped_mixture_changes))
+
+    def estimate_bounds(self):
+        # Bounds of the translated bounding box and every purge tower, used when the header is written before the
+        # layers are known
+        xy_translation, z_translation = self.get_translation()
+        bounds_min = [self.min.x + xy_translation.x(), self.min.y + xy_translation.y()]
+        bounds_max = [self.max.x + xy_translation.x(), self.max.y + xy_translation.y()]
+        # Towers of size zero are never printed, see Layer.generate_purge_tower
+        if self.purge_tower_x_size == 0 or self.purge_tower_y_size == 0:
+            return bounds_min, bounds_max
+        for lower, higher, center in self.purge_tower_centers:
+            x = center.x() + xy_translation.x()
+            y = center.y() + xy_translation.y()
+            bounds_min = [min(bounds_min[0], x - self.purge_tower_x_size / 2),
+                          min(bounds_min[1], y - self.purge_tower_y_size / 2)]
+            bounds_max = [max(bounds_max[0], x + self.purge_tower_x_size / 2),
+                          max(bounds_max[1], y + self.purge_tower_y_size / 2)]
+        return bounds_min, bounds_max
+
+    def prepare_layers(self, ranges):
+        # Everything process_layers needs to know before the first layer is sliced
+        self.cache_ranges = ranges
+        if self.checkpointer is not None:
+            self.checkpointer.open(ranges, self.cross_sectioner, self.min, self.max)
+        self.compute_purge_tower_centers(ranges)
+
+    def process_layers(self, ranges, translate=True):
+        """ Yields every layer as soon as it is sliced, connected and centered, without keeping it in self.layers.
+        Without translate the layers are left uncentered, for callers that place them on several beds."""
+        # The towers of ranges printed below a resumed window keep growing inside it
+        started_ranges = self.ranges_below_window
+        if self.purge_planner is not None:
+            print("\t-> Purge towers are sized for the largest transition into their range, as the layers are not "
+                  "known up front")
+        index = 1
+        self.total_skipped = 0
+        for l in self.generate_layers():
+            self.cut_layer(l, ranges)
+            for r in l.get_occupied_ranges():
+                if r not in started_ranges:
+                    started_ranges.append(r)
+            self.connect_layer(l, index, started_ranges, self.schedule_ranges(l))
+            if translate:
+                xy_translation, z_translation = self.get_translation()
+                l.translate_paths(xy_translation, z_translation)
+            yield l
+            index += 1
+        self.report_connection_statistics()
+
+    def slice_and_write(self, ranges, gcode_writer, queue_size=8, z_start=None, z_end=None, resume=True):
+        """ Slices and writes the part in one pass. Each layer is cut, connected and centered as soon as it is
+        sliced and handed to the writer through a bounded queue, so writing overlaps with slicing and only a window
+        of layers is kept in memory. Because later layers are not known yet, the purge towers of every range that
+        has been started keep growing up to the top of the part."""
+        self.set_z_window(z_start, z_end, resume)
+        print("1. Generating purge tower base locations")
+        self.prepare_layers(ranges)
+        print("2. Slicing and writing GCode")
+
+        pmin, pmax = self.estimate_bounds()
+        pipeline.write_pipelined(self.process_layers(ranges), gcode_writer, pmin, pmax,
+                                 gcode_writer.lookahead_distance, queue_size, self.resume)
+        print("\t-> Skipped {} redundant mixture changes".format(gcode_writer.skipped_mixture_changes))
 
     def visualize_geometry(self):
         for l in self.layers:
@@ -0,0 +1,152 @@
+import os
+import time
+import slicer
+import preview
+import range_planner
+import multi_target
+import pyvcad as pv
+import outline_slicer
+import gcode_writer as gw
+
+
+# Make gradient ranges
+def generate_linear_ranges(num_ranges, min, max):
+    ranges = []
+    step = (max - min) / num_ranges
+    for i in range(num_ranges):
+        ranges.append((min + i * step, min + (i + 1) * step))
+    return ranges
+
+
+def voxel_size_of(settings):
+    voxel_size = settings["object_settings"]["voxel_size"]
+    return pv.Vec3(voxel_size[0], voxel_size[1], voxel_size[2])
+
+
+# Pick which slicer to use (Cutting is strategy 1 in the paper, and Outline is strategy 2)
+def make_slicer(vcad_object, bbox_min, bbox_max, settings):
+    if settings["slicer_settings"]["mode"] == "outline":
+        return outline_slicer.OutlineSlicer(vcad_object, bbox_min, bbox_max, voxel_size_of(settings), settings)
+    return slicer.Slicer(vcad_object, bbox_min, bbox_max, voxel_size_of(settings), settings)
+
+
+def plan_ranges(part_slicer, settings, bbox_min, bbox_max):
+    num_regions = settings["gradient_settings"]["num_regions"]
+    ranges = generate_linear_ranges(num_regions, 0.0, 1.0)
+
+    # Optionally fit the ranges to the material fractions the object actually contains
+    if settings["slicer_settings"].get("range_planning", {}).get("use", False):
+        print("Planning gradient ranges from the material histogram")
+        planner = range_planner.RangePlanner(settings)
+        planner.sample_histogram(part_slicer.cross_sectioner, bbox_min.z, bbox_max.z)
+        planned_ranges = planner.plan(num_regions)
+        if len(planned_ranges) > 0:
+            print("\t-> Planned {} ranges with error {:.4f} (linear ranges: {:.4f})".format(
+                len(planned_ranges), planner.normalized_error(planner.ranges_cost(planned_ranges)),
+                planner.normalized_error(planner.ranges_cost(ranges))))
+            ranges = planned_ranges
+        else:
+            print("\t-> No material found while sampling, keeping the linear ranges")
+    return ranges
+
+
+def run_job(vcad_object, settings, output_file):
+    """ Slices an OpenVCAD object with the given settings and writes the G-code to output_file, returns the name of
+    the written file."""
+    voxel_size = voxel_size_of(settings)
+
+    # Report actual VCAD bounding box
+    [bbox_min, bbox_max] = vcad_object.bounding_box()
+
+    # Compute the total number of voxels based on the dimensions of the OpenVCAD object and the voxel size
+    x_dim = int((bbox_max.x - bbox_min.x) / voxel_size.x)
+    y_dim = int((bbox_max.y - bbox_min.y) / voxel_size.y)
+    z_dim = int((bbox_max.z - bbox_min.z) / voxel_size.z)
+    total_voxels = x_dim * y_dim * z_dim
+
+    # Print info about the OpenVCAD object
+    print("Starting slice of OpenVCAD object with dimensions: ")
+    print("Bounding Box Min: ({},{},{})".format(bbox_min.x, bbox_min.y, bbox_min.z))
+    print("Bounding Box Max: ({},{},{})".format(bbox_max.x, bbox_max.y, bbox_max.z))
+    print("Voxel size: ({},{},{})".format(voxel_size.x, voxel_size.y, voxel_size.z))
+    print("With total number of voxels: {}".format(total_voxels))
+    print("\nSlicing...")
+
+    # Start timer for slicing
+    start = time.time()
+
+    # Check if settings["slicer_settings"]["mode"] mode is present
+    if "mode" not in settings["slicer_settings"]:
+        raise ValueError("No slicer mode specified. Please use 'outline' or 'cutting'")
+    if settings["slicer_settings"]["mode"] == "outline":
+        print("Using outline slicer")
+    elif settings["slicer_settings"]["mode"] == "cutting":
+        print("Using cutting slicer")
+    else:
+        raise ValueError("Unknown slicer mode. Please use 'outline' or 'cutting'")
+
+    # Slicing and writing can overlap, so that each layer is written while the next ones are still being sliced
+    pipelined_settings = settings["slicer_settings"].get("pipelined", {})
+    use_pipeline = pipelined_settings.get("use", False)
+
+    part_slicer = make_slicer(vcad_object, bbox_min, bbox_max, settings)
+    ranges = plan_ranges(part_slicer, settings, bbox_min, bbox_max)
+
+    print("Gradient ranges: ") # Print ranges
+    for r in ranges:
+        print("\t{}".format(r))
+
+    # Optionally slice only a window of heights, to resume a failed print or to print a section of the part on its own
+    partial_settings = settings["slicer_settings"].get("partial_slicing", {})
+    z_start = None
+    z_end = None
+    if partial_settings.get("use", False):
+        z_start = partial_settings.get("z_start", None)
+        z_end = partial_settings.get("z_end", None)
+        print("Slicing heights from {} to {}".format(z_start, z_end))
+    resume = partial_settings.get("resume", True)
+
+    # Optionally write the same slice for several printer profiles at once, each to its own file. Every target is
+    # written on a thread of its own, which a forked format pool is not safe to start from
+    multi_target_settings = settings["slicer_settings"].get("multi_target", {})
+    use_multi_target = multi_target_settings.get("use", False) and len(multi_target_settings.get("targets", [])) > 0
+    gcode_writer = gw.GCodeWriter(output_file, settings, not use_multi_target)
+    targets = [(settings, gcode_writer)]
+    if use_multi_target:
+        output_base, output_extension = os.path.splitext(output_file)
+        for target in multi_target_settings.get("targets", []):
+            if "name" not in target:
+                raise ValueError("Every output target needs a name")
+            target_output = target.get("output", "{}_{}{}".format(output_base, target["name"], output_extension))
+            merged_settings = multi_target.target_settings(settings, target)
+            targets.append((merged_settings, gw.GCodeWriter(target_output, merged_settings, False)))
+        print("Writing {} output targets".format(len(targets)))
+
+    def slice_and_write():
+        if len(targets) > 1:
+            # Every target is streamed, the layers are never kept for a separate write
+            multi_target.slice_and_write_targets(part_slicer, ranges, targets,
+                                                 pipelined_settings.get("queue_size", 8), z_start, z_end, resume)
+        elif use_pipeline:
+            part_slicer.slice_and_write(ranges, gcode_writer, pipelined_settings.get("queue_size", 8), z_start, z_end,
+                                        resume)
+        else:
+            part_slicer.slice(ranges, z_start, z_end, resume)
+            # Write the gcode
+            part_slicer.write_gcode(gcode_writer)
+
+    # Optionally stream a coarse preview first, and refine to full resolution in the background while it is shown
+    preview_settings = settings["slicer_settings"].get("preview", {})
+    if preview_settings.get("use", False):
+        print("Slicing a coarse preview")
+        preview_slicer = make_slicer(vcad_object, bbox_min, bbox_max, preview.preview_settings(settings))
+        preview_layers = preview.stream_preview(preview_slicer, ranges)
+        print("Refining to full resolution")
+        preview.refine_in_background(slice_and_write, preview_layers, preview_settings.get("visualize_every", 0))
+    else:
+        slice_and_write()
+
+    for target_settings, target_writer in targets:
+        print("GCode written to {}".format(target_writer.filename))
+    print("Done! Slicing took {} seconds".format(time.time() - start))
+    return gcode_writer.filename
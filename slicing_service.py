@@ -0,0 +1,391 @@
+import argparse
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+import traceback
+
+
+class ProgressStream:
+    """ Stands in for stdout in a worker, every printed line becomes a progress event of the running job."""
+
+    def __init__(self, event_queue, job_id):
+        self.event_queue = event_queue
+        self.job_id = job_id
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            if len(line.strip()) > 0:
+                self.event_queue.put((self.job_id, "progress", line))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def load_object(objects, source, max_cached_objects):
+    # Objects are built once per worker and kept for later jobs with the same source
+    key = object_key(source)
+    if key in objects:
+        objects.move_to_end(key)
+        return objects[key]
+    namespace = {"__name__": "vcad_job"}
+    exec(compile(source, "<vcad job>", "exec"), namespace)
+    vcad_object = namespace.get("vcad_object", None)
+    if vcad_object is None:
+        raise ValueError("The VCAD source of a job has to define vcad_object")
+    objects[key] = vcad_object
+    while len(objects) > max_cached_objects:
+        objects.popitem(last=False)
+    return vcad_object
+
+
+def object_key(source):
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+def worker_main(worker_index, job_queue, event_queue, max_cached_objects):
+    # Importing the slicer (and pyvcad) once is what keeps the worker warm between jobs. If that fails, every job
+    # fails with the reason instead of waiting for a worker that is gone
+    import_error = None
+    try:
+        import slicing_job
+    except Exception:
+        import_error = traceback.format_exc()
+
+    objects = collections.OrderedDict()
+    while True:
+        job = job_queue.get()
+        if job is None:
+            return
+        job_id = job["job_id"]
+        event_queue.put((job_id, "started", worker_index))
+        if import_error is not None:
+            event_queue.put((job_id, "failed", import_error))
+            continue
+        try:
+            output_directory = os.path.dirname(job["output"])
+            if len(output_directory) > 0:
+                os.makedirs(output_directory, exist_ok=True)
+            with contextlib.redirect_stdout(ProgressStream(event_queue, job_id)):
+                vcad_object = load_object(objects, job["source"], max_cached_objects)
+                output = slicing_job.run_job(vcad_object, job["settings"], job["output"])
+            event_queue.put((job_id, "done", output))
+        except Exception:
+            event_queue.put((job_id, "failed", traceback.format_exc()))
+
+
+class SlicingService:
+    """ Long-running local slicing service. A pool of worker processes imports the slicer once and keeps the objects
+    of recent jobs built, jobs are queued by priority (higher first, then in submission order) and a job is preferably
+    handed to an idle worker that already built its object. Every job has a list of events (queued, started, one per
+    progress line, then done, failed or cancelled) that clients can watch while it runs. Only the latest
+    max_job_events events of a job and the max_finished_jobs most recently finished jobs are kept, so that a service
+    that runs for a long time does not grow without bound. A worker that dies fails the job it was running and is
+    replaced by a new one.
+
+    Jobs carry Python source that is executed by the workers, so the service only listens on a Unix socket that is
+    accessible to its own user."""
+
+    def __init__(self, socket_path, workers=2, max_cached_objects=4, max_finished_jobs=100, max_job_events=1000):
+        self.socket_path = socket_path
+        self.num_workers = workers
+        self.max_cached_objects = max_cached_objects
+        self.max_finished_jobs = max_finished_jobs
+        self.max_job_events = max_job_events
+        if self.num_workers < 1:
+            raise ValueError("The slicing service needs at least one worker")
+        if self.max_finished_jobs < 0 or self.max_job_events < 1:
+            raise ValueError("The slicing service has to keep at least the latest event of every job")
+
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.finished_jobs = collections.deque()  # Ids of the kept finished jobs, oldest first
+        self.queued = []
+        self.job_ids = itertools.count(1)
+        self.running = True
+
+        self.event_queue = multiprocessing.Queue()
+        self.workers = []  # (process, job queue)
+        self.worker_jobs = []  # Id of the job each worker is running, or None
+        self.idle_workers = []
+        self.warm_objects = []  # Object keys each worker has built most recently
+        self.server = None
+
+    def spawn_worker(self, worker_index):
+        job_queue = multiprocessing.Queue()
+        # Not a daemon process, since the G-code writer may start a pool of its own
+        process = multiprocessing.Process(target=worker_main,
+                                          args=(worker_index, job_queue, self.event_queue, self.max_cached_objects))
+        process.start()
+        return process, job_queue
+
+    def start(self):
+        for i in range(self.num_workers):
+            self.workers.append(self.spawn_worker(i))
+            self.worker_jobs.append(None)
+            self.idle_workers.append(i)
+            self.warm_objects.append(collections.deque(maxlen=self.max_cached_objects))
+        threading.Thread(target=self.collect_events, daemon=True).start()
+        threading.Thread(target=self.dispatch_jobs, daemon=True).start()
+        threading.Thread(target=self.monitor_workers, daemon=True).start()
+
+    def add_event(self, job, event, **values):
+        values.update({"job_id": job["job_id"], "event": event, "time": time.time()})
+        job["events"].append(values)
+        # The oldest events are dropped in batches, dropped_events keeps the indices clients watch by unchanged
+        if len(job["events"]) > 2 * self.max_job_events:
+            dropped = len(job["events"]) - self.max_job_events
+            del job["events"][:dropped]
+            job["dropped_events"] += dropped
+        self.condition.notify_all()
+
+    def finish_job(self, job, event, **values):
+        job["state"] = event
+        self.add_event(job, event, **values)
+        self.finished_jobs.append(job["job_id"])
+        while len(self.finished_jobs) > self.max_finished_jobs:
+            del self.jobs[self.finished_jobs.popleft()]
+
+    def submit(self, source, settings, output=None, priority=0):
+        with self.condition:
+            job_id = next(self.job_ids)
+            if output is None:
+                output = os.path.join("output", "{}_{}.gcode".format(settings["object_settings"]["name"], job_id))
+            job = {"job_id": job_id, "source": source, "settings": settings, "output": output, "priority": priority,
+                   "object_key": object_key(source), "state": "queued", "events": [], "dropped_events": 0}
+            self.jobs[job_id] = job
+            self.queued.append(job)
+            self.add_event(job, "queued", priority=priority)
+            return job_id
+
+    def cancel(self, job_id):
+        # Only queued jobs can be cancelled, a running job finishes
+        with self.condition:
+            job = self.jobs[job_id]
+            if job["state"] != "queued":
+                return False
+            self.queued.remove(job)
+            self.finish_job(job, "cancelled")
+            return True
+
+    def next_job(self, worker_index):
+        # Highest priority first, then a job whose object this worker already built, then the oldest job
+        warm = self.warm_objects[worker_index]
+        return min(self.queued, key=lambda job: (-job["priority"], job["object_key"] not in warm, job["job_id"]))
+
+    def dispatch_jobs(self):
+        with self.condition:
+            while self.running:
+                if len(self.queued) == 0 or len(self.idle_workers) == 0:
+                    self.condition.wait()
+                    continue
+                worker_index = self.idle_workers.pop(0)
+                job = self.next_job(worker_index)
+                self.queued.remove(job)
+                job["state"] = "running"
+                job["worker"] = worker_index
+                self.worker_jobs[worker_index] = job["job_id"]
+                warm = self.warm_objects[worker_index]
+                if job["object_key"] in warm:
+                    warm.remove(job["object_key"])
+                warm.append(job["object_key"])
+                self.workers[worker_index][1].put({"job_id": job["job_id"], "source": job["source"],
+                                                   "settings": job["settings"], "output": job["output"]})
+
+    def collect_events(self):
+        while True:
+            job_id, event, value = self.event_queue.get()
+            with self.condition:
+                job = self.jobs.get(job_id)
+                # Late events of a job whose worker died were already answered by a failure
+                if job is None or job["state"] != "running":
+                    continue
+                if event == "started":
+                    self.add_event(job, event, worker=value)
+                elif event == "progress":
+                    self.add_event(job, event, message=value)
+                else:
+                    if event == "done":
+                        self.finish_job(job, event, output=value)
+                    else:
+                        self.finish_job(job, event, error=value)
+                    self.worker_jobs[job["worker"]] = None
+                    self.idle_workers.append(job["worker"])
+
+    def monitor_workers(self):
+        # A worker that is killed or crashes in native code never reports its job, so its exit is watched for here
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                sentinels = {process.sentinel: i for i, (process, job_queue) in enumerate(self.workers)}
+            exited = multiprocessing.connection.wait(list(sentinels), timeout=1.0)
+            with self.condition:
+                if not self.running:
+                    return
+                for sentinel in exited:
+                    worker_index = sentinels[sentinel]
+                    process = self.workers[worker_index][0]
+                    process.join()
+                    job_id = self.worker_jobs[worker_index]
+                    if job_id is not None and self.jobs[job_id]["state"] == "running":
+                        self.finish_job(self.jobs[job_id], "failed",
+                                        error="Worker {} exited with code {} while running the job".format(
+                                            worker_index, process.exitcode))
+                    print("Worker {} exited with code {}, starting a new one".format(worker_index, process.exitcode))
+                    self.workers[worker_index] = self.spawn_worker(worker_index)
+                    self.worker_jobs[worker_index] = None
+                    self.warm_objects[worker_index].clear()
+                    if worker_index not in self.idle_workers:
+                        self.idle_workers.append(worker_index)
+                    self.condition.notify_all()
+
+    def watch(self, job_id, since=0):
+        """ Yields the events of a job from index since on, as they happen, until the job has finished. Events that
+        were dropped before they were watched are skipped."""
+        with self.condition:
+            # The job is held on to, so that it can be watched to its end even if it is evicted meanwhile
+            job = self.jobs[job_id]
+        while True:
+            with self.condition:
+                while job["dropped_events"] + len(job["events"]) <= since and job["state"] in ("queued", "running"):
+                    self.condition.wait()
+                since = max(since, job["dropped_events"])
+                events = job["events"][since - job["dropped_events"]:]
+                finished = job["state"] not in ("queued", "running")
+            for event in events:
+                yield event
+            since += len(events)
+            if finished and len(events) == 0:
+                return
+
+    def status(self):
+        with self.condition:
+            return [{"job_id": job["job_id"], "state": job["state"], "priority": job["priority"],
+                     "output": job["output"]} for job in self.jobs.values()]
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for process, job_queue in self.workers:
+            job_queue.put(None)
+        for process, job_queue in self.workers:
+            process.join()
+        if self.server is not None:
+            self.server.shutdown()
+
+    def serve_forever(self):
+        # A stale socket of an earlier run is replaced, anything else at the path is left alone
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                raise ValueError("{} exists and is not a socket".format(self.socket_path))
+            os.remove(self.socket_path)
+        directory = os.path.dirname(self.socket_path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for response in service.handle_line(self.rfile.readline()):
+                    self.wfile.write((json.dumps(response) + "\n").encode())
+                    self.wfile.flush()
+
+        old_umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+        self.start()
+        print("Slicing service listening on {} with {} workers".format(self.socket_path, self.num_workers))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+    def handle_line(self, line):
+        """ Yields the responses to one line sent by a client, or an error if it is not a JSON request."""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            yield {"error": "Malformed request: {}".format(e)}
+            return
+        if not isinstance(request, dict):
+            yield {"error": "A request has to be a JSON object"}
+            return
+        yield from self.handle_request(request)
+
+    def handle_request(self, request):
+        """ Yields the responses to a request, one per line. Watching a job streams its events."""
+        command = request.get("command")
+        try:
+            if command == "submit":
+                yield {"job_id": self.submit(request["source"], request["settings"], request.get("output"),
+                                             request.get("priority", 0))}
+            elif command == "watch":
+                for event in self.watch(request["job_id"], request.get("since", 0)):
+                    yield event
+            elif command == "cancel":
+                yield {"cancelled": self.cancel(request["job_id"])}
+            elif command == "status":
+                yield {"jobs": self.status()}
+            elif command == "shutdown":
+                yield {"shutting_down": True}
+                threading.Thread(target=self.shutdown, daemon=True).start()
+            else:
+                yield {"error": "Unknown command {}".format(command)}
+        except KeyError as e:
+            yield {"error": "Missing or unknown {}".format(e)}
+        except (TypeError, ValueError) as e:
+            yield {"error": "Invalid request: {}".format(e)}
+
+
+def send_request(socket_path, request):
+    """ Client side: sends a request to a running service and yields its responses."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(request) + "\n").encode())
+        with connection.makefile("r") as responses:
+            for line in responses:
+                yield json.loads(line)
+
+
+def submit_job(socket_path, source, settings, output=None, priority=0):
+    response = next(send_request(socket_path, {"command": "submit", "source": source, "settings": settings,
+                                               "output": output, "priority": priority}))
+    if "error" in response:
+        raise ValueError(response["error"])
+    return response["job_id"]
+
+
+def watch_job(socket_path, job_id):
+    return send_request(socket_path, {"command": "watch", "job_id": job_id})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local slicing service with warm workers and a job queue")
+    parser.add_argument("--socket", default="output/slicing_service.sock", help="Path of the Unix socket")
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker processes")
+    parser.add_argument("--cached-objects", type=int, default=4, help="Objects each worker keeps built")
+    parser.add_argument("--kept-jobs", type=int, default=100, help="Finished jobs kept for watching and status")
+    parser.add_argument("--kept-events", type=int, default=1000, help="Latest events kept of every job")
+    arguments = parser.parse_args()
+    SlicingService(arguments.socket, arguments.workers, arguments.cached_objects, arguments.kept_jobs,
+                   arguments.kept_events).serve_forever()
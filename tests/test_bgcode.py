@@ -0,0 +1,133 @@
+import os
+import struct
+import sys
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bgcode
+
+
+def heatshrink_decompress(data, window_bits, lookahead_bits):
+    out = bytearray()
+    bits = "".join("{:08b}".format(byte) for byte in data)
+    i = 0
+    while i + 9 <= len(bits):
+        if bits[i] == "1":
+            out.append(int(bits[i + 1:i + 9], 2))
+            i += 9
+        else:
+            if i + 1 + window_bits + lookahead_bits > len(bits):
+                break
+            offset = int(bits[i + 1:i + 1 + window_bits], 2) + 1
+            length = int(bits[i + 1 + window_bits:i + 1 + window_bits + lookahead_bits], 2) + 1
+            for k in range(length):
+                out.append(out[-offset])
+            i += 1 + window_bits + lookahead_bits
+    return bytes(out)
+
+
+def meatpack_decode(data):
+    codes = {code: character for character, code in bgcode.MEATPACK_TABLE.items()}
+    assert data[:3] == bytes([bgcode.MEATPACK_SIGNAL_BYTE, bgcode.MEATPACK_SIGNAL_BYTE,
+                              bgcode.MEATPACK_ENABLE_PACKING])
+    assert data[-3:] == bytes([bgcode.MEATPACK_SIGNAL_BYTE, bgcode.MEATPACK_SIGNAL_BYTE, bgcode.MEATPACK_RESET_ALL])
+    data = data[3:-3]
+    text = []
+    i = 0
+    while i < len(data):
+        byte = data[i]
+        i += 1
+        for nibble in [byte & 0x0F, byte >> 4]:
+            if nibble == 0x0F:
+                text.append(chr(data[i]))
+                i += 1
+            else:
+                text.append(codes[nibble])
+    # Odd length lines are padded with an extra newline
+    return "".join(text).replace("\n\n", "\n")
+
+
+def read_blocks(path):
+    with open(path, "rb") as bgcode_file:
+        data = bgcode_file.read()
+    magic, version, checksum = struct.unpack_from("<4sIH", data, 0)
+    assert (magic, version, checksum) == (bgcode.FILE_MAGIC, bgcode.FILE_VERSION, bgcode.CHECKSUM_CRC32)
+
+    blocks = []
+    offset = 10
+    while offset < len(data):
+        block_type, compression, size = struct.unpack_from("<HHI", data, offset)
+        header_size = 8
+        compressed_size = size
+        if compression != bgcode.COMPRESSION_NONE:
+            compressed_size = struct.unpack_from("<I", data, offset + 8)[0]
+            header_size = 12
+        block_end = offset + header_size + 2 + compressed_size
+        crc = struct.unpack_from("<I", data, block_end)[0]
+        assert crc == zlib.crc32(data[offset:block_end]) & 0xFFFFFFFF
+        encoding = struct.unpack_from("<H", data, offset + header_size)[0]
+        payload = data[offset + header_size + 2:block_end]
+        if compression == bgcode.COMPRESSION_DEFLATE:
+            payload = zlib.decompress(payload)
+        elif compression == bgcode.COMPRESSION_HEATSHRINK_11_4:
+            payload = heatshrink_decompress(payload, 11, 4)
+        elif compression == bgcode.COMPRESSION_HEATSHRINK_12_4:
+            payload = heatshrink_decompress(payload, 12, 4)
+        assert len(payload) == size
+        blocks.append((block_type, compression, encoding, payload))
+        offset = block_end + 4
+    return blocks
+
+
+def write_file(path, text, **options):
+    bgcode_file = bgcode.BGCodeFile(str(path), {"printer_model": "MK4S"}, {"filament_type": "PLA"},
+                                    {"generator": "VCAD-Slicer"}, **options)
+    bgcode_file.write(text)
+    bgcode_file.close()
+    return read_blocks(str(path))
+
+
+GCODE = "".join("G1 X{:.3f} Y{:.3f} E{:.5f} ; move {}\nM117 layer {}\n".format(i * 0.5, i * 0.25, i * 0.01, i, i)
+                for i in range(2000))
+
+
+def expected_lines(text):
+    lines = [line.split(";", 1)[0].rstrip() for line in text.split("\n")]
+    return "".join(line + "\n" for line in lines if len(line) > 0)
+
+
+def test_default_file_round_trips(tmp_path, monkeypatch):
+    monkeypatch.setattr(bgcode, "heatshrink2", None)
+    blocks = write_file(tmp_path / "default.bgcode", GCODE)
+
+    metadata = {block_type: (compression, payload.decode("utf-8")) for block_type, compression, encoding, payload
+                in blocks if block_type != bgcode.BLOCK_GCODE}
+    assert metadata[bgcode.BLOCK_PRINTER_METADATA] == (bgcode.COMPRESSION_NONE, "printer_model=MK4S\n")
+    assert metadata[bgcode.BLOCK_PRINT_METADATA] == (bgcode.COMPRESSION_DEFLATE, "filament_type=PLA\n")
+
+    gcode_blocks = [b for b in blocks if b[0] == bgcode.BLOCK_GCODE]
+    assert len(gcode_blocks) > 1
+    assert all(b[1] == bgcode.COMPRESSION_HEATSHRINK_12_4 and b[2] == bgcode.GCODE_ENCODING_MEATPACK
+               for b in gcode_blocks)
+    assert "".join(meatpack_decode(b[3]) for b in gcode_blocks) == expected_lines(GCODE)
+
+
+def test_uncompressed_plain_file_round_trips(tmp_path):
+    blocks = write_file(tmp_path / "plain.bgcode", GCODE, compression="none", use_meatpack=False,
+                        metadata_compression="none")
+    assert all(b[1] == bgcode.COMPRESSION_NONE for b in blocks)
+    text = "".join(b[3].decode("utf-8") for b in blocks if b[0] == bgcode.BLOCK_GCODE)
+    assert text == GCODE
+
+
+def test_heatshrink_11_4_round_trips():
+    data = GCODE.encode("utf-8")[:20000]
+    assert heatshrink_decompress(bgcode.heatshrink_compress(data, 11, 4), 11, 4) == data
+
+
+def test_deflate_is_refused_for_gcode_blocks(tmp_path):
+    with pytest.raises(ValueError):
+        bgcode.BGCodeFile(str(tmp_path / "deflate.bgcode"), {}, {}, {}, compression="deflate")
@@ -0,0 +1,50 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import range_planner
+
+
+def make_planner(histogram, **planning_settings):
+    planner = range_planner.RangePlanner({"slicer_settings": {"range_planning": dict(bins=len(histogram),
+                                                                                     **planning_settings)}})
+    planner.histogram = list(histogram)
+    return planner
+
+
+def assert_covers_unit_interval(ranges):
+    assert ranges[0][0] == 0.0
+    assert ranges[-1][1] == 1.0
+    for (lower, higher), (next_lower, next_higher) in zip(ranges, ranges[1:]):
+        assert higher == next_lower
+    for lower, higher in ranges:
+        assert lower < higher
+
+
+def test_plan_covers_unit_interval_across_empty_stretches():
+    # Two clusters of material with empty stretches below, between and above them
+    histogram = [0.0] * 50
+    for i in range(10, 15):
+        histogram[i] = 1.0
+    for i in range(30, 35):
+        histogram[i] = 2.0
+    planner = make_planner(histogram)
+    for max_ranges in range(1, 6):
+        ranges = planner.plan(max_ranges)
+        assert 1 <= len(ranges) <= max_ranges
+        assert_covers_unit_interval(ranges)
+
+
+def test_plan_cost_includes_empty_stretches():
+    # The material sits at both ends, so a single range spanning the gap prints it at 0.5
+    histogram = [1.0] + [0.0] * 8 + [1.0]
+    planner = make_planner(histogram)
+    ranges = planner.plan(2)
+    assert len(ranges) == 2
+    assert_covers_unit_interval(ranges)
+    assert planner.ranges_cost(ranges) < planner.ranges_cost(planner.plan(1))
+
+
+def test_plan_without_material_is_one_range():
+    assert make_planner([0.0] * 10).plan(3) == [(0.0, 1.0)]
@@ -0,0 +1,96 @@
+import concurrent.futures
+import math
+import pyvcad as pv
+import pyvcad_compilers as pvc
+
+
+class TiledCrossSectioner:
+    """ Drop-in replacement for pvc.CrossSectionSlicer that samples the XY domain in tiles. A coarse cross-section of
+    the whole window tells which tiles hold geometry at a height, only those tiles are sampled (on a thread pool) and
+    their outlines or range polygons are stitched back together. Tiles overlap by a few voxels and are aligned to the
+    voxel grid of the full window, and the pieces are merged by offsetting them out and back in by a fraction of a
+    voxel, which unions the overlapping pieces. The raster of a single sample is bounded by the tile size."""
+
+    def __init__(self, root, bbox_min, bbox_max, voxel_size, settings):
+        tiled_settings = settings["slicer_settings"].get("tiled_sampling", {})
+        tile_size = tiled_settings.get("tile_size", 50.0)
+        overlap_voxels = tiled_settings.get("overlap_voxels", 2)
+        occupancy_scale = tiled_settings.get("occupancy_scale", 8)
+        self.workers = tiled_settings.get("workers", 4)
+        if tile_size <= 0 or occupancy_scale < 1:
+            raise ValueError("Tiled sampling needs a positive tile size and an occupancy scale of at least 1")
+
+        self.min = bbox_min
+        self.max = bbox_max
+        self.voxel_size = voxel_size
+        self.merge_distance = min(voxel_size.x, voxel_size.y) / 4.0
+        self.occupancy_sectioner = pvc.CrossSectionSlicer(root, bbox_min, bbox_max, pv.Vec3(
+            voxel_size.x * occupancy_scale, voxel_size.y * occupancy_scale, voxel_size.z))
+        self.occupancy_padding = max(voxel_size.x, voxel_size.y) * occupancy_scale
+
+        # Tiles of whole voxels, each extended by the overlap on every side
+        tile_voxels_x = max(int(tile_size / voxel_size.x), 1)
+        tile_voxels_y = max(int(tile_size / voxel_size.y), 1)
+        count_x = max(int(math.ceil((bbox_max.x - bbox_min.x) / (tile_voxels_x * voxel_size.x))), 1)
+        count_y = max(int(math.ceil((bbox_max.y - bbox_min.y) / (tile_voxels_y * voxel_size.y))), 1)
+        self.tiles = []  # (min_x, min_y, max_x, max_y, cross-sectioner)
+        for i in range(count_x):
+            for j in range(count_y):
+                tile_min_x = max(bbox_min.x + (i * tile_voxels_x - overlap_voxels) * voxel_size.x, bbox_min.x)
+                tile_min_y = max(bbox_min.y + (j * tile_voxels_y - overlap_voxels) * voxel_size.y, bbox_min.y)
+                tile_max_x = min(bbox_min.x + ((i + 1) * tile_voxels_x + overlap_voxels) * voxel_size.x, bbox_max.x)
+                tile_max_y = min(bbox_min.y + ((j + 1) * tile_voxels_y + overlap_voxels) * voxel_size.y, bbox_max.y)
+                sectioner = pvc.CrossSectionSlicer(root, pv.Vec3(tile_min_x, tile_min_y, bbox_min.z),
+                                                   pv.Vec3(tile_max_x, tile_max_y, bbox_max.z), voxel_size)
+                self.tiles.append((tile_min_x, tile_min_y, tile_max_x, tile_max_y, sectioner))
+
+        self.occupancy = {}  # Occupied tiles of the most recently sampled heights
+
+    def occupied_tiles(self, z):
+        if z in self.occupancy:
+            return self.occupancy[z]
+
+        boxes = []
+        for outline in self.occupancy_sectioner.slice_geometry(z):
+            xs = [p.x() for p in outline]
+            ys = [p.y() for p in outline]
+            boxes.append((min(xs) - self.occupancy_padding, min(ys) - self.occupancy_padding,
+                          max(xs) + self.occupancy_padding, max(ys) + self.occupancy_padding))
+        tiles = []
+        for tile in self.tiles:
+            for min_x, min_y, max_x, max_y in boxes:
+                if tile[0] <= max_x and min_x <= tile[2] and tile[1] <= max_y and min_y <= tile[3]:
+                    tiles.append(tile)
+                    break
+
+        # Cutting asks for the same heights again, only a few are kept
+        if len(self.occupancy) >= 8:
+            self.occupancy.pop(next(iter(self.occupancy)))
+        self.occupancy[z] = tiles
+        return tiles
+
+    def sample(self, z, sample_tile):
+        tiles = self.occupied_tiles(z)
+        if self.workers > 1 and len(tiles) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(sample_tile, [tile[4] for tile in tiles]))
+        return [sample_tile(tile[4]) for tile in tiles]
+
+    def merge(self, pieces):
+        if len(pieces) == 0:
+            return []
+        return pv.Polygon2.Offset(pv.Polygon2.Offset(pieces, self.merge_distance), -self.merge_distance)
+
+    def slice_geometry(self, z):
+        pieces = []
+        for outlines in self.sample(z, lambda sectioner: sectioner.slice_geometry(z)):
+            pieces.extend(outlines)
+        return self.merge(pieces)
+
+    def slice_material(self, z, material, ranges):
+        results = self.sample(z, lambda sectioner: sectioner.slice_material(z, material, ranges))
+        pieces = {}
+        for result in results:
+            for lower, higher, polygons in result:
+                pieces.setdefault((lower, higher), []).extend(polygons)
+        return [(lower, higher, self.merge(pieces.get((lower, higher), []))) for lower, higher in ranges]
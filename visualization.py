@@ -73,7 +73,7 @@ def plot_labeled_paths(labeled_paths, printer_bounds=None, name=None, figsize=(1
     plot_travels = False
     plt.figure(figsize=figsize)
 
-    for lower, higher, is_extrusion, path in labeled_paths:
+    for lower, higher, is_extrusion, path, layers in labeled_paths:
         points = [(p.x(), p.y()) for p in path.points()]
         color = cm.viridis((lower + higher) / 2.0)
         # Plot extrusion paths as arrows. Plot travels as dashed lines
@@ -110,7 +110,7 @@ def plot_labeled_paths(labeled_paths, printer_bounds=None, name=None, figsize=(1
 #     index = 0
 #     for r in ranges:
 #         plt.figure(figsize=figsize)
-#         for lower, higher, is_extrusion, path in labeled_paths:
+#         for lower, higher, is_extrusion, path, layers in labeled_paths:
 #             if lower == r[0]:
 #                 points = [(p.x(), p.y()) for p in path.points()]
 #                 color = cm.viridis((lower + higher) / 2.0)